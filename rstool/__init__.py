@@ -1,3 +1,3 @@
 from .postprocess import postprocess
-from .prof import prof
-from .main import __version__
+from .prof import prof, prof_segments, prof_wmo
+from .main import __version__, convert
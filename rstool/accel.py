@@ -0,0 +1,238 @@
+import os
+import numpy as np
+
+from rstool.const import *
+
+# Optional numba backend for the hot loops. If numba is installed, the kernels
+# below are compiled with numba and used instead of the numpy reference
+# implementation. The backend can be forced with set_backend or the
+# environment variable RSTOOL_BACKEND ("numpy" or "numba"). The results of
+# the two backends agree within the tolerance of the reference solvers.
+
+try:
+	import numba
+except ImportError:
+	numba = None
+
+BACKENDS = ['numpy', 'numba']
+
+backend = None
+
+def set_backend(name=None):
+	'''Set backend to name ("numpy" or "numba"), or to the default (numba if
+	installed, unless overriden by the environment variable RSTOOL_BACKEND)
+	if name is None.'''
+	global backend
+	if name is not None and name not in BACKENDS:
+		raise ValueError('%s: unknown backend' % name)
+	if name == 'numba' and numba is None:
+		raise ValueError('numba backend requested, but numba is not installed')
+	backend = name
+
+def get_backend():
+	'''Return the name of the backend in use.'''
+	if backend is not None:
+		return backend
+	name = os.environ.get('RSTOOL_BACKEND')
+	if name is not None:
+		set_backend(name)
+		return name
+	return 'numba' if numba is not None else 'numpy'
+
+def jit(func):
+	return numba.njit(cache=True)(func) if numba is not None else func
+
+@jit
+def bin_add_loop(i, x, total, count):
+	for j in range(len(i)):
+		if not np.isnan(x[j]):
+			total[i[j]] += x[j]
+			count[i[j]] += 1
+
+@jit
+def td_loop(e):
+	# Inverse of calc_esat.
+	out = np.empty(len(e), np.float64)
+	for j in range(len(e)):
+		if np.isfinite(e[j]) and e[j] > 0:
+			x = np.log(e[j]/611.2)
+			out[j] = n0 + 243.5*x/(17.67 - x)
+		else:
+			out[j] = np.nan
+	return out
+
+@jit
+def pc_log_wsat(x, ps, tas):
+	# Logarithm of the saturation humidity mixing ratio of a dry adiabatic
+	# parcel lifted from ps to exp(x).
+	p = np.exp(x)
+	ta = tas*(p/ps)**kappa
+	esat = 6.112*np.exp((17.67*(ta - n0))/(ta - n0 + 243.5))*1e2
+	return np.log(eps*esat/(p - esat))
+
+@jit
+def pc_loop(ps, ws, tas):
+	# Newton's method in log pressure, starting at 1e5 Pa as calc_pc.
+	out = np.empty(len(ps), np.float64)
+	for j in range(len(ps)):
+		out[j] = np.nan
+		if not (np.isfinite(ps[j]) and np.isfinite(ws[j]) and \
+			np.isfinite(tas[j]) and ws[j] > 0):
+			continue
+		x = np.log(1e5)
+		y = np.log(ws[j])
+		for _ in range(50):
+			h = 1e-6
+			f = pc_log_wsat(x, ps[j], tas[j]) - y
+			df = (pc_log_wsat(x + h, ps[j], tas[j]) -
+				pc_log_wsat(x - h, ps[j], tas[j]))/(2*h)
+			if not (np.isfinite(f) and np.isfinite(df)) or df == 0:
+				break
+			dx = f/df
+			x -= dx
+			if abs(dx) < 1e-12:
+				out[j] = np.exp(x)
+				break
+	return out
+
+@jit
+def turns_loop(p, h, j0, state):
+	# Hysteresis segmentation. state is the direction (0 unknown, -1
+	# decreasing, 1 increasing), the minimum and maximum pressure and their
+	# indices, carried over between calls.
+	out = np.empty(len(p), np.int64)
+	k = 0
+	for j in range(len(p)):
+		x = p[j]
+		if np.isnan(x):
+			continue
+		if np.isnan(state[1]) or x < state[1]:
+			state[1] = x
+			state[2] = j0 + j
+		if np.isnan(state[3]) or x > state[3]:
+			state[3] = x
+			state[4] = j0 + j
+		if state[0] <= 0 and x >= state[1] + h:
+			if state[0] < 0:
+				out[k] = state[2] + 1
+				k += 1
+			state[0] = 1
+			state[3] = x
+			state[4] = j0 + j
+		elif state[0] >= 0 and x <= state[3] - h:
+			if state[0] > 0:
+				out[k] = state[4] + 1
+				k += 1
+			state[0] = -1
+			state[1] = x
+			state[2] = j0 + j
+	return out[:k]
+
+# Initial number of points searched at a time for the end of a segment in
+# turns_numpy. The window is doubled until the end is found, so that the time
+# is proportional to the number of points for both short and long segments.
+TURNS_WINDOW = 256
+
+def running_extreme(x, x0, i0, sign):
+	# Running maximum (sign 1) or minimum (sign -1) of x starting from x0
+	# (NaN if none) at position i0, and the position of its first occurrence
+	# (-1 for i0).
+	y = sign*x
+	c = np.maximum.accumulate(np.concatenate([
+		[-np.inf if np.isnan(x0) else sign*x0],
+		y,
+	]))
+	new = y > c[:-1]
+	k = np.maximum.accumulate(np.where(new, np.arange(len(x)), -1))
+	return sign*c[1:], k
+
+def turns_numpy(p, h, j0, state):
+	# Vectorized hysteresis segmentation (see turns_loop). The points are
+	# searched in windows for the first point reversed by more than h from
+	# the running extreme since the start of the current segment.
+	idx = np.nonzero(~np.isnan(p))[0]
+	x = p[idx]
+	idx = idx + j0
+	out = []
+	i = 0
+	n = len(x)
+	w = TURNS_WINDOW
+	while i < n:
+		y = x[i:(i + w)]
+		m = len(y)
+		lo, klo = running_extreme(y, state[1], state[2], -1)
+		hi, khi = running_extreme(y, state[3], state[4], 1)
+		up = (y >= lo + h) if state[0] <= 0 else np.zeros(m, bool)
+		down = (y <= hi - h) if state[0] >= 0 else np.zeros(m, bool)
+		found = np.nonzero(up | down)[0]
+		k = found[0] if len(found) > 0 else m - 1
+		# Running extremes up to point k.
+		state[1] = lo[k]
+		state[2] = idx[i + klo[k]] if klo[k] >= 0 else state[2]
+		state[3] = hi[k]
+		state[4] = idx[i + khi[k]] if khi[k] >= 0 else state[4]
+		if len(found) == 0:
+			i += m
+			w *= 2
+			continue
+		if up[k]:
+			if state[0] < 0:
+				out += [state[2] + 1]
+			state[0] = 1
+			state[3] = y[k]
+			state[4] = idx[i + k]
+		else:
+			if state[0] > 0:
+				out += [state[4] + 1]
+			state[0] = -1
+			state[1] = y[k]
+			state[2] = idx[i + k]
+		i += k + 1
+		w = TURNS_WINDOW
+	return np.array(out, np.int64)
+
+def turns(p, h, j0, state):
+	'''Find turning points of pressure p (float64) starting at index j0,
+	where it changes between decreasing and increasing by more than h. state
+	is an array of the length 5 carrying the state between calls on
+	consecutive parts of a series, initially [0, nan, 0, nan, 0]. Returns an
+	array of the indices at which new segments start.'''
+	p = np.asarray(p, np.float64)
+	if get_backend() == 'numba':
+		return turns_loop(p, h, j0, state)
+	return turns_numpy(p, h, j0, state)
+
+def bin_add(i, x, total, count):
+	'''Add x (float64) to the sums total (float64) and counts count (int64) of
+	bins with bin index i, ignoring NaN values.'''
+	if get_backend() == 'numba':
+		bin_add_loop(i, x, total, count)
+		return
+	valid = ~np.isnan(x)
+	total += np.bincount(i[valid], weights=x[valid], minlength=len(total))
+	count += np.bincount(i[valid], minlength=len(count))
+
+def bin_mean(i, x, n):
+	'''Calculate the mean of x (float64) in n bins with bin index i, ignoring
+	NaN values. Empty bins are NaN.'''
+	total = np.zeros(n, np.float64)
+	count = np.zeros(n, np.int64)
+	bin_add(i, x, total, count)
+	out = np.full(n, np.nan, np.float64)
+	out[count > 0] = total[count > 0]/count[count > 0]
+	return out
+
+def td(e):
+	'''Calculate dew point temperature from water vapor pressure e with the
+	numba backend.'''
+	e = np.asarray(e, np.float64)
+	return td_loop(e.ravel()).reshape(e.shape)
+
+def pc(ps, ws, tas):
+	'''Calculate condensation pressure from surface air pressure ps,
+	near-surface humidity mixing ratio ws and near-surface air temperature
+	tas with the numba backend.'''
+	ps, ws, tas = np.broadcast_arrays(*[
+		np.asarray(x, np.float64) for x in [ps, ws, tas]
+	])
+	return pc_loop(ps.ravel(), ws.ravel(), tas.ravel()).reshape(ps.shape)
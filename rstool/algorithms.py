@@ -1,7 +1,32 @@
+import functools
 import numpy as np
 from scipy.optimize import fmin
 
 from rstool.const import *
+from rstool import accel
+
+def interp(x, xp, fp):
+	# The same as np.interp, but xp and fp can have leading dimensions, in
+	# which case x is interpolated along the last dimension for every
+	# profile. x is broadcast to the leading dimensions of xp and fp with a
+	# last dimension of length 1 if it has fewer than two dimensions.
+	if np.ndim(xp) == 1 and np.ndim(fp) == 1:
+		return np.interp(x, xp, fp)
+	xp, fp = np.broadcast_arrays(xp, fp)
+	x = np.asarray(x, np.float64)
+	if x.ndim < 2:
+		x = x.reshape((1,)*(xp.ndim - 1) + (-1,))
+	x = np.broadcast_to(x, xp.shape[:-1] + x.shape[-1:])
+	n = xp.shape[-1]
+	i = np.sum(xp[...,np.newaxis,:] <= x[...,np.newaxis], axis=-1)
+	i = np.clip(i, 1, n - 1)
+	x0 = np.take_along_axis(xp, i - 1, -1)
+	x1 = np.take_along_axis(xp, i, -1)
+	f0 = np.take_along_axis(fp, i - 1, -1)
+	f1 = np.take_along_axis(fp, i, -1)
+	out = f0 + (x - x0)/(x1 - x0)*(f1 - f0)
+	out = np.where(x <= xp[...,:1], fp[...,:1], out)
+	return np.where(x >= xp[...,-1:], fp[...,-1:], out)
 
 def calc_bvf(*, thetav, zg, p, g, res=400):
 	r'''
@@ -13,14 +38,15 @@ def calc_bvf(*, thetav, zg, p, g, res=400):
 	geopotential height (m). Returns a tuple of *p_bvf* (Pa), *zg_bvf* (m)
 	and *bvf* (Hz), where *p_bvf* are new air pressure coordinates, *zg_bvf* is
 	geopotential height at *p_bvf*, and *bvf* is the Brunt-Väisälä frequency
-	at *p_bvf*.
+	at *p_bvf*. For multiple profiles (arrays with leading dimensions),
+	*zg_bvf* covers the range of all profiles.
 	'''
 	zg_half = np.arange(np.nanmin(zg), np.nanmax(zg) + res, res)
 	zg_full = (zg_half[1:] + zg_half[:-1])*0.5
-	thetav_half = np.interp(zg_half, zg, thetav)
-	thetav_full = (thetav_half[1:] + thetav_half[:-1])*0.5
-	phalf = np.interp(zg_half, zg, p)
-	pfull = (phalf[1:] + phalf[:-1])*0.5
+	thetav_half = interp(zg_half, zg, thetav)
+	thetav_full = (thetav_half[...,1:] + thetav_half[...,:-1])*0.5
+	phalf = interp(zg_half, zg, p)
+	pfull = (phalf[...,1:] + phalf[...,:-1])*0.5
 	bvf2 = g*np.diff(thetav_half)/np.diff(zg_half)/thetav_full
 	bvf = np.sqrt(np.abs(bvf2))*np.sign(bvf2)
 	return pfull, zg_full, bvf
@@ -101,7 +127,7 @@ def calc_lts(*, p, theta, thetas):
 	potential temperature *theta* (K) and near-surface air potential
 	temperature *thetas* (K).
 	'''
-	theta700 = np.interp(700e2, p[::-1], theta[::-1])
+	theta700 = interp(700e2, p[...,::-1], theta[...,::-1])
 	return theta700 - thetas
 
 def calc_rho(*, rhod, rhow):
@@ -132,15 +158,179 @@ def calc_rhow(*, p, e, ta):
 	'''
 	return e/rw/ta
 
-def calc_tapar(*, p, ps, tas):
+# Pseudo-adiabats are tabulated by wet-bulb potential temperature (K) at
+# standard pressure (p0) on a grid uniform in the logarithm of air pressure.
+# The table is calculated once when first needed.
+PSEUDOADIABAT_THETAW = (200., 340., 0.2) # Start, end and step (K).
+PSEUDOADIABAT_LNP = (np.log(1.1e5), np.log(1e2), 0.01) # Start, end and step.
+
+def pseudoadiabat_rate(p, ta):
+	# Rate of change of air temperature (K) with the logarithm of air pressure
+	# along a pseudo-adiabat, consistent with calc_gammam.
+	wsat = calc_wsat(p=p, ta=ta)
+	return rd*ta/cp*(1 + lv*wsat/(rd*ta))/(1 + lv**2*wsat*eps/(rd*cp*ta**2))
+
+@functools.lru_cache()
+def pseudoadiabats():
+	'''Return a table of pseudo-adiabats as a tuple of wet-bulb potential
+	temperature (K), logarithm of air pressure and air temperature (K)
+	(wet-bulb potential temperature, air pressure). The pseudo-adiabats are
+	integrated with the Runge-Kutta method from standard pressure.'''
+	thetaw = np.arange(*PSEUDOADIABAT_THETAW)
+	lnp0, lnp1, step = PSEUDOADIABAT_LNP
+	k0 = int(round((lnp0 - np.log(p0))/step))
+	k1 = int(round((lnp0 - lnp1)/step))
+	lnp = np.log(p0) + (k0 - np.arange(k1 + 1))*step
+	ta = np.full((len(thetaw), len(lnp)), np.nan, np.float64)
+	ta[:,k0] = thetaw
+	for ks in [range(k0, k1), range(k0, 0, -1)]:
+		for k in ks:
+			k2 = k + 1 if ks.step > 0 else k - 1
+			h = lnp[k2] - lnp[k]
+			x = ta[:,k]
+			f = lambda lnp1, x1: pseudoadiabat_rate(np.exp(lnp1), x1)
+			a = f(lnp[k], x)
+			b = f(lnp[k] + h/2, x + h/2*a)
+			c = f(lnp[k] + h/2, x + h/2*b)
+			d = f(lnp[k2], x + h*c)
+			ta[:,k2] = x + h/6*(a + 2*b + 2*c + d)
+	return thetaw, lnp, ta
+
+def pseudoadiabat(p, thetaw):
+	# Air temperature (K) on pseudo-adiabats thetaw (K) at air pressure p (Pa)
+	# by bilinear interpolation in the table of pseudo-adiabats. Missing
+	# outside of the table.
+	thetaw_, lnp, ta = pseudoadiabats()
+	p, thetaw = np.broadcast_arrays(np.asarray(p, np.float64),
+		np.asarray(thetaw, np.float64))
+	fi = (thetaw - thetaw_[0])/(thetaw_[1] - thetaw_[0])
+	fk = (lnp[0] - np.log(p))/(lnp[0] - lnp[1])
+	valid = (fi >= 0) & (fi <= len(thetaw_) - 1) & \
+		(fk >= 0) & (fk <= len(lnp) - 1)
+	i = np.clip(np.floor(np.where(valid, fi, 0)).astype(int), 0,
+		len(thetaw_) - 2)
+	k = np.clip(np.floor(np.where(valid, fk, 0)).astype(int), 0, len(lnp) - 2)
+	wi = fi - i
+	wk = fk - k
+	out = (1 - wi)*(1 - wk)*ta[i,k] + wi*(1 - wk)*ta[i + 1,k] + \
+		(1 - wi)*wk*ta[i,k + 1] + wi*wk*ta[i + 1,k + 1]
+	return np.where(valid, out, np.nan)
+
+def calc_thetaw(*, p, ta):
+	r'''
+	**calc_thetaw**(\*, *p*, *ta*)
+
+	Calculate wet-bulb potential temperature (K) of saturated air at air
+	pressure *p* (Pa) and air temperature *ta* (K), i.e. the temperature of
+	the pseudo-adiabat through *p* and *ta* at standard pressure (1000 hPa).
+	Uses a cached table of pseudo-adiabats.
+	'''
+	thetaw_ = pseudoadiabats()[0]
+	p, ta = np.broadcast_arrays(np.asarray(p, np.float64),
+		np.asarray(ta, np.float64))
+	# Temperature increases with wet-bulb potential temperature at any
+	# pressure.
+	tat = pseudoadiabat(p[...,np.newaxis], thetaw_)
+	i = np.sum(tat < ta[...,np.newaxis], axis=-1)
+	i = np.clip(i, 1, len(thetaw_) - 1)
+	t0 = np.take_along_axis(tat, (i - 1)[...,np.newaxis], -1)[...,0]
+	t1 = np.take_along_axis(tat, i[...,np.newaxis], -1)[...,0]
+	out = thetaw_[i - 1] + (ta - t0)/(t1 - t0)*(thetaw_[1] - thetaw_[0])
+	return np.where((ta >= t0) & (ta <= t1), out, np.nan)
+
+def calc_tapar(*, p, ps, tas, pc=None):
 	r'''
-	**calc_tpar**(\*, *p*, *ps*, *tas*)
+	**calc_tapar**(\*, *p*, *ps*, *tas*, *pc*=None)
+
+	Calculate dry-moist adiabatic parcel temperature (K) at air pressure *p*
+	(Pa), assuming surface air pressure *ps* and near-surface air temperature
+	*tas* (K). The parcel follows a dry adiabat up to the condensation
+	pressure *pc* (Pa) and a pseudo-adiabat above (from a cached table). If
+	*pc* is None, only the dry adiabat is calculated.
+	'''
+	tapar = tas*(p/ps)**kappa
+	if pc is None:
+		return tapar
+	thetaw = calc_thetaw(p=pc, ta=tas*(pc/ps)**kappa)
+	return np.where(p >= pc, tapar, pseudoadiabat(p, thetaw))
+
+def calc_wpar(*, p, tapar, ws):
+	r'''
+	**calc_wpar**(\*, *p*, *tapar*, *ws*)
+
+	Calculate humidity mixing ratio (1) of a parcel lifted from the surface
+	at air pressure *p* (Pa) from parcel temperature *tapar* (K) and
+	near-surface humidity mixing ratio *ws* (1). The parcel is saturated
+	above the condensation level.
+	'''
+	return np.fmin(ws, calc_wsat(p=p, ta=tapar))
 
-	Calculate dry-moist adiabatic parcel temperature at air pressure *p* (Pa),
-	assuming surface air pressure *ps* and near-surface air temperature *tas*
-	(K).
+def calc_cape(*, p, tvpar, tv, ps, pc):
+	r'''
+	**calc_cape**(\*, *p*, *tvpar*, *tv*, *ps*, *pc*)
+
+	Calculate convective available potential energy (CAPE) and convective
+	inhibition (CIN) of a parcel lifted from the surface from air pressure
+	*p* (Pa), parcel virtual temperature *tvpar* (K), virtual temperature
+	*tv* (K), surface air pressure *ps* (Pa) and condensation pressure *pc*
+	(Pa). Returns a tuple of *cape* (J.kg<sup>-1</sup>), *cin*
+	(J.kg<sup>-1</sup>, negative), and air pressure of the level of free
+	convection *plfc* (Pa) and of the equilibrium level *pel* (Pa). The
+	buoyancy is integrated over the logarithm of air pressure between the
+	levels. *cape* is zero and *cin*, *plfc* and *pel* are missing if the
+	parcel is not positively buoyant above the condensation level. *pel* is
+	missing if the parcel is positively buoyant at the top of the profile.
+	All are missing if there are fewer than two valid levels. For multiple
+	profiles (arrays with leading dimensions), the results have a last
+	dimension of length 1.
 	'''
-	return tas*(p/ps)**kappa
+	if max(np.ndim(p), np.ndim(tvpar), np.ndim(tv)) > 1:
+		p, tvpar, tv = np.broadcast_arrays(p, tvpar, tv)
+		shape = p.shape[:-1]
+		ps, pc = [np.broadcast_to(x, shape + (1,))[...,0] for x in (ps, pc)]
+		out = np.array([
+			calc_cape(p=p[i], tvpar=tvpar[i], tv=tv[i], ps=ps[i], pc=pc[i])
+			for i in np.ndindex(shape)
+		], np.float64).reshape(shape + (4,))
+		return tuple(out[...,k:(k + 1)] for k in range(4))
+	b = tvpar - tv
+	valid = np.isfinite(p) & np.isfinite(b) & (p <= ps)
+	x = -np.log(p[valid])
+	b = b[valid]
+	order = np.argsort(x)
+	x = x[order]
+	b = b[order]
+	if len(x) < 2 or not np.isfinite(pc):
+		return np.nan, np.nan, np.nan, np.nan
+	# Insert points where the buoyancy changes sign and at the condensation
+	# level, so that the buoyancy is of the same sign between points.
+	cross = np.sign(b[:-1])*np.sign(b[1:]) < 0
+	xc = x[:-1][cross] - b[:-1][cross]*(x[1:][cross] - x[:-1][cross])/ \
+		(b[1:][cross] - b[:-1][cross])
+	xlcl = -np.log(pc)
+	blcl = np.interp(xlcl, x, b, left=np.nan, right=np.nan)
+	x = np.concatenate([x, xc] + ([[xlcl]] if np.isfinite(blcl) else []))
+	b = np.concatenate([b, np.zeros(len(xc))] +
+		([[blcl]] if np.isfinite(blcl) else []))
+	order = np.argsort(x, kind='stable')
+	x = x[order]
+	b = b[order]
+	pos = np.nonzero((b > 0) & (x >= xlcl))[0]
+	if len(pos) == 0:
+		return 0., np.nan, np.nan, np.nan
+	k = pos[0]
+	xlfc = max(xlcl, x[k - 1]) if k > 0 else x[k]
+	j = np.nonzero(b > 0)[0][-1]
+	xel = x[j + 1] if j + 1 < len(x) else np.nan
+	xmid = 0.5*(x[1:] + x[:-1])
+	dx = np.diff(x)
+	above = (xmid > xlfc) & ((xmid < xel) if np.isfinite(xel) else True)
+	below = xmid < xlfc
+	fpos = np.fmax(b, 0)
+	fneg = np.fmin(b, 0)
+	cape = rd*np.sum((0.5*(fpos[1:] + fpos[:-1])*dx)[above])
+	cin = rd*np.sum((0.5*(fneg[1:] + fneg[:-1])*dx)[below])
+	return cape, cin, np.exp(-xlfc), np.exp(-xel)
 
 def calc_tv(*, ta, w):
 	r'''
@@ -161,13 +351,100 @@ def calc_theta(*, p, ta, p0=1e5):
 	'''
 	return ta*(p0/p)**kappa
 
-@np.vectorize
-def calc_td(*, e):
+def calc_thermo(*, p, ta, w=None, hus=None, hur=None, e=None, td=None,
+	gammad=None, p0=1e5):
 	r'''
-	**calc_td**(\*, *e*)
-
-	Calculate dew point temperature (K) from water vapor pressure *e* (Pa).
+	**calc_thermo**(\*, *p*, *ta*, *w*=None, *hus*=None, *hur*=None, *e*=None, *td*=None, *gammad*=None, *p0*=1e5)
+
+	Calculate the moist thermodynamic variables *esat*, *wsat*, *w*, *e*,
+	*hur*, *hus*, *tv*, *theta*, *thetav*, *rhod*, *rhow*, *rho* and *gammam*
+	from air pressure *p* (Pa), air temperature *ta* (K) and one of humidity
+	mixing ratio *w* (1), specific humidity *hus* (1), relative humidity *hur*
+	(%), water vapor partial pressure *e* (Pa) or dew point temperature *td*
+	(K), in this order of preference. *gammam* is calculated only if dry
+	adiabatic air temperature lapse rate *gammad* (K.m<sup>-1</sup>) is
+	supplied, and the humidity-dependent variables only if a humidity
+	variable is supplied. The result is the same as of the individual
+	functions, but intermediate quantities are calculated only once and the
+	results are calculated in place in preallocated arrays. Returns a
+	dictionary of the calculated variables (the supplied variables are not
+	included).
 	'''
+	args = [x for x in [p, ta, w, hus, hur, e, td, gammad] if x is not None]
+	shape = np.broadcast_shapes(*[np.shape(x) for x in args])
+	dtype = np.result_type(*args, 1.)
+	new = lambda: np.empty(shape, dtype)
+	res = {}
+	tmp = new()
+
+	esat = res['esat'] = np.subtract(ta, n0, out=new())
+	np.add(esat, 243.5, out=tmp)
+	esat *= 17.67
+	esat /= tmp
+	np.exp(esat, out=esat)
+	esat *= 6.112
+	esat *= 1e2
+
+	wsat = res['wsat'] = np.multiply(esat, eps, out=new())
+	wsat /= np.subtract(p, esat, out=tmp)
+
+	theta = res['theta'] = np.divide(p0, p, out=new())
+	theta **= kappa
+	theta *= ta
+
+	if gammad is not None:
+		# gammad*(1 + lv*wsat/(rd*ta))/(1 + lv**2*wsat*eps/(rd*cp*ta**2))
+		gammam = res['gammam'] = np.multiply(wsat, lv, out=new())
+		gammam /= np.multiply(ta, rd, out=tmp)
+		gammam += 1
+		gammam *= gammad
+		x = np.multiply(wsat, lv**2, out=new())
+		x *= eps
+		x /= np.multiply(np.square(ta, out=tmp), rd*cp, out=tmp)
+		x += 1
+		gammam /= x
+
+	if w is None:
+		if hus is not None:
+			w = res['w'] = np.subtract(1, hus, out=new())
+			np.divide(hus, w, out=w)
+		elif hur is not None:
+			w = res['w'] = np.divide(hur, 100, out=new())
+			w *= wsat
+		elif e is not None or td is not None:
+			if e is None:
+				e = res['e'] = calc_esat(ta=td)
+			w = res['w'] = np.multiply(e, eps, out=new())
+			w /= np.subtract(p, e, out=tmp)
+		else:
+			return res
+
+	# Factors of the virtual temperature shared by tv, thetav and hus.
+	a = np.divide(w, eps, out=new())
+	a += 1
+	b = np.add(w, 1, out=new())
+	tv = res['tv'] = np.multiply(ta, a, out=new())
+	tv /= b
+	thetav = res['thetav'] = np.multiply(theta, a, out=a)
+	thetav /= b
+	if hus is None:
+		res['hus'] = np.divide(w, b, out=b)
+	if hur is None:
+		hur = res['hur'] = np.multiply(w, 100, out=new())
+		hur /= wsat
+	if e is None:
+		e = res['e'] = np.multiply(w, p, out=new())
+		e /= np.add(w, eps, out=tmp)
+	rhod = res['rhod'] = np.subtract(p, e, out=new())
+	rhod /= rd
+	rhod /= ta
+	rhow = res['rhow'] = np.divide(e, rw, out=new())
+	rhow /= ta
+	res['rho'] = np.add(rhod, rhow, out=tmp)
+	return res
+
+@np.vectorize
+def calc_td_fmin(e):
 	def f(ta):
 		esat = calc_esat(ta=ta)
 		return np.abs(esat - e)
@@ -177,14 +454,7 @@ def calc_td(*, e):
 		return np.nan
 
 @np.vectorize
-def calc_pc(*, ps, ws, tas):
-	r'''
-	**calc_pc**(\*, *ps*, *ws*, *tas*)
-
-	Calculate condensation pressure (Pa) from surface air pressure *ps* (Pa),
-	near-surface humidity mixing ratio *ws* (Pa) and near-surface air
-	temperature *tas* (K).
-	'''
+def calc_pc_fmin(ps, ws, tas):
 	def f(p):
 		ta = tas*(p/ps)**kappa
 		wsat = calc_wsat(p=p, ta=ta)
@@ -194,6 +464,28 @@ def calc_pc(*, ps, ws, tas):
 	else:
 		return np.nan
 
+def calc_td(*, e):
+	r'''
+	**calc_td**(\*, *e*)
+
+	Calculate dew point temperature (K) from water vapor pressure *e* (Pa).
+	'''
+	if accel.get_backend() == 'numba':
+		return accel.td(e)
+	return calc_td_fmin(e)
+
+def calc_pc(*, ps, ws, tas):
+	r'''
+	**calc_pc**(\*, *ps*, *ws*, *tas*)
+
+	Calculate condensation pressure (Pa) from surface air pressure *ps* (Pa),
+	near-surface humidity mixing ratio *ws* (Pa) and near-surface air
+	temperature *tas* (K).
+	'''
+	if accel.get_backend() == 'numba':
+		return accel.pc(ps, ws, tas)
+	return calc_pc_fmin(ps, ws, tas)
+
 def calc_ua(*, wds, wdd):
 	r'''
 	**calc_ua**(\*, *wds*, *wdd*)
@@ -284,7 +576,7 @@ def calc_z(*,
 	if zg is not None and g is not None:
 		return zg/g*gsl
 	elif p1 is not None and p is not None and z is not None:
-		return np.interp(p1, p[::-1], z[::-1])
+		return interp(p1, p[...,::-1], z[...,::-1])
 	else:
 		raise TypeError('invalid arguments')
 
@@ -306,6 +598,6 @@ def calc_zg(*,
 	if z is not None and g is not None:
 		return z*g/gsl
 	elif p1 is not None and p is not None and zg is not None:
-		return np.interp(p1, p[::-1], zg[::-1])
+		return interp(p1, p[...,::-1], zg[...,::-1])
 	else:
 		raise TypeError('invalid arguments')
@@ -0,0 +1,128 @@
+import os
+import io
+import gzip
+import bz2
+import lzma
+import tarfile
+import zipfile
+from fnmatch import fnmatch
+
+# Reading of compressed files and files in archives as streams, without
+# extracting them to disk.
+
+MAGIC = [
+	(b'\x1f\x8b', gzip.GzipFile),
+	(b'BZh', bz2.BZ2File),
+	(b'\xfd7zXZ\x00', lzma.LZMAFile),
+]
+
+EXT = ['.gz', '.bz2', '.xz']
+
+def strip_ext(name):
+	'''Remove compression extension from file name name.'''
+	root, ext = os.path.splitext(name)
+	return root if ext in EXT else name
+
+def compression(f):
+	# Class of the decompressed file object of buffered binary file object
+	# f (see MAGIC), or None if f is not compressed.
+	magic = f.peek(6)
+	for m, cls in MAGIC:
+		if magic.startswith(m):
+			return cls
+	return None
+
+def decompress(f):
+	'''Return a binary file object reading the decompressed content of
+	binary file object f if it is compressed with gzip, bzip2 or xz, or f
+	otherwise.'''
+	if not hasattr(f, 'peek'):
+		f = io.BufferedReader(f)
+	cls = compression(f)
+	if cls is None:
+		return f
+	return cls(fileobj=f) if cls is gzip.GzipFile else cls(f)
+
+def open_file(filename):
+	'''Open filename (str, binary file object or bytes) for reading as a
+	binary stream, decompressing it if compressed. If filename is a file
+	name, the file is closed when the stream is closed.'''
+	if isinstance(filename, (bytes, bytearray)):
+		return decompress(io.BytesIO(filename))
+	if hasattr(filename, 'read'):
+		return decompress(filename)
+	f = open(filename, 'rb')
+	try:
+		cls = compression(f)
+	except BaseException:
+		f.close()
+		raise
+	if cls is None:
+		return f
+	# The decompressed file object opened by name owns the file.
+	f.close()
+	return cls(filename)
+
+def is_archive(path):
+	'''Return True if path (str) is a zip or tar archive.'''
+	return isinstance(path, (str, os.PathLike)) and os.path.isfile(path) and (
+		zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+	)
+
+def iter_zip(path, match):
+	with zipfile.ZipFile(path) as z:
+		for info in z.infolist():
+			if not info.is_dir() and match(info.filename):
+				with z.open(info) as f:
+					yield info.filename, decompress(f)
+
+def iter_tar(path, match):
+	if hasattr(path, 'read'):
+		t = tarfile.open(fileobj=path, mode='r|*')
+	else:
+		t = tarfile.open(path, mode='r|*')
+	with t:
+		for info in t:
+			if info.isfile() and match(info.name):
+				yield info.name, decompress(t.extractfile(info))
+
+def iter_files(path, pattern='*'):
+	'''Iterate over files in a directory, zip archive or tar archive path,
+	whose base name without compression extension matches pattern. path can
+	also be a binary file object or bytes containing a zip or tar archive. Tar
+	archives are read sequentially as a stream. Yields pairs of file name and
+	binary file object (decompressed if compressed). The file object is only
+	valid until the next iteration.'''
+	match = lambda name: fnmatch(strip_ext(os.path.basename(name)), pattern)
+	if isinstance(path, (bytes, bytearray)):
+		path = io.BytesIO(path)
+	if hasattr(path, 'read'):
+		is_zip = False
+		if path.seekable():
+			path.seek(0)
+			is_zip = zipfile.is_zipfile(path)
+			path.seek(0)
+		if is_zip:
+			yield from iter_zip(path, match)
+		else:
+			yield from iter_tar(path, match)
+	elif os.path.isdir(path):
+		for name in sorted(os.listdir(path)):
+			filename = os.path.join(path, name)
+			if os.path.isfile(filename) and match(name):
+				with open_file(filename) as f:
+					yield filename, f
+	elif zipfile.is_zipfile(path):
+		yield from iter_zip(path, match)
+	elif tarfile.is_tarfile(path):
+		yield from iter_tar(path, match)
+	else:
+		raise ValueError('%s: not a directory or an archive' % path)
+
+def find(path, pattern):
+	'''Return the content (bytes) of the first file in a directory, zip
+	archive or tar archive path matching pattern (see iter_files), or None if
+	there is no such file.'''
+	for _, f in iter_files(path, pattern):
+		return f.read()
+	return None
@@ -0,0 +1,292 @@
+import os
+import sys
+import json
+import time
+import queue
+import hashlib
+import threading
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+import rstool
+from rstool import accel, archive, campaign, precision
+from rstool.ensemble import ensemble_size
+from rstool.main import get_driver, read_input, process, write
+from rstool.prof import grid_spec
+from rstool.server import init_worker
+from rstool.watch import output_path, write_atomic
+
+# Batch mode. All inputs in an input directory are converted to an output
+# directory. Completed conversions are recorded in a journal in the output
+# directory (JOURNAL_FILENAME), one JSON object per line. A conversion is
+# skipped if the journal contains an entry for the input with the same key and
+# all its outputs exist. The key is a hash of the input content, the rstool
+# version and the conversion options, so that an interrupted run can be
+# resumed, and a modified input, a different option or a new version of rstool
+# causes the affected inputs to be converted again.
+#
+# The conversions run in a pipeline of three stages connected by bounded
+# queues: reading (a thread, which also hashes the inputs), calculation (on a
+# pool of worker processes) and writing (a thread). Reading and parsing of the
+# next input, calculation of the current one and writing of the previous one
+# thus overlap, and the throughput is limited by the slowest stage rather than
+# the sum of all three.
+
+JOURNAL_FILENAME = '.rstool-journal.jsonl'
+
+def list_inputs(input_type, dirname):
+	'''List inputs of input type input_type in directory dirname.'''
+	out = []
+	for name in sorted(os.listdir(dirname)):
+		if name.startswith('.'):
+			continue
+		path = os.path.join(dirname, name)
+		name = archive.strip_ext(name)
+		if input_type in ('ws', 'ws:split'):
+			if os.path.isfile(path) and fnmatch(name, '*.sounding') or \
+				archive.is_archive(path):
+				out += [path]
+		elif input_type == 'imet':
+			if os.path.isdir(path) or archive.is_archive(path):
+				out += [path]
+		elif input_type == 'pts:npy':
+			if os.path.isfile(os.path.join(path, 'header.json')):
+				out += [path]
+		elif os.path.isfile(path) and fnmatch(name, '*.nc'):
+			out += [path]
+	return out
+
+def signature(path):
+	'''Return signature of file or directory path, which changes when it is
+	modified.'''
+	if os.path.isdir(path):
+		return [
+			[name] + signature(os.path.join(path, name))
+			for name in sorted(os.listdir(path))
+		]
+	st = os.stat(path)
+	return [st.st_size, st.st_mtime_ns]
+
+def hash_input(path, h=None):
+	'''Calculate SHA-256 hash of the content of file or directory path.'''
+	h = h if h is not None else hashlib.sha256()
+	if os.path.isdir(path):
+		for name in sorted(os.listdir(path)):
+			h.update(name.encode('utf-8') + b'\0')
+			hash_input(os.path.join(path, name), h)
+	else:
+		with open(path, 'rb') as f:
+			for chunk in iter(lambda: f.read(1 << 20), b''):
+				h.update(chunk)
+	return h.hexdigest()
+
+def read_journal(filename):
+	'''Read journal filename. Returns a list of journal entries.'''
+	entries = []
+	try:
+		with open(filename) as f:
+			for line in f:
+				try:
+					entries += [json.loads(line)]
+				except ValueError:
+					continue # Incomplete line of an interrupted run.
+	except FileNotFoundError:
+		pass
+	return entries
+
+def read_stage(input_type, path):
+	'''Read input path of input type input_type. Returns a dictionary of
+	sonde labels (None if the input type is not INSTRUMENT:split) and tuples
+	of the im, pts and prof datasets.'''
+	if input_type.endswith(':split'):
+		drv = get_driver(input_type[:input_type.index(':')])
+		return {
+			label: (d_im, None, None)
+			for label, d_im in drv.read(path, split_sondes=True).items()
+		}
+	drv, d_im, d_pts, d_prof = read_input(input_type, path)
+	return {None: (d_im, d_pts, d_prof)}
+
+def compute_stage(input_type, output_type, data, surf=None):
+	'''Calculate outputs of output type output_type from data returned by
+	read_stage. Returns a dictionary of sonde labels and output datasets.'''
+	name = input_type.split(':')[-1] if input_type.startswith('im:') else \
+		input_type.split(':')[0]
+	drv = get_driver(name) if name not in ('pts', 'prof') else None
+	return {
+		label: process(output_type, drv, d_im=d_im, d_pts=d_pts,
+			d_prof=d_prof, surf=surf, jobs=1)
+		for label, (d_im, d_pts, d_prof) in data.items()
+	}
+
+def write_stage(output_type, output, res, campaign_filename=None):
+	'''Write output datasets res returned by compute_stage to output, and
+	append them to campaign file campaign_filename if not None. Returns a
+	list of outputs.'''
+	def func(filename):
+		root, ext = os.path.splitext(filename)
+		for label, d in res.items():
+			write(output_type,
+				filename if label is None else root + '_' + label + ext, d)
+	outputs = write_atomic(output, func)
+	if campaign_filename is not None:
+		for d in res.values():
+			campaign.append(campaign_filename, d)
+	return outputs
+
+def batch(input_type, output_type, input_dir, output_dir, surf=None,
+	jobs=None, queue_size=None, campaign_filename=None):
+	'''Convert all inputs of input type input_type in input_dir to output type
+	output_type in output_dir on jobs worker processes (default: number of
+	CPUs), skipping inputs already converted according to the journal. surf is
+	an optional surface file. queue_size is the maximum number of inputs
+	waiting between the pipeline stages (default: jobs). If
+	campaign_filename is not None, the profiles converted are appended to the
+	campaign file campaign_filename (see rstool.campaign) in the writing
+	stage.'''
+	jobs = jobs if jobs is not None else os.cpu_count()
+	queue_size = queue_size if queue_size is not None else jobs
+	os.makedirs(output_dir, exist_ok=True)
+	journal_filename = os.path.join(output_dir, JOURNAL_FILENAME)
+	entries = read_journal(journal_filename)
+	journal = {(x['input'], x['key']): x for x in entries}
+	hashes = {x['input']: (x['signature'], x['hash']) for x in entries}
+	# Options set by environment variables: the vertical grid, the number of
+	# ensemble members, the floating-point type and the backend.
+	coord, levels, method = grid_spec(None, 5e2)
+	options = [
+		rstool.__version__,
+		input_type,
+		output_type,
+		[coord, np.asarray(levels).tolist(), method],
+		ensemble_size(None),
+		precision.get_dtype(),
+		accel.get_backend(),
+	]
+	if surf is not None:
+		options += [hash_input(surf)]
+
+	def key(path):
+		# Reuse the hash from the journal if the input has not been modified
+		# according to its signature.
+		sig = signature(path)
+		if path in hashes and hashes[path][0] == sig:
+			h = hashes[path][1]
+		else:
+			h = hash_input(path)
+		k = hashlib.sha256(json.dumps(options + [h]).encode('utf-8'))
+		return sig, h, k.hexdigest()
+
+	def event(res):
+		sys.stdout.write(json.dumps(res) + '\n')
+		sys.stdout.flush()
+
+	# Items passed between the stages are dictionaries with the keys "input",
+	# "signature", "hash", "key", "times" (stage times), "data" (the result of
+	# the previous stage) and "error" (if a stage failed, in which case the
+	# following stages pass the item through). None marks the end of input.
+	read_queue = queue.Queue(queue_size)
+	write_queue = queue.Queue(queue_size)
+	done_queue = queue.Queue()
+
+	def run(item, name, func, *args):
+		if 'error' in item:
+			return
+		start = time.time()
+		try:
+			item['data'] = func(*args)
+		except Exception as e:
+			item['error'] = str(e)
+			item.pop('data', None)
+		item['times'][name] = time.time() - start
+
+	def reader(paths):
+		try:
+			for path in paths:
+				item = {'input': path, 'times': {}}
+				try:
+					item['signature'], item['hash'], item['key'] = key(path)
+				except Exception as e:
+					item['error'] = str(e)
+				entry = journal.get((path, item.get('key')))
+				if entry is not None and \
+					all([os.path.exists(x) for x in entry['outputs']]):
+					done_queue.put(dict(item, status='skipped'))
+					continue
+				run(item, 'read', read_stage, input_type, path)
+				read_queue.put(item)
+		finally:
+			for _ in range(jobs):
+				read_queue.put(None)
+
+	def computer():
+		while True:
+			item = read_queue.get()
+			if item is None:
+				write_queue.put(None)
+				return
+			run(item, 'compute', lambda: executor.submit(compute_stage,
+				input_type, output_type, item.pop('data'), surf).result())
+			write_queue.put(item)
+
+	def writer():
+		n = 0
+		while n < jobs:
+			item = write_queue.get()
+			if item is None:
+				n += 1
+				continue
+			output = output_path(item['input'], output_type, output_dir)
+			run(item, 'write', write_stage, output_type, output,
+				item.get('data'), campaign_filename)
+			done_queue.put(item)
+		done_queue.put(None)
+
+	paths = list_inputs(input_type, input_dir)
+	counts = {'ok': 0, 'failed': 0, 'skipped': 0}
+	with open(journal_filename, 'a') as journal_file, \
+		ProcessPoolExecutor(jobs, initializer=init_worker) as executor:
+		threads = [threading.Thread(target=reader, args=(paths,), daemon=True)] + \
+			[threading.Thread(target=computer, daemon=True)
+				for _ in range(jobs)] + \
+			[threading.Thread(target=writer, daemon=True)]
+		for thread in threads:
+			thread.start()
+		while True:
+			item = done_queue.get()
+			if item is None:
+				break
+			path = item['input']
+			if item.get('status') == 'skipped':
+				counts['skipped'] += 1
+				continue
+			if 'error' in item:
+				counts['failed'] += 1
+				event({'input': path, 'status': 'error',
+					'error': item['error']})
+				continue
+			outputs = item['data']
+			entry = {
+				'input': path,
+				'outputs': outputs,
+				'signature': item['signature'],
+				'hash': item['hash'],
+				'key': item['key'],
+			}
+			journal_file.write(json.dumps(entry) + '\n')
+			journal_file.flush()
+			os.fsync(journal_file.fileno())
+			counts['ok'] += 1
+			event({
+				'input': path,
+				'outputs': outputs,
+				'status': 'ok',
+				'time': sum(item['times'].values()),
+				'read_time': item['times']['read'],
+				'compute_time': item['times']['compute'],
+				'write_time': item['times']['write'],
+			})
+		for thread in threads:
+			thread.join()
+	event(dict(counts, status='done'))
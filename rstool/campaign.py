@@ -0,0 +1,195 @@
+import os
+import numpy as np
+import netCDF4
+
+from rstool.headers import HEADER_PROF
+from rstool.columns import column_dim
+
+# Campaign datasets. Profiles (prof) are stacked along a profile dimension
+# ("profile") on a common pressure grid and stored in a single NetCDF file with
+# an unlimited profile dimension, so that new profiles can be appended without
+# reading the profiles already stored. The launch time of every profile is
+# stored in the variable "profile_time". A campaign dataset can be
+# interpolated on a regular time axis (a time-pressure curtain).
+
+# Highest pressure (Pa) and the default resolution (Pa) of the common pressure
+# grid. The grid levels are the same as the levels of prof with the same
+# resolution.
+PMAX = 1.1e5
+PRES = 5e2
+
+# Variables which are not stored in campaign datasets. The time of every level
+# is replaced with the launch time in "profile_time".
+EXCLUDE = ['p', 'time']
+
+def grid(pres=PRES):
+	'''Return the common pressure grid (Pa) with resolution pres (Pa), ordered
+	from the highest pressure.'''
+	return PMAX - (np.arange(int(round(PMAX/pres))) + 0.5)*pres
+
+def regrid(p, x, pgrid):
+	'''Regrid x on pressure levels p to the pressure grid pgrid. Values on p
+	matching levels of pgrid are copied. Otherwise, x is interpolated
+	linearly in pressure.'''
+	out = np.full(len(pgrid), np.nan, np.float64)
+	pres = pgrid[0] - pgrid[1] if len(pgrid) > 1 else PRES
+	k = (pgrid[0] - p)/pres
+	i = np.round(k).astype(int) if np.all(np.isfinite(k)) else None
+	if i is not None and np.allclose(k, i, rtol=0, atol=1e-6):
+		mask = (i >= 0) & (i < len(pgrid))
+		out[i[mask]] = x[mask]
+		return out
+	valid = np.isfinite(p)
+	p, x = p[valid], x[valid]
+	if len(p) == 0:
+		return out
+	order = np.argsort(p)
+	return np.interp(pgrid, p[order], x[order], left=np.nan, right=np.nan)
+
+def profiles(d):
+	'''Split profile dataset d into profiles. d can be a single-column or
+	multi-column (such as prof:segments or a campaign) dataset. Returns a
+	list of tuples of launch time and dictionaries of variables on the "p"
+	dimension or without a dimension. The launch time is profile_time if
+	present, or the time of the first level with a valid time, or
+	station_time if there is none.'''
+	meta = d['.']
+	dim = column_dim(meta)
+	data = {
+		var: np.ma.filled(np.ma.asarray(x, np.float64), np.nan)
+		for var, x in d.items()
+		if var != '.' and np.asarray(x).dtype.kind in 'biuf'
+	}
+	n = 1 if dim is None else d['ta'].shape[meta['ta']['.dims'].index(dim)]
+	out = []
+	for i in range(n):
+		prof = {}
+		for var, x in data.items():
+			dims = meta.get(var, {}).get('.dims', [])
+			if dim is not None and dim in dims:
+				x = np.take(x, i, axis=dims.index(dim))
+				dims = [y for y in dims if y != dim]
+			if dims in ([], ['p']):
+				prof[var] = x
+		# The launch time is the time of the first level with a valid time,
+		# as station_time is common to all segments of a flight.
+		t = prof.get('profile_time', np.nan)
+		time = np.asarray(prof.get('time', []), np.float64).ravel()
+		valid = np.isfinite(time)
+		if not np.isfinite(t) and np.any(valid):
+			t = time[valid][0]
+		if not np.isfinite(t):
+			t = prof.get('station_time', np.nan)
+		out += [(t, prof)]
+	return out
+
+def attrs(meta):
+	return {k: v for k, v in meta.items() if not k.startswith('.')}
+
+def create(filename, prof, meta, pres=PRES):
+	'''Create campaign file filename with variables of profile prof (as
+	returned by profiles) with metadata meta.'''
+	pgrid = grid(pres)
+	with netCDF4.Dataset(filename, 'w') as f:
+		f.createDimension('profile', None)
+		f.createDimension('p', len(pgrid))
+		v = f.createVariable('p', 'f8', ('p',))
+		v.setncatts(attrs(HEADER_PROF['p']))
+		v[:] = pgrid
+		v = f.createVariable('profile_time', 'f8', ('profile',),
+			fill_value=np.nan)
+		v.setncatts(attrs(dict(HEADER_PROF['time'],
+			long_name='profile launch time')))
+		for var, x in sorted(prof.items()):
+			if var in EXCLUDE or var == 'profile_time':
+				continue
+			dims = ('profile',) if np.ndim(x) == 0 else ('profile', 'p')
+			v = f.createVariable(var, 'f8', dims, fill_value=np.nan)
+			v.setncatts(attrs(meta.get(var, HEADER_PROF.get(var, {}))))
+		f.setncatts(attrs(meta.get('.', {})))
+
+def append(filename, d, pres=PRES):
+	'''Append profile dataset d (dict) to campaign file filename. The file is
+	created if it does not exist, with the variables of d and a pressure grid
+	of resolution pres (Pa). Variables of d not in the file are ignored, and
+	variables missing in d are stored as missing values. Profiles with a
+	launch time already in the file are skipped, so that appending the same
+	dataset again (such as in a resumed batch run) does not duplicate them.
+	Returns the number of profiles appended.'''
+	profs = profiles(d)
+	if len(profs) == 0:
+		return 0
+	if not os.path.exists(filename):
+		create(filename, profs[0][1], d['.'], pres)
+	with netCDF4.Dataset(filename, 'a') as f:
+		pgrid = f['p'][:]
+		i = len(f.dimensions['profile'])
+		existing = np.ma.filled(f['profile_time'][:], np.nan)
+		profs = [(t, prof) for t, prof in profs if not np.any(existing == t)]
+		for t, prof in profs:
+			f['profile_time'][i] = t
+			for var, v in f.variables.items():
+				if var in ('p', 'profile_time'):
+					continue
+				if var not in prof:
+					continue
+				x = prof[var]
+				if v.dimensions == ('profile',) and np.ndim(x) == 0:
+					v[i] = x
+				elif v.dimensions == ('profile', 'p') and np.ndim(x) == 1:
+					v[i,:] = regrid(np.asarray(prof['p'], np.float64), x,
+						pgrid)
+			i += 1
+	return len(profs)
+
+def curtain(d, step=3600., max_gap=86400.):
+	'''Interpolate campaign dataset d (dict) linearly on a regular time axis
+	with time step step (s), starting at the first profile. Values between
+	profiles more than max_gap (s) apart are missing. Returns a dataset
+	(dict) with the variables on the dimensions "time" and "p".'''
+	t = np.ma.filled(np.ma.asarray(d['profile_time'], np.float64), np.nan)
+	order = np.argsort(t)
+	order = order[np.isfinite(t[order])]
+	t = t[order]
+	n = len(t)
+	step = step/86400.
+	max_gap = max_gap/86400.
+	if n == 0:
+		tt = np.zeros(0, np.float64)
+	else:
+		tt = t[0] + np.arange(int(np.floor((t[-1] - t[0])/step)) + 1)*step
+	j = np.clip(np.searchsorted(t, tt, side='right'), 1, max(n - 1, 1))
+	if n > 1:
+		dt = t[j] - t[j - 1]
+		w = np.where(dt > 0, (tt - t[j - 1])/np.where(dt > 0, dt, 1), 0.)
+		# Times of the profiles are not affected by gaps.
+		gap = (dt > max_gap) & (w > 0) & (w < 1)
+	else:
+		j = np.zeros(len(tt), int)
+		w = np.ones(len(tt))
+		gap = np.zeros(len(tt), bool)
+	out = {'.': {}}
+	for var, x in d.items():
+		if var in ['.', 'p', 'profile_time']:
+			continue
+		dims = d['.'].get(var, {}).get('.dims', [])
+		if len(dims) == 0 or dims[0] != 'profile' or var in EXCLUDE:
+			continue
+		x = np.ma.filled(np.ma.asarray(x, np.float64), np.nan)[order]
+		if n > 1:
+			x0 = x[j - 1]
+			x1 = x[j]
+			ww = w.reshape((-1,) + (1,)*(x.ndim - 1))
+			y = np.where(ww == 0, x0,
+				np.where(ww == 1, x1, x0*(1 - ww) + x1*ww))
+			y[gap] = np.nan
+		else:
+			y = x[j]
+		out[var] = y
+		out['.'][var] = dict(d['.'][var], **{'.dims': ['time'] + dims[1:]})
+	out['time'] = tt
+	out['.']['time'] = dict(HEADER_PROF['time'], **{'.dims': ['time']})
+	out['p'] = d['p']
+	out['.']['p'] = d['.']['p']
+	out['.']['.'] = d['.'].get('.', {})
+	return out
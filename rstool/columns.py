@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from rstool.headers import HEADER_PROF, dataset_header
+from rstool.precision import var_dtype
+from rstool.postprocess import postprocess as postprocess_profile
+
+# Postprocessing of multi-column profile (prof) datasets, such as model
+# output with many profiles on a column dimension. The variables are on
+# dimensions (column, p) or (p, column), or (column) for near-surface and
+# station variables. The columns are postprocessed individually, optionally in
+# parallel on a pool of worker processes. In the parallel case, the column
+# variables and the outputs are stored as memory-mapped ".npy" files in a
+# temporary directory (in /dev/shm if available, i.e. shared memory), which
+# the workers open instead of receiving the arrays by pickling. Outputs are
+# stored with the column dimension first.
+
+TMP_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Minimum number of columns per worker process.
+MIN_COLUMNS = 16
+
+def column_dim(meta):
+	'''Return the name of the column dimension of a profile dataset with
+	metadata meta, or None if it is a single-column dataset.'''
+	dims = meta.get('ta', {}).get('.dims', [])
+	if len(dims) == 2 and 'p' in dims:
+		return [x for x in dims if x != 'p'][0]
+	return None
+
+def prof_header(meta):
+	'''Return profile metadata for input metadata meta. For multi-column
+	datasets, the dimensions of the input variables are retained.'''
+	dim = column_dim(meta)
+	out = dataset_header(HEADER_PROF)
+	if dim is None:
+		return out
+	for var, m in meta.items():
+		if var != '.' and dim in m.get('.dims', []):
+			out[var] = dict(HEADER_PROF.get(var, {}), **{'.dims': m['.dims']})
+	return out
+
+def init_worker():
+	np.seterr(all='ignore')
+
+def postprocess_range(inputs, shared, outputs, i0, i1):
+	'''Postprocess columns i0 to i1 (exclusive). inputs is a dictionary of
+	column variables as pairs of array and column axis, shared is a dictionary
+	of variables common to all columns and outputs is a dictionary of output
+	arrays (column dimension first). Returns a dictionary of outputs which do
+	not fit the output arrays (such as bvf), as dictionaries of column indices
+	and arrays.'''
+	other = {}
+	for i in range(i0, i1):
+		d = dict(shared)
+		for var, (x, axis) in inputs.items():
+			d[var] = np.take(x, i, axis=axis)
+		postprocess_profile(d)
+		store_column(d, i, shared, outputs, other)
+	return other
+
+def store_column(d, i, shared, outputs, other):
+	# Store postprocessed column d with index i in outputs, or in other if it
+	# does not fit the output arrays.
+	for var, x in d.items():
+		if var in outputs:
+			outputs[var][i] = np.ma.filled(x, np.nan)
+		elif var not in shared:
+			other.setdefault(var, {})[i] = x
+
+def postprocess_job(dirname, spec, shared, i0, i1):
+	inputs = {
+		var: (np.load(os.path.join(dirname, var + '.npy'), mmap_mode='r'), axis)
+		for var, axis in spec['inputs'].items()
+	}
+	outputs = {
+		var: np.load(os.path.join(dirname, 'out.' + var + '.npy'),
+			mmap_mode='r+')
+		for var in spec['outputs']
+	}
+	other = postprocess_range(inputs, shared, outputs, i0, i1)
+	for x in outputs.values():
+		x.flush()
+	return other
+
+def postprocess(d, jobs=None):
+	'''Postprocess multi-column profile dataset d on jobs worker processes
+	(default: the environment variable RSTOOL_JOBS or the number of CPUs). If
+	jobs is 1, the columns are postprocessed in the current process.'''
+	if jobs is None:
+		jobs = int(os.environ.get('RSTOOL_JOBS', os.cpu_count()))
+	meta = d['.']
+	dim = column_dim(meta)
+	axes = {}
+	for var in d.keys():
+		if var != '.' and dim in meta.get(var, {}).get('.dims', []):
+			axes[var] = meta[var]['.dims'].index(dim)
+	n = d['ta'].shape[axes['ta']]
+	filled = lambda x: x.filled(np.nan if x.dtype.kind == 'f' else None) \
+		if isinstance(x, np.ma.MaskedArray) else x
+	inputs = {var: (filled(d[var]), axis) for var, axis in axes.items()}
+	shared = {
+		var: filled(x) for var, x in d.items()
+		if var != '.' and var not in axes
+	}
+	if n == 0:
+		return
+
+	# Outputs on the p dimension or without a dimension are stored in arrays
+	# with the column dimension first. Determine their shape and type from
+	# the first column, which is stored in the outputs when the remaining
+	# columns are done.
+	d0 = dict(shared)
+	for var, (x, axis) in inputs.items():
+		d0[var] = np.take(x, 0, axis=axis)
+	postprocess_profile(d0)
+	np_ = np.shape(d0['ta'])
+	spec = {'inputs': axes, 'outputs': {}}
+	dims = {}
+	for var, x in d0.items():
+		if var in shared:
+			continue
+		if var in HEADER_PROF:
+			dims[var] = HEADER_PROF[var].get('.dims', [])
+		else:
+			dims[var] = ['p'] if np.shape(x) == np_ else []
+		if np.shape(x) in [(), np_] and set(dims[var]) <= {'p'}:
+			spec['outputs'][var] = ((n,) + np.shape(x),
+				np.result_type(np.asarray(x).dtype, var_dtype(var)).str)
+
+	jobs = max(1, min(jobs, (n - 1)//MIN_COLUMNS))
+	chunks = np.linspace(1, n, min(n - 1, jobs*4) + 1).astype(int)
+	if jobs == 1:
+		outputs = {
+			var: np.full(shape, np.nan, dtype)
+			for var, (shape, dtype) in spec['outputs'].items()
+		}
+		other = postprocess_range(inputs, shared, outputs, 1, n)
+	else:
+		dirname = tempfile.mkdtemp(prefix='rstool-', dir=TMP_DIR)
+		try:
+			for var, (x, axis) in inputs.items():
+				np.save(os.path.join(dirname, var + '.npy'), x)
+			for var, (shape, dtype) in spec['outputs'].items():
+				x = np.lib.format.open_memmap(
+					os.path.join(dirname, 'out.' + var + '.npy'),
+					mode='w+', dtype=dtype, shape=shape)
+				x[...] = np.nan
+				x.flush()
+				del x
+			with ProcessPoolExecutor(jobs, initializer=init_worker) as executor:
+				futures = [
+					executor.submit(postprocess_job, dirname, spec, shared,
+						i0, i1)
+					for i0, i1 in zip(chunks[:-1], chunks[1:])
+				]
+				other = {}
+				for fut in futures:
+					for var, x in fut.result().items():
+						other.setdefault(var, {}).update(x)
+			outputs = {
+				var: np.load(os.path.join(dirname, 'out.' + var + '.npy'))
+				for var in spec['outputs']
+			}
+		finally:
+			shutil.rmtree(dirname, ignore_errors=True)
+	store_column(d0, 0, shared, outputs, other)
+
+	# Outputs of variable size (such as bvf) are padded with NaN.
+	for var, x in other.items():
+		out = np.full((n, max([np.size(y) for y in x.values()])), np.nan)
+		for i, y in x.items():
+			out[i,:np.size(y)] = np.ma.filled(y, np.nan)
+		outputs[var] = out
+
+	meta = dict(meta)
+	for var, x in outputs.items():
+		d[var] = x
+		meta[var] = dict(HEADER_PROF.get(var, {}),
+			**{'.dims': [dim] + dims[var]})
+	d['.'] = meta
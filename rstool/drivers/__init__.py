@@ -2,6 +2,8 @@ from . import default
 from . import imet
 from . import ws
 from . import surf
+from . import npy
+from . import text
 
 DRIVERS = {
 	'imet': imet,
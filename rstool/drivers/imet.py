@@ -1,5 +1,4 @@
-import os
-from fnmatch import fnmatch
+import io
 import numpy as np
 import datetime as dt
 import json
@@ -8,9 +7,11 @@ import csv
 import configparser
 import aquarius_time as aq
 
+from rstool import archive
 from rstool.algorithms import *
 from rstool.const import n0
-from rstool.headers import HEADER_PROF, HEADER_PTS
+from rstool.headers import HEADER_PROF, HEADER_PTS, freeze, \
+	dataset_header
 
 PARAMS = [
 	('alt', 'altitude', 'height_above_reference_ellipsoid', 'm', 'float'),
@@ -52,13 +53,11 @@ def header(x):
 		out.update(x[6])
 	return out
 
-META = {x[0]: header(x) for x in PARAMS}
+META = freeze({x[0]: header(x) for x in PARAMS})
 
 def find(dirname, pattern):
-	for l in os.listdir(dirname):
-		if fnmatch(l, pattern):
-			return os.path.join(dirname, l)
-	return None
+	data = archive.find(dirname, pattern)
+	return io.BytesIO(data) if data is not None else None
 
 def parse_geo(s):
 	r = re.compile(rb'^(?P<deg>[0-9]+)\xb0(?P<minute>[0-9\.]+)\'(?P<second>[0-9\.]+)?\"?(?P<dir>[EWNS])')
@@ -97,7 +96,9 @@ def read_flt(filename):
 		'.': {'.': {}},
 	}
 	c = configparser.ConfigParser()
-	try: c.read(filename, encoding='utf-8-sig')
+	try:
+		with archive.open_file(filename) as f:
+			c.read_string(f.read().decode('utf-8-sig'))
 	except: return d
 	try: d['tas'] = float(c['Weather']['Temperature']) + n0
 	except: pass
@@ -155,14 +156,13 @@ def pts(d):
 		'station_time': d['station_time'],
 		'station_z': d['station_z'],
 	}
-	pts['.'] = HEADER_PTS
-	pts['.']['.'] = d['.'].get('.', {})
+	pts['.'] = dataset_header(HEADER_PTS, d['.'].get('.', {}))
 	return pts
 
 def read_dat(filename):
 	d = {}
 	trans = str.maketrans({'#': '', ' ': '_', '+': '_'})
-	with open(filename) as f:
+	with io.TextIOWrapper(archive.open_file(filename)) as f:
 		reader = csv.DictReader(f)
 		for r in reader:
 			for k, v in r.items():
@@ -201,6 +201,10 @@ def read_dat(filename):
 	return d2
 
 def read(dirname):
+	'''Read iMet sounding from a directory, zip or tar archive dirname
+	containing ".dat" and ".flt" files (optionally compressed with gzip,
+	bzip2 or xz). The archive can also be passed as a binary file object or
+	bytes.'''
 	filename_dat = find(dirname, '*.dat')
 	filename_flt = find(dirname, '*.flt')
 	d = read_flt(filename_flt)
@@ -0,0 +1,46 @@
+import os
+import json
+import numpy as np
+
+# Binary sidecar format: a directory containing one raw ".npy" file per
+# variable and a JSON header ("header.json") with the variable and global
+# attributes in the same layout as the "." item of a ds dictionary (mirroring
+# HEADER_PTS for pts datasets). Variables are opened as memory-mapped arrays,
+# so that very long datasets do not have to be loaded into memory.
+
+HEADER_FILENAME = 'header.json'
+
+def read(dirname, mmap_mode='r'):
+	'''Read dataset from a binary sidecar directory dirname. mmap_mode is
+	passed to np.load. Returns a ds dictionary.'''
+	with open(os.path.join(dirname, HEADER_FILENAME)) as f:
+		meta = json.load(f)
+	d = {'.': meta}
+	for var in meta.keys():
+		if var == '.':
+			continue
+		filename = os.path.join(dirname, var + '.npy')
+		if not os.path.exists(filename):
+			continue
+		x = np.load(filename, mmap_mode=mmap_mode)
+		d[var] = x[()] if x.ndim == 0 else x
+	return d
+
+def write(dirname, d):
+	'''Write dataset d (ds dictionary) to a binary sidecar directory
+	dirname.'''
+	os.makedirs(dirname, exist_ok=True)
+	meta = {
+		k: v for k, v in d.get('.', {}).items()
+		if k == '.' or k in d
+	}
+	for var, x in d.items():
+		if var == '.':
+			continue
+		if var not in meta:
+			meta[var] = {'.dims': ['seq'] if np.ndim(x) > 0 else []}
+		if isinstance(x, np.ma.MaskedArray):
+			x = x.filled(np.nan) if x.dtype.kind == 'f' else x.filled()
+		np.save(os.path.join(dirname, var + '.npy'), np.asarray(x))
+	with open(os.path.join(dirname, HEADER_FILENAME), 'w') as f:
+		json.dump(meta, f, indent=1)
@@ -1,13 +1,37 @@
+import os
 import numpy as np
 import ds_format as ds
 
 VARS = ['hurs', 'ps', 'tas', 'tds', 'ts', 'uas', 'vas', 'wdds', 'wdss']
 
+# Cache of time variables of surface files, indexed by file name, file
+# modification time and size. This avoids reading the time variable of the
+# same file repeatedly in a long-running process.
+TIME_CACHE = {}
+
+def read_time(filename):
+	'''Read the time variable from filename, using TIME_CACHE.'''
+	st = os.stat(filename)
+	key = (st.st_mtime_ns, st.st_size)
+	cached = TIME_CACHE.get(filename)
+	if cached is not None and cached[0] == key:
+		return cached[1]
+	time = ds.read(filename, ['time'])['time']
+	TIME_CACHE[filename] = (key, time)
+	return time
+
 def read(filename, time):
-	d = ds.read(filename, ['time'])
-	i = np.argmin(np.abs(d['time'] - time))
-	dt = np.abs(d['time'][i] - time)
-	if dt <= 1/24.:
-		return ds.read(filename, VARS, sel={'time': i})
+	'''Read near-surface variables at the time nearest to time from
+	filename (str) or dataset (dict). Returns None if there is no time within
+	1 hour.'''
+	if isinstance(filename, dict):
+		t = filename['time']
 	else:
+		t = read_time(filename)
+	i = np.argmin(np.abs(t - time))
+	dt = np.abs(t[i] - time)
+	if dt > 1/24.:
 		return None
+	if isinstance(filename, dict):
+		return {var: filename[var][i] for var in VARS if var in filename}
+	return ds.read(filename, VARS, sel={'time': i})
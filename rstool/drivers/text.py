@@ -0,0 +1,159 @@
+import sys
+import json
+import numpy as np
+
+# Text output formats: comma-separated values ("csv") and JSON lines
+# ("jsonl"). The variables of a dataset are written as columns of a table
+# with one row per element of the row dimensions, which are the dimensions
+# shared by the largest number of variables ("seq" for pts, "p" for prof and
+# "profile" and "p" for prof:segments). Variables on a subset of the row
+# dimensions (such as near-surface variables) are repeated on every row, and
+# variables on other dimensions are omitted. The rows are formatted and
+# written in chunks of CHUNK_SIZE, so that no copy of the whole dataset is
+# made. Missing values are written as empty fields (csv) or null (jsonl).
+#
+# csv: The first line contains the variable names and the second line the
+# units.
+#
+# jsonl: The first line is an object with the variable and global attributes
+# in the same layout as the "." item of a ds dictionary, and every other line
+# is an object of variable names and values of a row.
+
+FORMATS = ['csv', 'jsonl']
+
+CHUNK_SIZE = 10000
+
+def row_dims(d):
+	'''Return the row dimensions (tuple) of dataset d (dict).'''
+	count = {}
+	for var in d:
+		dims = tuple(d['.'].get(var, {}).get('.dims', []))
+		if var != '.' and len(dims) > 0:
+			count[dims] = count.get(dims, 0) + 1
+	if len(count) == 0:
+		return ()
+	return max(count, key=lambda dims: (count[dims], len(dims)))
+
+def columns(d, dims, shape):
+	'''Return a list of columns of dataset d on row dimensions dims with
+	shape shape as tuples of the column name, an array and the positions of
+	its dimensions in dims. Row dimensions which are not variables are
+	included as index columns if there is more than one.'''
+	out = []
+	if len(dims) > 1:
+		for i, dim in enumerate(dims):
+			if dim not in d:
+				out += [(dim, np.arange(shape[i]), [i])]
+	for var, x in d.items():
+		if var == '.':
+			continue
+		var_dims = d['.'].get(var, {}).get('.dims', [])
+		if not set(var_dims) <= set(dims) or np.ndim(x) != len(var_dims):
+			continue
+		pos = [dims.index(dim) for dim in var_dims]
+		if pos != sorted(pos):
+			continue
+		out += [(var, x, pos)]
+	return out
+
+def dims_shape(d, dims):
+	'''Return the shape of row dimensions dims in dataset d (dict).'''
+	for var, x in d.items():
+		if var != '.' and \
+			tuple(d['.'].get(var, {}).get('.dims', [])) == dims:
+			return np.shape(x)
+	return ()
+
+def chunk_of(x, pos, shape, j0, j1):
+	# Elements j0 to j1 of column x with dimensions at positions pos in the
+	# rows of shape shape (flattened).
+	if len(shape) == 1 and pos == [0]:
+		return x[j0:j1]
+	i = np.unravel_index(np.arange(j0, j1), shape)
+	y = x[tuple(i[k] for k in pos)] if len(pos) > 0 else x
+	if isinstance(y, np.ma.MaskedArray):
+		return np.ma.MaskedArray(np.broadcast_to(y, (j1 - j0,)),
+			np.broadcast_to(np.ma.getmaskarray(y), (j1 - j0,)))
+	return np.broadcast_to(y, (j1 - j0,))
+
+def csv_quote(s):
+	# Quote a CSV field if needed.
+	if any([c in s for c in ',"\r\n']):
+		return '"' + s.replace('"', '""') + '"'
+	return s
+
+def tokens(x, missing, quote):
+	'''Format array x as a list of strings. Missing values (masked or
+	non-finite) are formatted as missing. Strings are formatted with function
+	quote.'''
+	mask = np.ma.getmaskarray(x)
+	x = np.ma.getdata(x)
+	if x.dtype.kind == 'f':
+		mask = mask | ~np.isfinite(x)
+		# repr of Python float is the shortest representation which round
+		# trips, and faster than astype(str) for float64.
+		s = list(map(repr, x.tolist())) if x.dtype == np.float64 \
+			else x.astype(str).tolist()
+	elif x.dtype.kind in 'iu':
+		s = list(map(str, x.tolist()))
+	elif x.dtype.kind == 'b':
+		s = ['true' if v else 'false' for v in x.tolist()]
+	else:
+		s = [
+			quote(v.decode() if isinstance(v, bytes) else str(v))
+			for v in x.tolist()
+		]
+	if np.any(mask):
+		s = [missing if m else v for v, m in zip(s, mask.tolist())]
+	return s
+
+def write(output, d, fmt):
+	'''Write dataset d (dict) to output in text format fmt ("csv" or "jsonl",
+	see FORMATS). output is a file name, or "-" for the standard output.'''
+	if fmt not in FORMATS:
+		raise ValueError('%s: unknown text format' % fmt)
+	if output == '-':
+		write_file(sys.stdout, d, fmt)
+		sys.stdout.flush()
+	else:
+		with open(output, 'w', newline='') as f:
+			write_file(f, d, fmt)
+
+def write_file(f, d, fmt):
+	'''Write dataset d (dict) to a text file object f in text format fmt.'''
+	d = dict(d, **{'.': d.get('.', {})})
+	dims = row_dims(d)
+	shape = dims_shape(d, dims)
+	cols = columns(d, dims, shape)
+	n = int(np.prod(shape))
+	names = [name for name, _, _ in cols]
+	meta = {name: d['.'].get(name, {}) for name in names}
+	if fmt == 'csv':
+		f.write(','.join([csv_quote(name) for name in names]) + '\n')
+		f.write(','.join([
+			csv_quote(meta[name].get('units', '')) for name in names
+		]) + '\n')
+	else:
+		header = {
+			name: {k: v for k, v in m.items() if k != '.dims'}
+			for name, m in meta.items()
+		}
+		header['.'] = d['.'].get('.', {})
+		f.write(json.dumps({'.': header}, default=str) + '\n')
+		template = '{' + ', '.join([
+			json.dumps(name).replace('%', '%%') + ': %s' for name in names
+		]) + '}\n'
+	for j0 in range(0, n, CHUNK_SIZE):
+		j1 = min(j0 + CHUNK_SIZE, n)
+		if fmt == 'csv':
+			rows = zip(*[
+				tokens(chunk_of(x, pos, shape, j0, j1), '', csv_quote)
+				for _, x, pos in cols
+			])
+			f.write(''.join([','.join(row) + '\n' for row in rows]))
+		else:
+			rows = zip(*[
+				tokens(chunk_of(x, pos, shape, j0, j1), 'null', json.dumps)
+				for _, x, pos in cols
+			])
+			f.write(''.join([template % row for row in rows]))
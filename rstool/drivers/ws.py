@@ -1,8 +1,10 @@
+import os
 import re
 import numpy as np
 import ds_format as ds
 
-from rstool.headers import HEADER_PTS
+from rstool import archive
+from rstool.headers import HEADER_PTS, freeze, dataset_header
 from rstool.const import n0
 
 re_line = re.compile(b'^(?P<h>\d+h)?(?P<m>\d+m)?(?P<s>\d+s)?(?P<ms>\d+)?: \[\#(?P<label>[A-Z]+):(?P<data>[^:\]]*)(?P<extra>:[^\]*])?\]$')
@@ -96,12 +98,25 @@ def header(x):
 		])
 	return out
 
-META = {x[0]: header(x) for x in PARAMS}
+META = freeze({x[0]: header(x) for x in PARAMS})
+
+SONDE_VARS = ['node_id', 'sid', 'id']
+
+PARAM_CACHE = {}
 
 def param(key):
+	# The matching parameter is cached, because keys repeat on every line.
+	try:
+		return PARAM_CACHE[key]
+	except KeyError:
+		pass
+	out = None
 	for p in PARAMS:
 		if re.match(b'^' + p[0] + b'$', key):
-			return p
+			out = p
+			break
+	PARAM_CACHE[key] = out
+	return out
 
 def stage2(d):
 	if b'fwver' in d:
@@ -204,54 +219,86 @@ def stage0(line):
 			d[k.encode('utf-8')] = v
 	return stage1(d)
 
-def postprocess(dd):
-	for var in [b'lat', b'lon']:
-		x = np.nan
-		varm = var + b'm'
-		vard = var + b'd'
-		for d in dd:
-			xm = (np.abs(x) % 1.)*60.
-			xd = xm % 1.
-			if var in d:
-				x = d[var]
-			elif varm in d and not np.isnan(x):
-				xm2 = d[varm]
-				if x < 0:
-					xm2 = 60. - xm2
-				x = np.sign(x)*(np.floor(np.abs(x)) + xm2/60.)
-			elif vard in d and not np.isnan(x):
-				xd2 = d[vard]
-				if x < 0.:
-					xd2 = 1. - xd2
-				if xd2 - xd > 0.5:
-					xd2 -= 1.
-				if xd2 - xd < -0.5:
-					xd2 += 1.
-				x = np.sign(x)*(np.floor(np.abs(x)) + \
-					(np.floor(xm) + xd2)/60.)
-			if varm in d:
-				del d[varm]
-			if vard in d:
-				del d[vard]
-			d[var] = x
+def ffill_index(mask):
+	# Index of the last element at or before each position where mask is
+	# true, or -1 if there is none.
+	return np.maximum.accumulate(np.where(mask, np.arange(len(mask)), -1))
 
-def read(filename):
-	dd = []
+def postprocess(d):
+	'''Reconstruct absolute latitude and longitude in columnar data d from
+	the full fix (lat, lon), minute (latm, lonm) and decimal part of minute
+	(latd, lond) messages.'''
+	def column(k):
+		if k not in d:
+			return np.full(n, np.nan, np.float64)
+		return np.ma.filled(np.ma.asarray(d[k], np.float64), np.nan)
+	n = max([len(v) for k, v in d.items() if k != '.'], default=0)
+	if n == 0:
+		return
+	for var in ['lat', 'lon']:
+		varm = var + 'm'
+		vard = var + 'd'
+		x0 = column(var)
+		xm0 = column(varm)
+		xd0 = column(vard)
+		d.pop(varm, None)
+		d.pop(vard, None)
+		d['.'].pop(varm, None)
+		d['.'].pop(vard, None)
+
+		# Forward-fill the last full fix. Messages before it are missing.
+		is_fix = ~np.isnan(x0)
+		i_fix = ffill_index(is_fix)
+		valid = i_fix >= 0
+		x_fix = np.where(valid, x0[np.maximum(i_fix, 0)], np.nan)
+		sign = np.sign(x_fix)
+		has_m = valid & ~is_fix & ~np.isnan(xm0)
+		has_d = valid & ~is_fix & ~has_m & ~np.isnan(xd0)
+
+		# Minute and decimal part of minute, mirrored for negative values.
+		xm = np.where(sign < 0, 60. - xm0, xm0)
+		xd = np.where(sign < 0, 1. - xd0, xd0)
+
+		# The value is kept as degrees plus minutes. A full fix or a minute
+		# message starts a chain, in which each decimal part of minute
+		# message moves the minutes to the nearest value with the given
+		# decimal part.
+		anchor = is_fix | has_m
+		r = np.where(is_fix, (np.abs(x0) % 1.)*60., xm)
+		src = anchor | has_d
+		frac = np.where(anchor, r, xd) % 1.
+		i_src = ffill_index(src)
+		prev = np.full(n, np.nan, np.float64)
+		prev[1:] = frac[np.maximum(i_src[:-1], 0)]
+		u = np.where(has_d, xd - prev, 0.)
+		u = u - (u > 0.5) + (u < -0.5)
+		cs = np.cumsum(u)
+		i_anchor = ffill_index(anchor)
+		c = np.maximum(i_anchor, 0)
+		minute = r[c] + cs - cs[c]
+
+		# Carry over whole degrees when the minutes of a chain roll over.
+		a = np.flatnonzero(anchor)
+		end = np.append(a[1:], n) - 1
+		inc = np.floor((r[a] + cs[end] - cs[a])/60.)
+		inc_cs = np.cumsum(inc) - inc
+		deg_a = np.floor(np.abs(x0[a]))
+		k = np.searchsorted(a, i_fix[a])
+		deg_a = deg_a[k] + inc_cs - inc_cs[k]
+		deg = np.full(n, np.nan, np.float64)
+		deg[valid] = deg_a[np.searchsorted(a, i_anchor[valid])]
+
+		x = sign*(deg + minute/60.)
+		x[is_fix] = x0[is_fix]
+		x[~valid] = np.nan
+		d[var] = x
+		d['.'][var] = META[var.encode('utf-8')]
+
+def columns(dd):
 	keys = set()
-	header = {}
-	with open(filename, 'rb') as f:
-		for line in f.readlines():
-			line = line.strip()
-			d = stage0(line)
-			if d is not None:
-				if b'key' in d and b'value' in d:
-					header[d[b'key']] = d[b'value']
-				else:
-					dd += [d]
-	postprocess(dd)
 	for d in dd:
 		keys |= set(d.keys())
-	d0= {'.': {}}
+	d0 = {'.': {}}
 	for k in keys:
 		p = param(k)
 		if p is None:
@@ -269,6 +316,81 @@ def read(filename):
 				mask=[(k not in d) for d in dd]
 			)
 		d0['.'][ku] = META[p[0]]
+	return d0
+
+def ffill_column(x):
+	# Integer column x (masked array) with missing values forward-filled, and
+	# back-filled before the first value. NA['int'] if there is no value.
+	present = ~np.ma.getmaskarray(x)
+	x = np.ma.filled(x, NA['int']).astype(np.int64)
+	if not np.any(present):
+		return x
+	i = ffill_index(present)
+	i[i < 0] = np.argmax(present)
+	return x[i]
+
+def sonde_ids(d, keys):
+	'''Return identifiers (n, len(keys)) of the messages in columnar data d
+	from columns keys. Missing identifiers of a message are taken from the
+	preceding message (or the following message if there is none) with all
+	identifiers present and equal to the identifiers present in the message,
+	so that messages of interleaved sondes are not mixed. If there is no such
+	message, missing identifiers are forward-filled by column.'''
+	x = np.stack([
+		np.ma.filled(d[k], NA['int']).astype(np.int64)
+		for k in keys
+	], axis=1)
+	present = np.stack([~np.ma.getmaskarray(d[k]) for k in keys], axis=1)
+	complete = np.all(present, axis=1)
+	out = np.stack([ffill_column(d[k]) for k in keys], axis=1)
+	n = len(x)
+	best = np.full(n, -3*n, np.int64)
+	for u in np.unique(x[complete], axis=0):
+		is_u = complete & np.all(x == u, axis=1)
+		# Preceding messages are preferred to following ones.
+		i = ffill_index(is_u)
+		score = np.where(i >= 0, i, np.argmax(is_u) - 2*n)
+		better = ~complete & (score > best) & \
+			np.all(~present | (x == u), axis=1)
+		out[better] = u
+		best[better] = score[better]
+	return out
+
+def split(d):
+	'''Split columnar data d by sonde identified by SONDE_VARS. Missing
+	identifiers are filled by sonde_ids. Returns a dictionary of sonde labels
+	and columnar data.'''
+	keys = [k for k in SONDE_VARS if k in d]
+	n = len(d[keys[0]]) if len(keys) > 0 else 0
+	if n == 0 or all([np.all(np.ma.getmaskarray(d[k])) for k in keys]):
+		return {'': d}
+	x = sonde_ids(d, keys)
+	values, inv = np.unique(x, axis=0, return_inverse=True)
+	inv = inv.reshape(-1)
+	order = np.argsort(inv, kind='stable')
+	groups = np.split(order, np.cumsum(np.bincount(inv))[:-1])
+	out = {}
+	for value, idx in zip(values, groups):
+		label = '_'.join([
+			('na' if v == NA['int'] else str(v))
+			for v in value
+		])
+		d1 = {'.': {}}
+		for k, v in d.items():
+			if k == '.':
+				continue
+			v1 = v[idx]
+			if isinstance(v1, np.ma.MaskedArray):
+				present = np.any(~np.ma.getmaskarray(v1))
+			else:
+				present = np.any(~np.isnan(v1))
+			if present:
+				d1[k] = v1
+				d1['.'][k] = d['.'][k]
+		out[label] = d1
+	return out
+
+def set_header(d0, header):
 	for k, v in header.items():
 		p = param(k)
 		if p is None:
@@ -286,8 +408,138 @@ def read(filename):
 				d0[ku] = v.decode('utf-8')
 		else:
 			d0[ku] = v
-		d0['.'][ku] = META[p[0]]
-		d0['.'][ku]['.dims'] = []
+		d0['.'][ku] = dict(META[p[0]], **{'.dims': []})
+
+def merge(parts):
+	'''Merge columnar data of several files of the same flight. parts is a
+	list of pairs of columnar data and header. Message time is aligned to the
+	earliest session start (offset). Messages are sorted by time, and
+	duplicate messages (the same sonde and sequence number, or the same time
+	for messages without a sequence number) are removed. Returns a pair of
+	merged columnar data and header.'''
+	offsets = np.array([
+		float(header.get(b'offset', b'nan'))
+		for d, header in parts
+	])
+	offsets[np.isnan(offsets)] = np.nanmin(offsets) \
+		if np.any(~np.isnan(offsets)) else 0.
+	i0 = np.argmin(offsets)
+	header = parts[i0][1]
+	keys = set()
+	for d, _ in parts:
+		keys |= set(d.keys())
+	keys.discard('.')
+	d0 = {'.': {}}
+	for d, _ in parts:
+		d0['.'].update(d['.'])
+	# Files without messages (such as a file with only a header left by a
+	# receiver restart) contribute no columns.
+	ns = [
+		max([len(v) for k, v in d.items() if k != '.'], default=0)
+		for d, _ in parts
+	]
+	if sum(ns) == 0:
+		return d0, header
+	for k in keys:
+		p = param(k.encode('utf-8'))
+		type_ = p[4][1] if type(p[4]) is tuple else p[4]
+		dtype = [d[k].dtype for d, _ in parts if k in d][0]
+		if type_ == 'float':
+			d0[k] = np.concatenate([
+				d[k] if k in d else np.full(n, np.nan, dtype)
+				for (d, _), n in zip(parts, ns)
+			])
+		else:
+			d0[k] = np.ma.concatenate([
+				d[k] if k in d else np.ma.masked_all(n, dtype)
+				for (d, _), n in zip(parts, ns)
+			])
+	shift = np.concatenate([
+		np.full(n, np.round((offset - offsets[i0])*1e3), np.int64)
+		for n, offset in zip(ns, offsets)
+	])
+	t = ((
+		d0['h'].filled(0)*60 +
+		d0['m'].filled(0))*60 +
+		d0['s'].filled(0))*1000 + \
+		d0['ms'].filled(0) + shift
+
+	order = np.argsort(t, kind='stable')
+	keep = np.zeros(len(t), bool)
+	if 'seq' in d0:
+		has_seq = ~np.ma.getmaskarray(d0['seq'])[order]
+	else:
+		has_seq = np.zeros(len(t), bool)
+	sonde_keys = [k for k in SONDE_VARS if k in d0]
+	ids = np.concatenate([
+		sonde_ids({k: d0[k][order] for k in sonde_keys}, sonde_keys)
+			if len(sonde_keys) > 0 else np.zeros((len(t), 0), np.int64),
+		np.stack([
+			np.ma.filled(d0[k], NA['int']).astype(np.int64)[order]
+			for k in ['seq'] if k in d0
+		] + [np.zeros(len(t), np.int64)], axis=1),
+	], axis=1)
+	_, i = np.unique(ids[has_seq], axis=0, return_index=True)
+	keep[np.flatnonzero(has_seq)[i]] = True
+	_, i = np.unique(t[order][~has_seq], return_index=True)
+	keep[np.flatnonzero(~has_seq)[i]] = True
+	idx = order[keep]
+
+	for k in keys:
+		d0[k] = d0[k][idx]
+	t = t[idx]
+	d0['h'] = np.ma.array(t//3600000)
+	d0['m'] = np.ma.array(t//60000 % 60)
+	d0['s'] = np.ma.array(t//1000 % 60)
+	d0['ms'] = np.ma.array(t % 1000)
+	return d0, header
+
+def parse(filename):
+	dd = []
+	header = {}
+	with archive.open_file(filename) as f:
+		for line in f.readlines():
+			line = line.strip()
+			d = stage0(line)
+			if d is not None:
+				if b'key' in d and b'value' in d:
+					header[d[b'key']] = d[b'value']
+				else:
+					dd += [d]
+	return columns(dd), header
+
+def read(filename, split_sondes=False):
+	'''Read Windsond sounding from filename. filename can be a file name, a
+	binary file object or bytes, optionally compressed with gzip, bzip2 or xz. It can
+	also be a list of files, or a directory, zip or tar archive containing
+	".sounding" files of the same flight, which are merged (see merge). If
+	split_sondes is True, return a dictionary of sonde labels and datasets of
+	the individual sondes in the session instead of a single dataset.'''
+	if isinstance(filename, (list, tuple)):
+		parts = [parse(x) for x in filename]
+	elif isinstance(filename, (str, os.PathLike)) and (
+		os.path.isdir(filename) or archive.is_archive(filename)
+	):
+		parts = [
+			parse(f)
+			for _, f in archive.iter_files(filename, '*.sounding')
+		]
+		if len(parts) == 0:
+			raise ValueError('%s: no .sounding files found' % filename)
+	else:
+		parts = [parse(filename)]
+	if len(parts) == 1:
+		d0, header = parts[0]
+	else:
+		d0, header = merge(parts)
+	if split_sondes:
+		out = split(d0)
+		for d in out.values():
+			postprocess(d)
+			set_header(d, header)
+		return out
+	postprocess(d0)
+	set_header(d0, header)
 	return d0
 
 def pts(d):
@@ -314,5 +566,5 @@ def pts(d):
 	pts['hur'] = d['hu']
 	pts['lat'] = d['lat']
 	pts['lon'] = d['lon']
-	pts['.'] = HEADER_PTS
+	pts['.'] = dataset_header(HEADER_PTS)
 	return pts
@@ -0,0 +1,134 @@
+import os
+import numpy as np
+
+from rstool.headers import HEADER_PROF
+from rstool.postprocess import DEPS, postprocess
+from rstool.algorithms import interp
+
+# Monte Carlo uncertainty propagation. The input variables of a profile
+# (prof) are perturbed randomly according to error models (ERRORS) to create
+# an ensemble of profiles. The ensemble is postprocessed at once as a batch,
+# with the profile variables on dimensions (member, p) and near-surface
+# variables on dimensions (member, 1), so that the derived variables are
+# calculated by the same array operations as for a single profile. The
+# ensemble mean and standard deviation of the derived variables (VARS) are
+# returned as variables VAR_mean and VAR_std.
+
+# Error models of the input variables as pairs of the standard deviation of a
+# normally-distributed error common to all levels (bias) and of an error
+# independent at every level (noise), in the units of the variable.
+ERRORS = {
+	'ta': (0.2, 0.1),
+	'hur': (3., 1.),
+	'p': (50., 10.),
+	'tas': (0.2, 0.),
+	'hurs': (3., 0.),
+	'ps': (50., 0.),
+}
+
+# Variables whose ensemble mean and standard deviation are calculated.
+VARS = ['td', 'theta', 'thetav', 'w', 'lcl', 'pc', 'lts', 'bvf', 'cape',
+	'cin']
+
+# Variables with dimensions other than "p" and their coordinate variables,
+# on which the ensemble members are interpolated to the coordinate of the
+# nominal profile.
+COORDS = {
+	'p_bvf': 'zg_bvf',
+}
+
+# Humidity variables, which are limited to non-negative values.
+HUMIDITY = ['hur', 'hurs']
+
+def dependents(vars):
+	'''Return a set of variables calculated from variables vars in
+	postprocessing (directly or indirectly), excluding vars.'''
+	out = set(vars)
+	while True:
+		n = len(out)
+		for rec in DEPS:
+			target, source = rec[:2]
+			target = target if isinstance(target, list) else [target]
+			source = source if isinstance(source, list) else [source]
+			if any([s in out for s in source]):
+				out |= set(target)
+		if len(out) == n:
+			return out - set(vars)
+
+def perturb(d, n, errors, rng):
+	'''Create an ensemble of n members from profile d (dict) by perturbing
+	variables by error models errors with random generator rng. Returns a
+	dataset with perturbed variables on dimensions (member, p) or (member, 1)
+	and the other variables as in d. Variables calculated from the perturbed
+	variables are excluded.'''
+	vars = [var for var in errors if var in d]
+	drop = dependents(vars)
+	out = {var: x for var, x in d.items() if var != '.' and var not in drop}
+	for var in vars:
+		bias, noise = errors[var]
+		x = np.ma.filled(np.ma.asarray(d[var], np.float64), np.nan)
+		x = x.reshape((1, -1))
+		x = x + rng.normal(0., 1., (n, 1))*bias + \
+			rng.normal(0., 1., (n, x.shape[1]))*noise
+		if var in HUMIDITY:
+			x = np.fmax(x, 0.)
+		out[var] = x
+	return out
+
+def stats(x):
+	# Mean and sample standard deviation along the first dimension, ignoring
+	# missing values.
+	valid = np.isfinite(x)
+	count = np.sum(valid, axis=0)
+	x = np.where(valid, x, 0.)
+	with np.errstate(invalid='ignore', divide='ignore'):
+		mean = np.sum(x, axis=0)/count
+		var = np.sum(np.where(valid, (x - mean)**2, 0.), axis=0)/(count - 1)
+	return np.where(count > 0, mean, np.nan), \
+		np.where(count > 1, np.sqrt(var), np.nan)
+
+def ensemble(d, nominal, n=100, errors=ERRORS, vars=VARS, seed=0):
+	'''Calculate the ensemble mean and standard deviation of variables vars
+	of profile d (dict, single column, not postprocessed) with n members
+	perturbed by error models errors (see ERRORS) with random seed seed.
+	nominal is the postprocessed profile d, to whose dimensions the results
+	are matched. Returns a dataset (dict) with variables VAR_mean and
+	VAR_std.'''
+	rng = np.random.default_rng(seed)
+	e = perturb(d, n, errors, rng)
+	postprocess(e)
+	out = {'.': {}}
+	for var in vars:
+		if var not in e or var not in nominal:
+			continue
+		meta = d['.'].get(var, HEADER_PROF.get(var, {}))
+		dims = meta.get('.dims', [])
+		x = np.ma.filled(np.ma.asarray(e[var], np.float64), np.nan)
+		if len(dims) == 1 and dims[0] in COORDS:
+			coord = COORDS[dims[0]]
+			x = interp(nominal[coord], e[coord], x)
+		x = np.broadcast_to(x, (n,) + np.shape(x)[-1:]) if x.ndim > 0 \
+			else np.full((n, 1), x)
+		mean, std = stats(x)
+		if len(dims) == 0:
+			mean, std = mean[0], std[0]
+		out[var + '_mean'] = mean
+		out[var + '_std'] = std
+		attrs = {k: v for k, v in meta.items() if k != 'long_name'}
+		comment = '; '.join([c for c in [meta.get('comment'),
+			'ensemble of %d members' % n] if c])
+		long_name = meta.get('long_name', var)
+		out['.'][var + '_mean'] = dict(attrs,
+			long_name=long_name + ' ensemble mean', comment=comment)
+		out['.'][var + '_std'] = dict(
+			{k: v for k, v in attrs.items() if k != 'standard_name'},
+			long_name=long_name + ' ensemble standard deviation',
+			comment=comment)
+	return out
+
+def ensemble_size(n):
+	# Number of ensemble members n, or the environment variable
+	# RSTOOL_ENSEMBLE if None. 0 if no ensemble should be calculated.
+	if n is None:
+		n = int(os.environ.get('RSTOOL_ENSEMBLE', 0))
+	return n
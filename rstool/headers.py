@@ -1,3 +1,53 @@
+import copy
+
+# Header registries. The headers (HEADER_PTS, HEADER_PROF and the variable
+# metadata of the drivers) are shared by all datasets, and are therefore
+# frozen (see freeze) so that metadata of one dataset cannot leak into another
+# one, such as when conversions run concurrently in threads. The metadata of
+# a dataset is a shallow copy of a header made with dataset_header, in which
+# variable and global attributes are replaced rather than modified, e.g.
+# meta[var] = dict(meta[var], **attrs). The shallow copy is cheap, because the
+# frozen variable attributes are shared and need not be copied.
+
+class FrozenDict(dict):
+	'''Read-only dictionary. Copies made with dict, copy.copy or
+	copy.deepcopy are ordinary (mutable) dictionaries.'''
+	def readonly(self, *args, **kwargs):
+		raise TypeError('header is read-only')
+
+	__setitem__ = readonly
+	__delitem__ = readonly
+	__ior__ = readonly
+	clear = readonly
+	pop = readonly
+	popitem = readonly
+	setdefault = readonly
+	update = readonly
+
+	def __copy__(self):
+		return dict(self)
+
+	def __deepcopy__(self, memo):
+		return copy.deepcopy(dict(self), memo)
+
+	def __reduce__(self):
+		return (FrozenDict, (dict(self),))
+
+def freeze(x):
+	'''Return header x (dict) and its dictionary items as FrozenDict.'''
+	return FrozenDict({
+		k: freeze(v) if isinstance(v, dict) else v
+		for k, v in x.items()
+	})
+
+def dataset_header(header, attrs=None):
+	'''Return metadata of a new dataset from header header (dict) with global
+	attributes attrs (dict). The result is a shallow copy of header, which
+	can be modified without affecting header.'''
+	out = dict(header)
+	out['.'] = dict(attrs if attrs is not None else header.get('.', {}))
+	return out
+
 def header(x):
 	out = {}
 	for i, h in enumerate(['long_name', 'standard_name', 'units', '.dims']):
@@ -27,13 +77,21 @@ HEADER_PTS = [
 	('vas', 'northward near-surface wind', 'northward_wind', 'm s-1', []),
 	('z', 'altitude', 'height_above_reference_ellipsoid', 'm', ['seq']),
 ]
-HEADER_PTS = {x[0]: header(x) for x in HEADER_PTS}
+HEADER_PTS = freeze({x[0]: header(x) for x in HEADER_PTS})
 
 HEADER_PROF = [
 	('bvf', 'brunt vaisala frequency in air', 'brunt_vaisala_frequency_in_air',
 		's-1', ['p_bvf']),
+	('cape', 'convective available potential energy',
+		'atmosphere_convective_available_potential_energy_wrt_surface',
+		'J kg-1', [], {'comment': 'parcel lifted from the surface'}),
+	('cin', 'convective inhibition',
+		'atmosphere_convective_inhibition_wrt_surface', 'J kg-1', [],
+		{'comment': 'parcel lifted from the surface'}),
 	('e', 'water vapor partial pressure in air',
 		'water_vapor_partial_pressure_in_air', 'Pa', ['p']),
+	('el', 'equilibrium level', 'geopotential_height', 'm', [],
+		{'comment': 'parcel lifted from the surface'}),
 	('es', 'near-surface water vapor partial pressure in air',
 		'water_vapor_partial_pressure_in_air', 'Pa', []),
 	('esat', 'saturation water vapor partial pressure in air',
@@ -53,7 +111,7 @@ HEADER_PROF = [
 	('hur', 'relative humidity', 'relative_humidity', '%', ['p']),
 	('hurs', 'near-surface relative humidity', 'relative_humidity', '%', []),
 	('hus', 'specific humidity', 'specific_humidity', '1', ['p']),
-	('huss', 'near-surface specific humidity', 'specific_humidity', '1', ['p']),
+	('huss', 'near-surface specific humidity', 'specific_humidity', '1', []),
 	('lat', 'latitude', 'latitude', 'degree_north', ['p']),
 	('lcl', 'lifting condensation level', 'geopotential_height', 'm', [], {
 		'comment': 'calculated from the measured environmental pressure and geopotential height'
@@ -64,12 +122,22 @@ HEADER_PROF = [
 	('lclp', 'lifting condensation level from surface temperature', 'geopotential_height', 'm', [], {
 		'comment': 'same as lcl but uses ts instead of tas'
 	}),
+	('lfc', 'level of free convection', 'geopotential_height', 'm', [],
+		{'comment': 'parcel lifted from the surface'}),
+	('level_type', 'level type', None, '1', ['p'], {
+		'flag_masks': [1, 2, 4, 8, 16],
+		'flag_meanings': 'surface mandatory significant_temperature significant_humidity significant_wind',
+	}),
 	('lon', 'longitude', 'longitude', 'degree_east', ['p']),
 	('lts', 'lower tropospheric stability', None, 'K', [],
 		{'units_metadata': 'temperature: difference'}),
 	('p', 'pressure', 'air_pressure', 'Pa', ['p']),
 	('p_bvf', 'pressure of bvf', 'air_pressure', 'Pa', ['p_bvf']),
 	('pc', 'condensation pressure', 'air_pressure', 'Pa', []),
+	('pel', 'pressure of equilibrium level', 'air_pressure', 'Pa', [],
+		{'comment': 'parcel lifted from the surface'}),
+	('plfc', 'pressure of level of free convection', 'air_pressure', 'Pa',
+		[], {'comment': 'parcel lifted from the surface'}),
 	('pcs', 'condensation pressure from surface temperature',
 		'air_pressure', 'Pa', [], {
 			'comment': 'same as pc but uses ts instead of tas'
@@ -91,7 +159,11 @@ HEADER_PROF = [
 	('td', 'dew point temperature', 'dew_point_temperature', 'K', ['p']),
 	('tds', 'near-surface dew point temperature', 'dew_point_temperature', 'K', []),
 	('tv', 'virtual temperature', 'virtual_temperature', 'K', ['p']),
+	('tvpar', 'parcel virtual temperature', 'virtual_temperature', 'K', ['p'],
+		{'comment': 'parcel lifted from the surface'}),
 	('tvs', 'near-surface virtual temperature', 'virtual_temperature', 'K', []),
+	('tapar', 'parcel air temperature', 'air_temperature', 'K', ['p'],
+		{'comment': 'parcel lifted from the surface'}),
 	('tas', 'near-surface air temperature', 'air_temperature', 'K', []),
 	('td', 'dew point temperature', 'dew_point_temperature', 'K', ['p']),
 	('tds', 'near-surface dew point temperature', 'dew_point_temperature', 'K',
@@ -121,6 +193,8 @@ HEADER_PROF = [
 		'degree', []),
 	('wds', 'wind speed', 'wind_speed', 'm s-1', ['p']),
 	('wdss', 'near-surface wind speed', 'wind_speed', 'm s-1', []),
+	('wpar', 'parcel humidity mixing ratio', None, '1', ['p'],
+		{'comment': 'parcel lifted from the surface'}),
 	('ws', 'near-surface humidity mixing ratio', None, '1', []),
 	('wsat', 'saturation humidity mixing ratio', None, '1', ['p']),
 	('wsats', 'near-surface saturation humidity mixing ratio', None,
@@ -129,4 +203,4 @@ HEADER_PROF = [
 	('zg', 'geopotential height', 'geopotential_height', 'm', ['p']),
 	('zg_bvf', 'geopotential height of bvf', 'geopotential_height', 'm', ['p_bvf']),
 ]
-HEADER_PROF = {x[0]: header(x) for x in HEADER_PROF}
+HEADER_PROF = freeze({x[0]: header(x) for x in HEADER_PROF})
@@ -2,6 +2,13 @@
 '''rstool converts radiosonde measurement data to NetCDF intrument-dependent intermediate (im), points (pts), and profile (prof) datasets and calculates derived physical quantities.
 
 Usage: rstool INPUT_TYPE OUTPUT_TYPE INPUT [SURFACE] OUTPUT
+       rstool server [SOCKET [JOBS]]
+       rstool watch OUTPUT_TYPE INPUT_DIR OUTPUT_DIR [JOBS]
+       rstool batch INPUT_TYPE OUTPUT_TYPE INPUT_DIR [SURFACE] OUTPUT_DIR
+       rstool campaign CAMPAIGN INPUT...
+       rstool curtain CAMPAIGN OUTPUT [STEP]
+       rstool stats GROUP OUTPUT INPUT...
+       rstool verify [N]
 
 Arguments:
 
@@ -9,27 +16,44 @@ Arguments:
   OUTPUT_TYPE  See Output types below.
   INPUT        Input file or directory.
   SURFACE      Near-surface variables (NetCDF).
-  OUTPUT       Output file (NetCDF).
+  OUTPUT       Output file (NetCDF) or directory (pts:npy). "-" for the standard output with the text output types (":csv" and ":jsonl").
+  SOCKET       Unix socket to listen on in the server mode. If "-" or omitted, the standard input and output are used.
+  JOBS         Number of worker processes in the server and watch modes. Default: number of CPUs.
+  INPUT_DIR    Directory to watch for new inputs in the watch mode, or directory of inputs in the batch mode.
+  OUTPUT_DIR   Output directory in the watch and batch modes.
+  N            Number of random inputs per case in the verify mode. Default: 10.
+  CAMPAIGN     Campaign dataset (NetCDF).
+  STEP         Time step of the curtain (s). Default: 3600.
+  GROUP        Grouping of profiles in the stats mode. One of "all", "year", "month" or "season".
 
 Input types:
 
-  imet           InterMet Systems iMet-1-ABxn sounding. INPUT should be a directory generated by the iMetOS-II software, containing ".dat" and ".flt" files.
-  prof           rstool profile ("prof") format (NetCDF). Vertically-interpolated quantities on pressure coordinates.
+  imet           InterMet Systems iMet-1-ABxn sounding. INPUT should be a directory generated by the iMetOS-II software, containing ".dat" and ".flt" files, or a zip or tar archive of the directory.
+  prof           rstool profile ("prof") format (NetCDF). Vertically-interpolated quantities on pressure coordinates. The dataset can contain multiple columns (profiles), in which case the variables have a column dimension in addition to "p" (or only the column dimension for near-surface variables). The columns are postprocessed in parallel on a pool of worker processes (the number of which can be set with the environment variable RSTOOL_JOBS, default: number of CPUs).
   pts            rstool points ("pts") format (NetCDF). Collection of measurement points, not interpolated on vertical coordinates. The output of running rstool with the output type "pts".
+  pts:npy        rstool points ("pts") format stored as a directory of ".npy" files and a JSON header. The output of running rstool with the output type "pts:npy". The arrays are memory-mapped instead of loaded into memory. Profiles are calculated from the points in chunks of one million points, so that long series of points can be processed in bounded memory.
   im:INSTRUMENT  Instrument-dependent intermediate (im) rstool format (NetCDF). INSTRUMENT is one of "imet" or "ws".
-  ws             Windsond sounding. INPUT should be a ".sounding" file generated by the Windsond software.
+  ws             Windsond sounding. INPUT should be a ".sounding" file generated by the Windsond software, or a directory, zip or tar archive containing multiple ".sounding" files of the same flight (such as after a receiver restart). Multiple files are merged, and messages present in more than one file are included only once.
+  ws:split       The same as "ws", but a session with multiple sondes is split into separate outputs for every sonde. The output files are named OUTPUT with "_" and the sonde identification (node ID, session ID and sonde ID separated by "_") inserted before the file extension.
 
 Output types:
 
   pts        Collection of measurement points (NetCDF).
+  pts:npy    Collection of measurement points stored as a directory of ".npy" files and a JSON header ("header.json").
   prof       Vertical profile calculated by interpolating the measurement points during the ascent of the radiosonde as a function of pressure (NetCDF).
   prof:desc  The same as "prof", but for the descending path of the radiosonde (if present in the input data).
+  prof:segments  Vertical profiles of all ascents and descents of the radiosonde on a profile dimension ("profile"), such as in yo-yo soundings, tethered balloon flights or re-launches (NetCDF). A new segment starts where the direction of the radiosonde is reversed by more than 20 hPa. The variable "desc" (profile) is 1 for descending segments.
+  prof:wmo   Vertical profile of the WMO mandatory pressure levels (1000 to 1 hPa, interpolated linearly in the logarithm of pressure) and significant levels selected from the profile by line simplification, so that linear interpolation between the significant levels deviates from the profile by at most 1 K in temperature, 15% in relative humidity and 5 m/s in the wind vector (NetCDF). The variable "level_type" (p) contains flags of the level type: 1 (surface), 2 (mandatory), 4 (significant temperature), 8 (significant humidity) and 16 (significant wind).
   im         Instrument-dependent intermediate rstool format (NetCDF).
+  OUTPUT_TYPE:csv, OUTPUT_TYPE:jsonl  Any of the output types above except "pts:npy" as comma-separated values or JSON lines, such as "prof:csv" or "pts:jsonl". The table has a row for every element of the dimensions shared by the largest number of variables ("seq" for pts, "p" for prof, and "profile" and "p" for prof:segments). Variables with no dimensions are repeated on every row, and variables on other dimensions are omitted. Missing values are written as empty fields (CSV) or null (JSON lines). The first line of CSV contains the variable names and the second line the units. The first line of JSON lines is an object with the variable and global attributes under the key ".".
 
-The following input/output type combinations are possible, where INSTRUMENT is "imet" or "ws":
+Input files can be compressed with gzip, bzip2 or xz (such as ".sounding.gz"). They are decompressed while reading.
+
+The following input/output type combinations are possible, where INSTRUMENT is "imet", "ws" or "ws:split":
 
   INSTRUMENT im            An instrument native format to instrument-dependent intermediate format (NetCDF).
   INSTRUMENT pts           An instrument native format to the points format (NetCDF).
+  INSTRUMENT pts:npy       An instrument native format to the points format (.npy).
   INSTRUMENT prof          An instrument native format to the profile format (NetCDF).
   INSTRUMENT prof:desc     An instrument native format to a descending profile format.
   im:INSTRUMENT pts        An instrument-dependent intermediate format (NetCDF) to the points format (NetCDF).
@@ -37,7 +61,48 @@ The following input/output type combinations are possible, where INSTRUMENT is "
   im:INSTRUMENT prof:desc  An instrument-dependent intermediate format (NetCDF) to the descending profile format (NetCDF).
   pts prof                 The points format (NetCDF) to the profile format (NetCDF).
   pts prof:desc            The points format (NetCDF) to the descending profile format (NetCDF).
+  pts pts:npy              The points format (NetCDF) to the points format (.npy).
+  pts:npy prof             The points format (.npy) to the profile format (NetCDF).
+  pts:npy prof:desc        The points format (.npy) to the descending profile format (NetCDF).
   prof prof                The profile format (NetCDF) to the profile format (NetCDF). This can be used to calculate derived physical quantities from a set source quantities.
+
+The output types "prof:segments" and "prof:wmo" can be used in the same combinations as "prof:desc".
+
+Vertical grid:
+
+  Profiles are calculated on a regular pressure grid with a resolution of 5 hPa covering the range of the points by default. A different vertical grid can be selected with the environment variable RSTOOL_GRID as COORD:LEVELS[:METHOD], where COORD is the vertical coordinate ("p" for pressure in Pa, "lnp" for pressure in Pa with the grid regular and the interpolation linear in the logarithm of pressure, "z" for altitude in m or "zg" for geopotential height in m), LEVELS is the resolution of a regular grid covering the range of the points (in units of the logarithm of pressure for "lnp"), comma-separated levels, or "@" followed by the name of a text file containing the levels, and METHOD is "bin" (averaging of the points between the half levels, the default) or "interp" (linear interpolation between consecutive points). Example: "p:100000,92500,85000,70000,50000:interp". The vertical dimension is named "p" regardless of the coordinate.
+
+Uncertainty ensemble:
+
+  If the environment variable RSTOOL_ENSEMBLE is set to a number of members N, the uncertainty of derived variables of single-column profiles is estimated by Monte Carlo propagation. The air temperature, relative humidity and pressure of the profile and near-surface air temperature, relative humidity and pressure are perturbed N times with normally-distributed errors common to all levels (standard deviation 0.2 K, 3% and 50 Pa) and independent at every level (0.1 K, 1% and 10 Pa). The ensemble is postprocessed at once as a batch of profiles. The ensemble mean and standard deviation of td, theta, thetav, w, lcl, pc, lts, bvf, cape and cin are stored in the variables VAR_mean and VAR_std.
+
+Single precision:
+
+  If the environment variable RSTOOL_DTYPE is set to "float32", points, profiles and derived variables are stored and calculated in single precision, which halves the memory used by the datasets and the size of the output files. time, station_time, profile_time, lat and lon are kept in double precision. The maximum relative difference from "float64" (the default) is about 1e-7 in temperature, height and wind and 2e-6 in humidity variables.
+
+Server mode:
+
+  In the server mode ("rstool server"), rstool keeps running and accepts conversion requests as JSON objects, one per line, with the keys "input_type", "output_type", "input", "output", and optionally "surf" and "id". The requests are run on a pool of JOBS worker processes. A response is written for every request as a JSON object on a line with the keys "id" (the same as in the request), "status" ("ok" or "error"), "error" (error message), "queue_time" (time waiting in the queue in seconds) and "time" (conversion time in seconds). Responses are written in the order in which the requests complete.
+
+Watch mode:
+
+  In the watch mode ("rstool watch"), rstool watches INPUT_DIR for new Windsond ".sounding" files and iMet flight directories (containing ".dat" and ".flt" files), and converts them to OUTPUT_TYPE in OUTPUT_DIR on a pool of JOBS worker processes. The output files are named after the input with "_" and OUTPUT_TYPE appended (":" replaced with "_") and the extension ".nc" (".csv" or ".jsonl" for the text output types). An input is converted once its size and modification time have not changed for 10 s. Failed conversions are retried up to 3 times. Inputs are deferred while 2*JOBS conversions are queued or running. Outputs are written to a temporary file first and renamed when complete. Inputs whose outputs are newer are skipped. Events are written as JSON objects, one per line, with the keys "input", "output", "status" ("ok", "error" or "deferred"), "attempt", "error", "queue_time", "time" and "metrics" (counts of queued, running, ok, failed, retried, deferred and skipped conversions).
+
+Batch mode:
+
+  In the batch mode ("rstool batch"), rstool converts all inputs of INPUT_TYPE in INPUT_DIR to OUTPUT_TYPE in OUTPUT_DIR on a pool of worker processes (one per CPU). The inputs are ".sounding" files (optionally compressed) and zip or tar archives for "ws" and "ws:split", directories and zip or tar archives for "imet", directories containing "header.json" for "pts:npy", and ".nc" files for the other input types. The output files are named as in the watch mode. The conversions run in a pipeline of three stages: reading (in a separate thread), calculation (on the pool of worker processes) and writing (in a separate thread), so that reading of the next input, calculation and writing of the previous output overlap. Completed conversions are recorded in a journal ".rstool-journal.jsonl" in OUTPUT_DIR. A conversion is skipped if its outputs exist and the content of the input, the rstool version, INPUT_TYPE, OUTPUT_TYPE, SURFACE and the environment variables RSTOOL_GRID (the vertical grid), RSTOOL_ENSEMBLE, RSTOOL_DTYPE and RSTOOL_BACKEND are the same as recorded in the journal. An interrupted batch run can therefore be resumed by running the same command again. Events are written as JSON objects, one per line, with the keys "input", "outputs", "status" ("ok", "error" or "done"), "error", "time" (total conversion time in seconds) and "read_time", "compute_time" and "write_time" (time spent in the pipeline stages in seconds), and a summary with the counts of ok, failed and skipped conversions.
+
+Campaign mode:
+
+  In the campaign mode ("rstool campaign"), rstool appends the profiles in the "prof" or "prof:segments" INPUT files to a campaign dataset CAMPAIGN, which is created if it does not exist. The profiles are stacked along a profile dimension ("profile") on a common pressure grid. Profiles already stored in CAMPAIGN are not read again. The launch time of every profile is stored in the variable "profile_time". Profiles with a launch time already in CAMPAIGN are skipped. With "rstool curtain", the campaign dataset is interpolated linearly on a regular time axis with a time step STEP and written to OUTPUT as a time-pressure curtain. Times between profiles more than 1 day apart are filled with missing values.
+
+Stats mode:
+
+  In the stats mode ("rstool stats"), rstool calculates statistics of profiles in the "prof", "prof:segments" or campaign INPUT files, grouped by GROUP, and writes them to OUTPUT (NetCDF). The files are read one at a time (campaign and prof:segments files in slices of 1000 profiles), and the statistics are accumulated in streaming accumulators, so the memory used does not depend on the number of profiles. The profiles are regridded on the pressure grid of campaign datasets. For every variable VAR (ta, hur, ua, va, theta and w), the output contains the number of values (VAR_count), mean (VAR_mean), standard deviation (VAR_std), minimum (VAR_min), maximum (VAR_max) and the 5%, 25%, 50%, 75% and 95% quantiles estimated from a histogram with fixed bins (VAR_quantile). The variables are on the dimensions "group" and "p" ("group", "quantile" and "p" for VAR_quantile).
+
+Verify mode:
+
+  In the verify mode ("rstool verify"), rstool checks that the optimized code paths give the same results as the reference implementations on N random synthetic inputs. The cases are: "prof" (calculation of profiles), "chunks" (calculation of profiles in chunks), "grid" (binning and interpolation on vertical grids), "ws" (Windsond latitude and longitude reconstruction), "merge" (merging of Windsond files), "simplify" (selection of significant levels of prof:wmo), "postprocess" (calculation of derived variables), "solvers" (dew point temperature and condensation pressure solvers of the numba backend), "parcel" (parcel temperature from the table of pseudo-adiabats), "cape" (CAPE, CIN, level of free convection and equilibrium level), "binning" (pressure binning of the numba backend), "turns" (segmentation of prof:segments with the numpy and numba backends), "backend" (conversion with the numpy and numba backends, only if numba is installed) and "float32" (conversion in double and single precision). For every case and variable, a JSON object is written on a line with the keys "case", "var", "max_abs" (maximum absolute difference), "max_rel" (maximum relative difference), "n_fail" (number of values outside of the tolerance), "n_valid" (number of values compared), "rtol" and "atol" (relative and absolute tolerance) and "status" ("ok", "fail" or "skipped", if no values are present in both outputs). The exit status is 1 if any case fails. The tolerances can be configured in the Python function rstool.verify.verify.
 '''
 
 import sys
@@ -46,15 +111,19 @@ signal.signal(signal.SIGINT, lambda signal, frame: sys.exit(0))
 
 __version__ = '2.0.0'
 
+import os
+import json
 import datetime as dt
 import numpy as np
+import netCDF4
 import ds_format as ds
+from ds_format.drivers import netcdf
 import aquarius_time as aq
 
 import rstool
 from rstool.drivers import DRIVERS
-from rstool.headers import HEADER_PTS, HEADER_PROF
-from rstool import postprocess, prof
+from rstool import postprocess, prof, prof_segments, prof_wmo, columns, \
+	ensemble, precision
 
 def get_driver(name):
 	try:
@@ -63,50 +132,137 @@ def get_driver(name):
 		raise ValueError('%s: unknown input type' % name)
 	return drv
 
-def main2(input_type, output_type, input_, output, surf=None):
+def read_dataset(input_):
+	'''Read a dataset from input_, which is a dataset (dict), a NetCDF file
+	name, or the content of a NetCDF file as bytes or a binary file object
+	(read in memory).'''
+	if isinstance(input_, dict):
+		return dict(input_)
+	if hasattr(input_, 'read'):
+		input_ = input_.read()
+	if not isinstance(input_, (bytes, bytearray)):
+		return ds.read(input_)
+	if not bytes(input_[:4]).startswith((b'CDF', b'\x89HDF')):
+		raise ValueError('input is not a NetCDF file')
+	d = {}
+	with netCDF4.Dataset('memory', memory=bytes(input_)) as f:
+		ds.attrs(d, None, netcdf.read_attrs(f))
+		for var in f.variables.keys():
+			x, meta = netcdf.read_var(f, var)
+			ds.var(d, var, x)
+			ds.meta(d, var, meta)
+	return d
+
+def split_text_format(output_type):
+	'''Split output type output_type into the output type and the text format
+	(see rstool.drivers.text.FORMATS) if it ends with ":csv" or ":jsonl".
+	Returns a tuple of the output type and the text format (None if not a
+	text output type).'''
+	base, _, fmt = output_type.rpartition(':')
+	if base not in ('', 'pts:npy') and fmt in rstool.drivers.text.FORMATS:
+		return base, fmt
+	return output_type, None
+
+def read_input(input_type, input_):
+	'''Read input input_ of input type input_type. Returns a tuple of the
+	driver and the im, pts and prof datasets (None if not available).'''
+	drv = None
 	d_im = None
 	d_pts = None
 	d_prof = None
-	d_prof_desc = None
-	d_surf = None
-	desc = False
-
-	not_supported_msg = 'input or output type not supported'
-
 	if input_type.startswith('im:'):
 		name = input_type[(input_type.index(':')+1):]
 		drv = get_driver(name)
-		d_im = ds.read(input_)
+		d_im = read_dataset(input_)
 	elif input_type == 'pts':
-		d_pts = ds.read(input_)
+		d_pts = read_dataset(input_)
+	elif input_type == 'pts:npy':
+		d_pts = rstool.drivers.npy.read(input_)
 	elif input_type == 'prof':
-		d_prof = ds.read(input_)
-		d_prof['.'] = HEADER_PROF
+		d_prof = read_dataset(input_)
+		d_prof['.'] = columns.prof_header(d_prof.get('.', {}))
 	else:
 		drv = get_driver(input_type)
 		if hasattr(drv, 'read'):
 			d_im = drv.read(input_)
+	return drv, d_im, d_pts, d_prof
+
+def postprocess_ensemble(d, members):
+	'''Postprocess single-column profile d and add the ensemble mean and
+	standard deviation of derived variables of an ensemble with members
+	members (see rstool.ensemble) if members is greater than 0.'''
+	base = dict(d)
+	postprocess(d)
+	if members > 0:
+		res = ensemble.ensemble(base, d, members)
+		d['.'] = dict(d['.'], **res.pop('.'))
+		d.update(res)
+
+def surface_time(d):
+	'''Return the time of the first level with a valid time in profile
+	dataset d, at which near-surface variables are selected.'''
+	t = np.ma.filled(np.ravel(d['time']).astype(np.float64), np.nan)
+	valid = np.isfinite(t)
+	return t[np.argmax(valid)] if len(t) > 0 else np.nan
+
+def process(output_type, drv=None, d_im=None, d_pts=None, d_prof=None,
+	surf=None, jobs=None, grid=None, members=None):
+	d_prof_desc = None
+	d_prof_seg = None
+	d_prof_wmo = None
+	d_prof_full = None
+	d_surf = None
+
+	not_supported_msg = 'input or output type not supported'
+	output_type = split_text_format(output_type)[0]
+	members = ensemble.ensemble_size(members)
 
 	if d_pts is None and d_im is not None and hasattr(drv, 'pts'):
 		d_pts = drv.pts(d_im)
 
+	for d in [d_pts, d_prof]:
+		if d is not None:
+			precision.cast(d)
+
 	if d_prof is None and d_pts is not None:
-		d_prof = prof(d_pts)
-		d_prof_desc = prof(d_pts, desc=True)
+		# Calculate only the profile needed by the output type. The WMO
+		# levels are selected from the full-resolution profile.
+		if output_type == 'prof':
+			d_prof = prof(d_pts, grid=grid)
+		elif output_type == 'prof:desc':
+			d_prof_desc = prof(d_pts, desc=True, grid=grid)
+		elif output_type == 'prof:segments':
+			d_prof_seg = prof_segments(d_pts, grid=grid)
+		elif output_type == 'prof:wmo':
+			d_prof_full = prof(d_pts, grid=grid)
+			d_prof_wmo = prof_wmo(d_pts, grid=grid, full=d_prof_full)
 
-	if d_prof is not None and surf is not None:
+	profs = [x for x in [d_prof, d_prof_seg, d_prof_wmo] if x is not None]
+	if len(profs) > 0 and surf is not None:
 		drv = rstool.drivers.surf
-		d_surf = drv.read(surf, d_prof['time'][0])
+		time = surface_time(profs[0] if d_prof_full is None else d_prof_full)
+		d_surf = drv.read(surf, time)
 		if d_surf is not None:
+			precision.cast(d_surf)
 			for k, v in d_surf.items():
 				if k != '.':
-					d_prof[k] = d_surf[k]
+					for x in profs:
+						x[k] = d_surf[k]
 
 	if d_prof is not None:
-		postprocess(d_prof)
+		if columns.column_dim(d_prof['.']) is not None:
+			columns.postprocess(d_prof, jobs)
+		else:
+			postprocess_ensemble(d_prof, members)
 
 	if d_prof_desc is not None:
-		postprocess(d_prof_desc)
+		postprocess_ensemble(d_prof_desc, members)
+
+	if d_prof_seg is not None:
+		columns.postprocess(d_prof_seg, jobs)
+
+	if d_prof_wmo is not None:
+		postprocess_ensemble(d_prof_wmo, members)
 
 	if output_type == 'prof':
 		if d_prof is None:
@@ -116,7 +272,15 @@ def main2(input_type, output_type, input_, output, surf=None):
 		if d_prof_desc is None:
 			raise ValueError(not_supported_msg)
 		d = d_prof_desc
-	elif output_type == 'pts':
+	elif output_type == 'prof:segments':
+		if d_prof_seg is None:
+			raise ValueError(not_supported_msg)
+		d = d_prof_seg
+	elif output_type == 'prof:wmo':
+		if d_prof_wmo is None:
+			raise ValueError(not_supported_msg)
+		d = d_prof_wmo
+	elif output_type in ('pts', 'pts:npy'):
 		if d_pts is None:
 			raise ValueError(not_supported_msg)
 		d = d_pts
@@ -127,16 +291,119 @@ def main2(input_type, output_type, input_, output, surf=None):
 	else:
 		raise ValueError(not_supported_msg)
 
-	d['.'] = d.get('.', {})
-	d['.']['.'] = d['.'].get('.', {})
+	d = dict(d)
+	if output_type != 'im':
+		precision.cast(d)
+	d['.'] = dict(d.get('.', {}))
+	d['.']['.'] = dict(d['.'].get('.', {}))
 	d['.']['.'].update({
 		'software': 'rstool ' + __version__ + \
 			' (https://github.com/peterkuma/rstool)',
 		'created': aq.to_iso(aq.from_datetime(dt.datetime.utcnow())),
 	})
-	ds.write(output, d)
+	return d
+
+def convert(input_type, output_type, input_, surf=None, jobs=None,
+	grid=None, members=None):
+	'''Convert input input_ of input type input_type to output type
+	output_type (see Input types and Output types in the rstool
+	documentation) without writing any files. input_ can be a file name, or
+	the content of the file as a binary file object or bytes (NetCDF for the
+	im:INSTRUMENT, pts and prof input types, read in memory), or a dataset
+	(dict) for the im:INSTRUMENT, pts and prof input types. For the pts:npy
+	input type, input_ is a directory name. surf is an optional near-surface dataset (dict)
+	or file name. jobs is the number of worker processes for multi-column
+	profile datasets (see rstool.columns.postprocess). grid is the vertical
+	grid specification of profiles (see rstool.prof). members is the number
+	of members of an uncertainty ensemble (see rstool.ensemble). Returns the
+	output dataset (dict), or a dictionary of sonde labels and output
+	datasets for the INSTRUMENT:split input types.'''
+	if input_type.endswith(':split'):
+		name = input_type[:input_type.index(':')]
+		drv = get_driver(name)
+		if not hasattr(drv, 'split'):
+			raise ValueError('%s: splitting not supported' % name)
+		return {
+			label: process(output_type, drv, d_im=d_im, surf=surf, grid=grid,
+				members=members)
+			for label, d_im in drv.read(input_, split_sondes=True).items()
+		}
+	drv, d_im, d_pts, d_prof = read_input(input_type, input_)
+	return process(output_type, drv, d_im=d_im, d_pts=d_pts, d_prof=d_prof,
+		surf=surf, jobs=jobs, grid=grid, members=members)
+
+def write(output_type, output, d):
+	fmt = split_text_format(output_type)[1]
+	if fmt is not None:
+		rstool.drivers.text.write(output, d, fmt)
+	elif output_type == 'pts:npy':
+		rstool.drivers.npy.write(output, d)
+	else:
+		ds.write(output, d)
+
+def main2(input_type, output_type, input_, output, surf=None):
+	d = convert(input_type, output_type, input_, surf=surf)
+	if input_type.endswith(':split'):
+		root, ext = os.path.splitext(output)
+		for label, d1 in d.items():
+			write(output_type,
+				output if output == '-' else root + '_' + label + ext, d1)
+	else:
+		write(output_type, output, d)
 
 def main():
+	if len(sys.argv) in [2, 3, 4] and sys.argv[1] == 'server':
+		from rstool.server import serve
+		socket = sys.argv[2] if len(sys.argv) > 2 else '-'
+		jobs = int(sys.argv[3]) if len(sys.argv) > 3 else None
+		serve(None if socket == '-' else socket, jobs)
+		return
+
+	if len(sys.argv) in [5, 6] and sys.argv[1] == 'watch':
+		from rstool.watch import watch
+		np.seterr(all='ignore')
+		jobs = int(sys.argv[5]) if len(sys.argv) > 5 else None
+		watch(sys.argv[2], sys.argv[3], sys.argv[4], jobs)
+		return
+
+	if len(sys.argv) in [6, 7] and sys.argv[1] == 'batch':
+		from rstool.batch import batch
+		np.seterr(all='ignore')
+		surf = sys.argv[5] if len(sys.argv) == 7 else None
+		batch(sys.argv[2], sys.argv[3], sys.argv[4], sys.argv[-1], surf)
+		return
+
+	if len(sys.argv) >= 4 and sys.argv[1] == 'campaign':
+		from rstool.campaign import append
+		np.seterr(all='ignore')
+		for input_ in sys.argv[3:]:
+			append(sys.argv[2], ds.read(input_))
+		return
+
+	if len(sys.argv) in [4, 5] and sys.argv[1] == 'curtain':
+		from rstool.campaign import curtain
+		np.seterr(all='ignore')
+		step = float(sys.argv[4]) if len(sys.argv) > 4 else 3600.
+		ds.write(sys.argv[3], curtain(ds.read(sys.argv[2]), step))
+		return
+
+	if len(sys.argv) >= 5 and sys.argv[1] == 'stats':
+		from rstool.stats import stats
+		np.seterr(all='ignore')
+		ds.write(sys.argv[3], stats(sys.argv[4:], sys.argv[2]))
+		return
+
+	if len(sys.argv) in [2, 3] and sys.argv[1] == 'verify':
+		from rstool.verify import verify
+		np.seterr(all='ignore')
+		n = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+		results = verify(n)
+		for res in results:
+			sys.stdout.write(json.dumps(res) + '\n')
+		if any([res['status'] == 'fail' for res in results]):
+			sys.exit(1)
+		return
+
 	if len(sys.argv) not in [5, 6]:
 		sys.stderr.write(sys.modules[__name__].__doc__)
 		sys.exit(1)
@@ -1,9 +1,13 @@
 from rstool.algorithms import *
+from rstool.precision import cast_var
 
 DEPS = [
 	[['p_bvf', 'zg_bvf', 'bvf'], ['thetav', 'zg', 'p', 'g'], calc_bvf],
+	[['cape', 'cin', 'plfc', 'pel'], ['p', 'tvpar', 'tv', 'ps', 'pc'],
+		calc_cape],
 	['e', ['p', 'w'], calc_e],
 	['e', 'td', calc_esat, 'ta'],
+	['el', ['pel', 'p', 'zg'], calc_zg, ['p1', 'p', 'zg']],
 	['es', ['ps', 'ws'], calc_e, ['p', 'w']],
 	['es', 'tds', calc_esat, 'ta'],
 	['esat', 'ta', calc_esat],
@@ -17,6 +21,7 @@ DEPS = [
 	['huss', 'ws', calc_hus, 'w'],
 	['lcl', ['pc', 'p', 'zg'], calc_zg, ['p1', 'p', 'zg']],
 	['lcls', ['pcs', 'p', 'zg'], calc_zg, ['p1', 'p', 'zg']],
+	['lfc', ['plfc', 'p', 'zg'], calc_zg, ['p1', 'p', 'zg']],
 	['lts', ['p', 'theta', 'thetas'], calc_lts],
 	['pc', ['ps', 'ws', 'tas'], calc_pc],
 	['pcs', ['ps', 'ws', 'ts'], calc_pc, ['ps', 'ws', 'tas']],
@@ -26,9 +31,11 @@ DEPS = [
 	['rhos', ['rhods', 'rhows'], calc_rho, ['rhod', 'rhow']],
 	['rhow', ['p', 'e', 'ta'], calc_rhow],
 	['rhows', ['ps', 'es', 'tas'], calc_rhow, ['p', 'e', 'ta']],
+	['tapar', ['p', 'ps', 'tas', 'pc'], calc_tapar],
 	['td', 'e', calc_td],
 	['tds', 'es', calc_td, 'e'],
 	['tv', ['ta', 'w'], calc_tv],
+	['tvpar', ['tapar', 'wpar'], calc_tv, ['ta', 'w']],
 	['tvs', ['tas', 'ws'], calc_tv, ['ta', 'w']],
 	['theta', ['p', 'ta'], calc_theta],
 	['thetas', ['ps', 'tas'], calc_theta, ['p', 'ta']],
@@ -41,6 +48,7 @@ DEPS = [
 	['w', 'hus', calc_w],
 	['w', ['hur', 'wsat'], calc_w],
 	['w', ['p', 'e'], calc_w],
+	['wpar', ['p', 'tapar', 'ws'], calc_wpar],
 	['wdd', ['ua', 'va'], calc_wdd],
 	['wdds', ['uas', 'vas'], calc_wdd, ['ua', 'va']],
 	['wds', ['ua', 'va'], calc_wds],
@@ -54,7 +62,9 @@ DEPS = [
 	['zg', ['z', 'g'], calc_zg],
 ]
 
-def postprocess_target(d, target, chain=[]):
+def postprocess_target(d, target, chain=[], computed=None):
+	# Calculate target in dataset d, and its sources recursively if missing.
+	# The variables calculated are added to the set computed (if not None).
 	for rec in DEPS:
 		if len(rec) == 4:
 			target1, source, func, map_ = rec
@@ -75,7 +85,8 @@ def postprocess_target(d, target, chain=[]):
 						#print('in chain')
 						break
 					#print('-> %s' % s)
-					if not postprocess_target(d, s, chain + [target]):
+					if not postprocess_target(d, s, chain + [target],
+						computed):
 						break
 			else:
 				if map_ is not None:
@@ -86,26 +97,62 @@ def postprocess_target(d, target, chain=[]):
 					res = (res,)
 				for t, x in zip(target1, res):
 					#print('setting %s to %s' % (t, x))
-					d[t] = x
+					d[t] = cast_var(t, x)
+				if computed is not None:
+					computed.update(target1)
 				return True
 	#print('not found')
 	return False
 
-def postprocess(d):
+THERMO_SOURCES = ['w', 'hus', 'hur', 'e', 'td']
+
+THERMO_TARGETS = ['esat', 'wsat', 'w', 'e', 'hur', 'hus', 'tv', 'theta',
+	'thetav', 'rhod', 'rhow', 'rho', 'gammam']
+
+def postprocess_thermo(d):
+	'''Calculate the core moist thermodynamic variables (THERMO_TARGETS) in
+	dataset d at once with calc_thermo, if d contains air pressure, air
+	temperature and at most one humidity variable (THERMO_SOURCES), and none
+	of the targets otherwise. Returns a list of variables which need not be
+	calculated by postprocess_target.'''
+	sources = [k for k in THERMO_SOURCES if k in d]
+	if 'p' not in d or 'ta' not in d or len(sources) > 1 or \
+		any([k in d for k in THERMO_TARGETS if k not in sources]):
+		return []
+	postprocess_target(d, 'gammad')
+	# Masked values (such as in profiles read from NetCDF) are filled with
+	# NaN.
+	kwargs = {
+		k: np.ma.filled(d[k], np.nan) if isinstance(d[k], np.ma.MaskedArray)
+			else d[k]
+		for k in ['p', 'ta', 'gammad'] + sources if k in d
+	}
+	res = calc_thermo(**kwargs)
+	d.update(res)
+	return list(res.keys()) + sources
+
+def postprocess(d, fused=True):
 	'''Postprocess profile (prof) dataset d by calculating derived
-	variables.'''
+	variables. If fused is False, do not use calc_thermo (see
+	postprocess_thermo).'''
 	rm_station_lat = 'station_lat' not in d
 	tmp_station_lat = 'station_lat' not in d or np.isnan(d['station_lat'])
 	if tmp_station_lat:
 		# Use a temporary latitude of 45 degrees for g calculation, but remove
 		# the variable when done.
 		d['station_lat'] = 45
+	# Variables already calculated in this call are not calculated again
+	# (such as the other targets of a function with multiple targets, or
+	# sources of a previous target). Variables present in d on input are
+	# recalculated.
+	computed = set(postprocess_thermo(d) if fused else [])
 	for rec in DEPS:
 		target, source, func = rec[:3]
 		if not isinstance(target, list):
 			target = [target]
 		for t in target:
-			postprocess_target(d, t)
+			if t not in computed:
+				postprocess_target(d, t, computed=computed)
 	if rm_station_lat:
 		del d['station_lat']
 	elif tmp_station_lat:
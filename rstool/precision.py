@@ -0,0 +1,66 @@
+import os
+import numpy as np
+
+# Floating-point precision of the calculations. By default, points, profiles
+# and derived variables are stored and calculated in double precision
+# (float64). In single precision mode (float32), selected with set_dtype or
+# the environment variable RSTOOL_DTYPE ("float64" or "float32"), they are
+# stored and calculated in float32, which halves memory use and memory
+# bandwidth. Variables which need double precision (FLOAT64_VARS) are kept in
+# float64, and sums of binned points are accumulated in float64 before they
+# are converted. Memory-mapped arrays (the pts:npy input type) are left as
+# they are, as they are read in chunks.
+
+DTYPES = ['float64', 'float32']
+
+# Variables kept in float64 in single precision mode. Julian dates need
+# double precision to resolve seconds, and the winds are calculated from
+# differences of the coordinates of points.
+FLOAT64_VARS = ['time', 'station_time', 'profile_time', 'lat', 'lon']
+
+dtype = None
+
+def set_dtype(name=None):
+	'''Set the floating-point type of the calculations to name ("float64" or
+	"float32"), or to the default (float64, unless overriden by the
+	environment variable RSTOOL_DTYPE) if name is None.'''
+	global dtype
+	if name is not None and name not in DTYPES:
+		raise ValueError('%s: unknown dtype' % name)
+	dtype = name
+
+def get_dtype():
+	'''Return the name of the floating-point type in use.'''
+	if dtype is not None:
+		return dtype
+	name = os.environ.get('RSTOOL_DTYPE')
+	if name is not None:
+		set_dtype(name)
+		return name
+	return 'float64'
+
+def var_dtype(var):
+	'''Return the floating-point type (numpy dtype) of variable var.'''
+	return np.dtype(np.float64 if var in FLOAT64_VARS else get_dtype())
+
+def cast_var(var, x):
+	'''Return value x of variable var converted to the floating-point type in
+	use if it is a floating-point array or number, or x otherwise.'''
+	if get_dtype() == 'float64' or \
+		var in FLOAT64_VARS or \
+		isinstance(x, np.memmap):
+		return x
+	if isinstance(x, (float, np.floating)):
+		return np.float32(x)
+	if isinstance(x, np.ndarray) and x.dtype == np.float64:
+		return x.astype(np.float32)
+	return x
+
+def cast(d):
+	'''Convert floating-point variables of dataset d (dict) in place to the
+	floating-point type in use (see cast_var).'''
+	if get_dtype() == 'float64':
+		return
+	for var, x in d.items():
+		if var != '.':
+			d[var] = cast_var(var, x)
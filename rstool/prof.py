@@ -1,7 +1,11 @@
+import os
 import numpy as np
 from numpy import ma
 from pyproj import Geod
-from rstool.headers import HEADER_PROF
+from rstool.headers import HEADER_PROF, dataset_header
+from rstool.accel import bin_add, turns
+from rstool.algorithms import calc_g, calc_zg
+from rstool.precision import cast
 
 VARS = [
 	'z',
@@ -12,69 +16,426 @@ VARS = [
 	'time',
 ]
 
-def prof(d, pres=5e2, desc=False):
+STATION_VARS = [
+	'tas',
+	'hurs',
+	'ps',
+	'uas',
+	'vas',
+	'station_lat',
+	'station_lon',
+	'station_time',
+	'station_z'
+]
+
+# Maximum number of points binned at a time. Long points series (such as
+# multi-day tethered balloon or UAV flights) are binned in chunks of this size,
+# so that the memory used by temporary arrays is bounded. Memory-mapped points
+# (pts:npy) are read one chunk at a time.
+CHUNK_SIZE = 1000000
+
+# Pressure change (Pa) by which the direction of the radiosonde has to be
+# reversed to start a new segment in prof_segments.
+HYSTERESIS = 2e3
+
+# Vertical coordinates of the grid (see parse_grid). The values are functions
+# returning the coordinate of points j0 to j1 (exclusive) of points d, and the
+# direction of the coordinate (-1 if decreasing with height). Levels of the
+# "lnp" coordinate are given in Pa, but the grid is regular and interpolation
+# is linear in the logarithm of pressure.
+COORDS = {
+	'p': (lambda d, j0, j1: filled(d['p'][j0:j1]), -1),
+	'lnp': (lambda d, j0, j1: log(filled(d['p'][j0:j1])), -1),
+	'z': (lambda d, j0, j1: filled(d['z'][j0:j1]), 1),
+	'zg': (lambda d, j0, j1: calc_zg(z=filled(d['z'][j0:j1]),
+		g=calc_g(lat=filled(d['lat'][j0:j1]))), 1),
+}
+
+# Methods of calculation of the variables on the levels: bin averaging
+# ("bin") or linear interpolation between consecutive points ("interp").
+METHODS = ['bin', 'interp']
+
+def filled(x):
+	return np.asarray(np.ma.filled(x, np.nan), np.float64)
+
+def log(x):
+	return np.log(np.where(x > 0, x, np.nan))
+
+# WMO mandatory pressure levels (Pa) of prof_wmo.
+MANDATORY = np.array([
+	1000, 925, 850, 700, 500, 400, 300, 250, 200, 150, 100, 70, 50, 30, 20,
+	10, 7, 5, 3, 2, 1,
+])*1e2
+
+# Criteria for significant levels of prof_wmo by type: variables and the
+# maximum deviation from linear interpolation in the logarithm of pressure
+# between the significant levels. The deviation of multiple variables is the
+# Euclidean norm of their deviations (such as the wind vector).
+SIGNIFICANT = {
+	'temperature': (['ta'], 1.),
+	'humidity': (['hur'], 15.),
+	'wind': (['ua', 'va'], 5.),
+}
+
+# Flags of level types in the variable level_type of prof_wmo.
+LEVEL_TYPES = {
+	'surface': 1,
+	'mandatory': 2,
+	'temperature': 4,
+	'humidity': 8,
+	'wind': 16,
+}
+
+def chunks(n, chunk):
+	return [(j, min(j + chunk, n)) for j in range(0, n, chunk)]
+
+def parse_grid(spec):
+	'''Parse vertical grid specification spec (str) of the form
+	COORD:LEVELS[:METHOD], where COORD is a key in COORDS, LEVELS is a
+	resolution (a number), comma-separated levels or "@" followed by the name
+	of a text file containing levels, and METHOD is one of METHODS (default:
+	"bin"). Returns a tuple of COORD, the resolution (float) or levels (array)
+	and METHOD.'''
+	parts = spec.split(':')
+	if len(parts) not in (2, 3) or parts[0] not in COORDS or \
+		(len(parts) == 3 and parts[2] not in METHODS):
+		raise ValueError('%s: invalid grid specification' % spec)
+	method = parts[2] if len(parts) == 3 else 'bin'
+	if parts[1].startswith('@'):
+		levels = np.loadtxt(parts[1][1:], np.float64, ndmin=1).ravel()
+	elif ',' in parts[1]:
+		levels = np.array(parts[1].split(','), np.float64)
+	else:
+		levels = float(parts[1])
+	return parts[0], levels, method
+
+def vertical_grid(d, spec, chunk):
+	# Levels of the vertical grid specified by spec (a tuple as returned by
+	# parse_grid), as a dictionary of the coordinate, direction and method,
+	# and the full and half levels of the coordinate ordered from the lowest
+	# level. A regular grid covers all points, with half levels at multiples
+	# of the resolution.
+	coord, levels, method = spec
+	f, sign = COORDS[coord]
+	if np.ndim(levels) == 0:
+		res = levels
+		cmin, cmax = np.nan, np.nan
+		for j0, j1 in chunks(len(d['p']), chunk):
+			c = f(d, j0, j1)
+			cmin = np.fmin(cmin, np.fmin.reduce(c))
+			cmax = np.fmax(cmax, np.fmax.reduce(c))
+		# Integer multiples, as a floating-point range can have an extra
+		# level due to rounding.
+		k = np.arange(np.floor(cmin/res), np.ceil(cmax/res) + 1)
+		half = (k*res)[::sign]
+		full = 0.5*(half[1:] + half[:-1])
+	else:
+		full = np.asarray(levels, np.float64)
+		if coord == 'lnp':
+			full = np.log(full)
+		full = np.unique(full)[::sign]
+		if len(full) < 2:
+			raise ValueError('at least two levels are required')
+		mid = 0.5*(full[1:] + full[:-1])
+		half = np.concatenate([
+			[1.5*full[0] - 0.5*full[1]],
+			mid,
+			[1.5*full[-1] - 0.5*full[-2]],
+		])
+	return {
+		'coord': coord,
+		'sign': sign,
+		'method': method,
+		'full': full,
+		'half': half,
+	}
+
+def levels(g):
+	# Variables of the vertical coordinate on the levels of grid g.
+	if g['coord'] == 'p':
+		return {'p': g['full']}
+	elif g['coord'] == 'lnp':
+		return {'p': np.exp(g['full'])}
+	else:
+		return {g['coord']: g['full']}
+
+def bin_points(d, g, select, m, chunk):
+	# Mean of VARS in m groups of levels of grid g. select(j0, j1, p) returns
+	# a mask of points j0 to j1 (exclusive) to include and their group. p is
+	# the pressure of points j0 to j1 and the next point (if any). Sums and
+	# counts on every level are accumulated over the chunks. The arrays in d
+	# are only read, so they can be memory-mapped.
+	f, sign = COORDS[g['coord']]
+	n = len(g['full'])
+	vars = VARS + ([] if g['coord'] in ('p', 'lnp') else ['p'])
+	total = {var: np.zeros(m*n, np.float64) for var in vars}
+	count = {var: np.zeros(m*n, np.int64) for var in vars}
+	# Coordinate increasing with height.
+	half = sign*g['half']
+	full = sign*g['full']
+	for j0, j1 in chunks(len(d['p']), chunk):
+		p = d['p'][j0:(j1 + 1)]
+		mask, group = select(j0, j1, p)
+		j2 = j0 + len(p)
+		c = sign*f(d, j0, j2)
+		if g['method'] == 'bin':
+			# Index of the level interval [half[i], half[i + 1]) of each
+			# point.
+			k = np.searchsorted(half, c[:(j1 - j0)], side='right') - 1
+			mask = mask & (k >= 0) & (k < n)
+			i = k[mask] + n*group[mask]
+			for var in vars:
+				x = filled(d[var][j0:j1])[mask]
+				bin_add(i, x, total[var], count[var])
+		else:
+			# Levels in [min(c0, c1), max(c0, c1)) between every included
+			# point (c0) and the next point (c1), interpolated linearly.
+			c0 = c[:(j2 - j0 - 1)]
+			c1 = c[1:]
+			mask = mask[:len(c0)] & np.isfinite(c0) & np.isfinite(c1) & \
+				(c0 != c1)
+			a = np.nonzero(mask)[0]
+			lo = np.fmin(c0[a], c1[a])
+			hi = np.fmax(c0[a], c1[a])
+			k0 = np.searchsorted(full, lo, side='left')
+			k1 = np.searchsorted(full, hi, side='left')
+			nk = k1 - k0
+			a = np.repeat(a, nk)
+			k = np.repeat(k0, nk) + np.arange(len(a)) - \
+				np.repeat(np.cumsum(nk) - nk, nk)
+			w = (full[k] - c0[a])/(c1[a] - c0[a])
+			i = k + n*group[a]
+			for var in vars:
+				x = filled(d[var][j0:j2])
+				bin_add(i, x[a] + w*(x[a + 1] - x[a]), total[var], count[var])
+	out = {}
+	for var in vars:
+		out[var] = np.full(m*n, np.nan, np.float64)
+		valid = count[var] > 0
+		out[var][valid] = total[var][valid]/count[var][valid]
+		out[var] = out[var].reshape(m, n)
+	for var, x in levels(g).items():
+		out[var] = np.tile(x, (m, 1))
+	return out
+
+def grid_spec(grid, pres):
+	# Grid specification from grid (str, tuple or None) and pressure
+	# resolution pres.
+	if grid is None:
+		grid = os.environ.get('RSTOOL_GRID')
+	if grid is None:
+		return ('p', pres, 'bin')
+	if isinstance(grid, str):
+		return parse_grid(grid)
+	return tuple(grid)
+
+def winds(lat, lon, time):
+	# Eastward and northward wind from the displacement between levels.
+	n = len(lat)
+	ua = np.full(n, np.nan, np.float64)
+	va = np.full(n, np.nan, np.float64)
+	geod = Geod(ellps='WGS84')
+	for i in range(1, n):
+		az, _, dst = geod.inv(lon[i - 1], lat[i - 1], lon[i], lat[i])
+		dt = (time[i] - time[i - 1])*24.*60.*60.
+		if dt > 0.:
+			ua[i] = dst/dt*np.sin(az/180.*np.pi)
+			va[i] = dst/dt*np.cos(az/180.*np.pi)
+	return ua, va
+
+def prof(d, pres=5e2, desc=False, chunk=CHUNK_SIZE, grid=None):
 	'''Calculate profile (prof) from points (pts).
 
 	d - Points (pts) dataset (dict).
 	pres - Pressure resolution (float).
 	desc - Descending profile (bool).
+	chunk - Maximum number of points binned at a time (int).
+	grid - Vertical grid specification (str, see parse_grid) or a tuple as
+		returned by parse_grid. Default: the environment variable
+		RSTOOL_GRID or a regular pressure grid with resolution pres.
 	'''
-	pmin, pmax = np.nanmin(d['p']), np.nanmax(d['p'])
-	phalf_min = np.floor(pmin/pres)*pres
-	phalf_max = np.ceil(pmax/pres)*pres
-	phalf = np.arange(phalf_min, phalf_max + pres, pres)[::-1]
-	pfull = 0.5*(phalf[1:] + phalf[:-1])
-	n = len(phalf) - 1
-	prof = {}
-	for var in VARS:
-		prof[var] = np.full(n, np.nan, np.float64)
-
-	if desc:
-		mask1 = np.array(
-			list(~(np.diff(d['p']) < 0.)) + [True],
-			bool
-		)
-	else:
-		mask1 = np.array(
-			list(~(np.diff(d['p']) > 0.)) + [True],
-			bool
-		)
-	for i in range(n):
-		p1 = phalf[i]
-		p2 = phalf[i + 1]
-		for var in VARS:
-			mask2 = (d['p'] > p2) & (d['p'] <= p1)
-			mask = mask1 & mask2
-			if np.sum(mask) > 0 and np.any(~np.isnan(d[var][mask])):
-				prof[var][i] = np.nanmean(d[var][mask])
-
-	prof['p'] = pfull
-	prof['ua'] = np.full(n, np.nan, np.float64)
-	prof['va'] = np.full(n, np.nan, np.float64)
-	geod = Geod(ellps='WGS84')
-	for i in range(1, n):
-		az, _, dst = geod.inv(
-			prof['lon'][i - 1],
-			prof['lat'][i - 1],
-			prof['lon'][i],
-			prof['lat'][i],
-		)
-		dt = (prof['time'][i] - prof['time'][i - 1])*24.*60.*60.
-		if dt > 0.:
-			prof['ua'][i] = dst/dt*np.sin(az/180.*np.pi)
-			prof['va'][i] = dst/dt*np.cos(az/180.*np.pi)
-	for var in [
-		'tas',
-		'hurs',
-		'ps',
-		'uas',
-		'vas',
-		'station_lat',
-		'station_lon',
-		'station_time',
-		'station_z'
-	]:
+	g = vertical_grid(d, grid_spec(grid, pres), chunk)
+
+	def select(j0, j1, p):
+		# Points are included if the next point (in the next chunk for the
+		# last point of the chunk) is not at a lower (ascending) or higher
+		# (descending) pressure.
+		if desc:
+			mask1 = np.append(~(np.diff(p) < 0.), True)[:(j1 - j0)]
+		else:
+			mask1 = np.append(~(np.diff(p) > 0.), True)[:(j1 - j0)]
+		return mask1, np.zeros(j1 - j0, np.int64)
+
+	prof = {
+		var: x[0]
+		for var, x in bin_points(d, g, select, 1, chunk).items()
+	}
+	prof['ua'], prof['va'] = winds(prof['lat'], prof['lon'], prof['time'])
+	for var in STATION_VARS:
 		prof[var] = d[var] if var in d else np.nan
-	prof['.'] = HEADER_PROF
-	prof['.']['.'] = d['.'].get('.', {})
+	cast(prof)
+	prof['.'] = dataset_header(HEADER_PROF, d['.'].get('.', {}))
 	return prof
+
+def segments(p, hysteresis=HYSTERESIS, chunk=CHUNK_SIZE):
+	'''Split pressure p into segments of ascent or descent. The direction
+	changes when the pressure is reversed by more than hysteresis (Pa).
+	Returns a tuple of an array of the indices at which segments 1, 2, ...
+	start and an array of directions of the segments (True if descending).'''
+	state = np.array([0, np.nan, 0, np.nan, 0], np.float64)
+	start = [np.zeros(0, np.int64)]
+	for j0, j1 in chunks(len(p), chunk):
+		start += [turns(np.ma.filled(p[j0:j1], np.nan), hysteresis, j0,
+			state)]
+	start = np.concatenate(start)
+	# The direction of the last segment is known from the state. If the
+	# direction was never determined, the only segment is an ascent.
+	last = state[0] > 0
+	desc = np.array([
+		last if (len(start) - i) % 2 == 0 else not last
+		for i in range(len(start) + 1)
+	], bool)
+	return start, desc
+
+def prof_segments(d, pres=5e2, hysteresis=HYSTERESIS, chunk=CHUNK_SIZE,
+	grid=None):
+	'''Calculate profiles (prof) of all ascents and descents in points (pts).
+	The variables of the segments are on a profile dimension ("profile").
+
+	d - Points (pts) dataset (dict).
+	pres - Pressure resolution (float).
+	hysteresis - Pressure change by which the direction has to be reversed
+		to start a new segment (float).
+	chunk - Maximum number of points binned at a time (int).
+	grid - Vertical grid specification (see prof).
+	'''
+	start, desc = segments(d['p'], hysteresis, chunk)
+	m = len(desc)
+	g = vertical_grid(d, grid_spec(grid, pres), chunk)
+	n = len(g['full'])
+
+	def select(j0, j1, p):
+		group = np.searchsorted(start, np.arange(j0, j1), side='right')
+		return np.ones(j1 - j0, bool), group
+
+	prof = bin_points(d, g, select, m, chunk)
+	prof['p'] = prof['p'][0] if g['coord'] in ('p', 'lnp') else prof['p']
+	prof['ua'] = np.full((m, n), np.nan, np.float64)
+	prof['va'] = np.full((m, n), np.nan, np.float64)
+	for i in range(m):
+		prof['ua'][i], prof['va'][i] = \
+			winds(prof['lat'][i], prof['lon'][i], prof['time'][i])
+	prof['desc'] = desc.astype(np.int8)
+	for var in STATION_VARS:
+		prof[var] = d[var] if var in d else np.nan
+	cast(prof)
+	prof['.'] = dataset_header(HEADER_PROF, d['.'].get('.', {}))
+	for var, x in prof.items():
+		if var != '.' and np.ndim(x) == 2:
+			prof['.'][var] = dict(HEADER_PROF[var],
+				**{'.dims': ['profile', 'p']})
+	prof['.']['desc'] = {
+		'long_name': 'descending profile',
+		'units': '1',
+		'.dims': ['profile'],
+	}
+	return prof
+
+def simplify(x, y, tol):
+	'''Simplify a line with coordinates x (n) and values y (n, k) with the
+	Douglas-Peucker algorithm, keeping points from which the line interpolated
+	linearly between the kept points deviates by at most tol (Euclidean norm
+	of y). Points with missing values are ignored. All segments are split at
+	the same time. Returns the indices of the kept points.'''
+	idx = np.nonzero(np.isfinite(x) & np.all(np.isfinite(y), axis=1))[0]
+	x = x[idx]
+	y = y[idx]
+	n = len(x)
+	keep = np.zeros(n, bool)
+	keep[[0, -1] if n > 0 else []] = True
+	while n > 2:
+		k = np.nonzero(keep)[0]
+		# Segment (between kept points) of every point.
+		seg = np.minimum(np.searchsorted(k, np.arange(n), side='right') - 1,
+			len(k) - 2)
+		a = k[seg]
+		b = k[seg + 1]
+		w = ((x - x[a])/(x[b] - x[a]))[:,np.newaxis]
+		dev = np.sqrt(np.sum((y - (y[a] + w*(y[b] - y[a])))**2, axis=1))
+		dev[keep] = 0.
+		# Point of the maximum deviation in every segment.
+		order = np.lexsort((-dev, seg))
+		first = order[np.r_[0, np.nonzero(np.diff(seg[order]))[0] + 1]]
+		new = first[dev[first] > tol]
+		if len(new) == 0:
+			break
+		keep[new] = True
+	return idx[keep]
+
+def prof_wmo(d, pres=5e2, chunk=CHUNK_SIZE, grid=None, full=None):
+	'''Calculate a profile (prof) of WMO mandatory and significant levels
+	from points (pts). The profile is calculated as in prof, and values on
+	the mandatory levels (MANDATORY) are interpolated linearly in the
+	logarithm of pressure. The significant levels are the levels of the
+	profile selected by simplify with the criteria SIGNIFICANT, including the
+	first (surface) and last level. The types of every level are stored in
+	the variable level_type (LEVEL_TYPES).
+
+	d - Points (pts) dataset (dict).
+	pres - Pressure resolution of the profile (float).
+	chunk - Maximum number of points binned at a time (int).
+	grid - Vertical grid specification of the profile (see prof).
+	full - Profile calculated by prof from d with the same arguments, if
+		already available (dict). It is not modified.
+	'''
+	if full is None:
+		full = prof(d, pres=pres, chunk=chunk, grid=grid)
+	order = np.argsort(-full['p'], kind='stable')
+	order = order[full['p'][order] > 0]
+	lnp = np.log(full['p'][order])
+	vars = VARS + ['ua', 'va']
+	x = {var: full[var][order] for var in vars}
+	valid = np.isfinite(x['ta'])
+	rows = []
+	types = []
+	if np.any(valid):
+		i = np.nonzero(valid)[0]
+		rows += [i[[0]]]
+		types += [np.array([LEVEL_TYPES['surface']])]
+		for name, (vars1, tol) in SIGNIFICANT.items():
+			i = simplify(lnp, np.stack([x[var] for var in vars1], axis=1), tol)
+			rows += [i]
+			types += [np.full(len(i), LEVEL_TYPES[name])]
+	rows = np.concatenate(rows + [np.zeros(0, np.int64)])
+	types = np.concatenate(types + [np.zeros(0, np.int64)])
+	p = full['p'][order][rows]
+	out = {var: x[var][rows] for var in vars}
+	# Mandatory levels within the range of the profile.
+	if np.any(valid):
+		pm = MANDATORY[
+			(MANDATORY <= np.exp(lnp[valid][0])) &
+			(MANDATORY >= np.exp(lnp[valid][-1]))
+		]
+	else:
+		pm = np.zeros(0, np.float64)
+	for var in vars:
+		v = np.isfinite(x[var])
+		y = np.interp(-np.log(pm), -lnp[v], x[var][v], left=np.nan,
+			right=np.nan) if np.any(v) else np.full(len(pm), np.nan)
+		out[var] = np.concatenate([out[var], y])
+	p = np.concatenate([p, pm])
+	types = np.concatenate([types, np.full(len(pm), LEVEL_TYPES['mandatory'])])
+	# Merge levels of multiple types, from the highest pressure.
+	p, inverse = np.unique(-p, return_inverse=True)
+	n = len(p)
+	first = np.full(n, len(inverse), np.int64)
+	np.minimum.at(first, inverse, np.arange(len(inverse)))
+	out = {var: y[first] for var, y in out.items()}
+	out['p'] = -p
+	out['level_type'] = np.zeros(n, np.int8)
+	np.bitwise_or.at(out['level_type'], inverse, types.astype(np.int8))
+	for var in STATION_VARS:
+		out[var] = d[var] if var in d else np.nan
+	cast(out)
+	out['.'] = dataset_header(HEADER_PROF, d['.'].get('.', {}))
+	return out
@@ -0,0 +1,112 @@
+import os
+import io
+import sys
+import stat
+import json
+import time
+import threading
+import socketserver
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from rstool.main import main2
+
+# Conversion server. Requests are JSON objects, one per line, with the keys
+# "input_type", "output_type", "input", "output" and optionally "surf" and
+# "id" (passed through to the response). Responses are JSON objects, one per
+# line, with the keys "id", "status" ("ok" or "error"), "error" (error
+# message), "queue_time" (time in the queue in seconds) and "time"
+# (conversion time in seconds). Responses are written as jobs complete, which
+# is not necessarily in the order of requests.
+
+def init_worker():
+	np.seterr(all='ignore')
+
+def job(req):
+	start = time.time()
+	main2(
+		req['input_type'],
+		req['output_type'],
+		req['input'],
+		req['output'],
+		surf=req.get('surf'),
+	)
+	return start, time.time()
+
+def handle(f_in, f_out, executor):
+	'''Read requests from text file object f_in, run them on executor and
+	write responses to text file object f_out. Returns when all requests have
+	completed.'''
+	lock = threading.Lock()
+	done = threading.Condition(lock)
+	pending = [0]
+
+	def respond(res):
+		with lock:
+			f_out.write(json.dumps(res) + '\n')
+			f_out.flush()
+
+	def callback(fut, id_, submitted):
+		res = {'id': id_}
+		try:
+			start, end = fut.result()
+			res.update({
+				'status': 'ok',
+				'queue_time': start - submitted,
+				'time': end - start,
+			})
+		except Exception as e:
+			res.update({'status': 'error', 'error': str(e)})
+		respond(res)
+		with lock:
+			pending[0] -= 1
+			done.notify_all()
+
+	for line in f_in:
+		if line.strip() == '':
+			continue
+		try:
+			req = json.loads(line)
+			id_ = req.get('id')
+			for k in ['input_type', 'output_type', 'input', 'output']:
+				if k not in req:
+					raise ValueError('%s: missing request key' % k)
+		except Exception as e:
+			respond({'id': None, 'status': 'error', 'error': str(e)})
+			continue
+		with lock:
+			pending[0] += 1
+		submitted = time.time()
+		fut = executor.submit(job, req)
+		fut.add_done_callback(
+			lambda fut, id_=id_, submitted=submitted: \
+				callback(fut, id_, submitted)
+		)
+	with lock:
+		while pending[0] > 0:
+			done.wait()
+
+def serve(socket=None, jobs=None):
+	'''Run conversion server with jobs worker processes (default: number of
+	CPUs). If socket is None, read requests from the standard input and write
+	responses to the standard output. Otherwise, listen on a Unix socket
+	socket.'''
+	with ProcessPoolExecutor(jobs, initializer=init_worker) as executor:
+		if socket is None:
+			handle(sys.stdin, sys.stdout, executor)
+			return
+
+		class Handler(socketserver.StreamRequestHandler):
+			def handle(self):
+				f_in = io.TextIOWrapper(self.rfile, encoding='utf-8')
+				f_out = io.TextIOWrapper(self.wfile, encoding='utf-8',
+					write_through=True)
+				handle(f_in, f_out, executor)
+
+		if os.path.exists(socket) and stat.S_ISSOCK(os.stat(socket).st_mode):
+			os.remove(socket)
+		with socketserver.ThreadingUnixStreamServer(socket, Handler) as server:
+			try:
+				server.serve_forever()
+			finally:
+				os.remove(socket)
@@ -0,0 +1,206 @@
+import numpy as np
+import ds_format as ds
+import aquarius_time as aq
+
+from rstool.headers import HEADER_PROF
+from rstool.campaign import grid, regrid, profiles
+
+# Climatology statistics. Profiles (prof) are read one file at a time and
+# accumulated on the common pressure grid of campaign datasets in streaming
+# accumulators for every group of profiles (such as month): count, mean and
+# variance (Welford's algorithm), minimum, maximum and a histogram with fixed
+# bins (HIST), from which quantiles are estimated. Files with a profile
+# dimension (campaign and prof:segments) are read in slices of CHUNK_PROFILES
+# profiles, and only the variables needed are read, so that the memory used
+# does not depend on the number of profiles.
+
+# Variables for which statistics are calculated by default.
+VARS = ['ta', 'hur', 'ua', 'va', 'theta', 'w']
+
+# Histogram range and number of bins by variable. Values outside of the range
+# are counted in the first or last bin. Quantiles are not calculated for
+# variables not listed.
+HIST = {
+	'ta': (150., 350., 400),
+	'hur': (0., 120., 240),
+	'ua': (-100., 100., 400),
+	'va': (-100., 100., 400),
+	'theta': (200., 700., 500),
+	'thetav': (200., 700., 500),
+	'w': (0., 0.04, 400),
+}
+
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+# Maximum number of profiles read from a file at a time.
+CHUNK_PROFILES = 1000
+
+# Variables read in addition to the variables of the statistics.
+READ_VARS = ['p', 'ta', 'time', 'profile_time', 'station_time']
+
+SEASONS = ['DJF', 'MAM', 'JJA', 'SON']
+
+# Functions returning the group label of a profile launched at time t
+# (Julian date).
+GROUPS = {
+	'all': lambda t: 'all',
+	'year': lambda t: '%04d' % aq.to_date(t)[1],
+	'month': lambda t: '%02d' % aq.to_date(t)[2],
+	'season': lambda t: SEASONS[aq.to_date(t)[2]//3 % 4],
+}
+
+def init(n, hist):
+	'''Initialize accumulators for n levels with histogram hist (a tuple of
+	range and number of bins, or None).'''
+	acc = {
+		'count': np.zeros(n, np.int64),
+		'mean': np.zeros(n, np.float64),
+		'm2': np.zeros(n, np.float64),
+		'min': np.full(n, np.nan, np.float64),
+		'max': np.full(n, np.nan, np.float64),
+	}
+	if hist is not None:
+		acc['hist'] = np.zeros((hist[2], n), np.int64)
+	return acc
+
+def update(acc, x, hist):
+	'''Update accumulators acc with profile x, ignoring missing values.'''
+	valid = np.isfinite(x)
+	i = np.nonzero(valid)[0]
+	x = x[valid]
+	acc['count'][i] += 1
+	delta = x - acc['mean'][i]
+	acc['mean'][i] += delta/acc['count'][i]
+	acc['m2'][i] += delta*(x - acc['mean'][i])
+	acc['min'][i] = np.fmin(acc['min'][i], x)
+	acc['max'][i] = np.fmax(acc['max'][i], x)
+	if hist is not None:
+		lo, hi, nbins = hist
+		k = ((x - lo)/(hi - lo)*nbins).astype(np.int64)
+		k = np.clip(k, 0, nbins - 1)
+		np.add.at(acc['hist'], (k, i), 1)
+
+def read_slices(input_, vars):
+	'''Iterate over slices of profile file input_ (file name or dataset)
+	along the profile dimension, with variables vars and READ_VARS. A dataset
+	or a file without a profile dimension is yielded whole.'''
+	if isinstance(input_, dict):
+		yield input_
+		return
+	meta = ds.read(input_, [], full=True)['.']
+	names = [
+		var for var in meta
+		if var != '.' and (var in vars or var in READ_VARS)
+	]
+	n = None
+	for var in names:
+		dims = meta[var].get('.dims', [])
+		if 'profile' in dims:
+			n = meta[var]['.size'][dims.index('profile')]
+			break
+	if n is None:
+		yield ds.read(input_, names)
+		return
+	for i0 in range(0, n, CHUNK_PROFILES):
+		i1 = min(i0 + CHUNK_PROFILES, n)
+		yield ds.read(input_, names, sel={'profile': np.arange(i0, i1)})
+
+def quantiles(h, hist, q):
+	'''Estimate quantiles q from histogram h (bins, levels) with range and
+	number of bins hist, interpolating linearly within bins.'''
+	lo, hi, nbins = hist
+	width = (hi - lo)/nbins
+	cum = np.cumsum(h, axis=0)
+	n = cum[-1]
+	out = np.full((len(q), h.shape[1]), np.nan, np.float64)
+	for j, qj in enumerate(q):
+		target = qj*n
+		k = np.argmax(cum >= target, axis=0)
+		levels = np.arange(h.shape[1])
+		below = np.where(k > 0, cum[k - 1, levels], 0)
+		inbin = h[k, levels]
+		frac = np.where(inbin > 0, (target - below)/np.where(inbin > 0,
+			inbin, 1), 0.)
+		out[j] = np.where(n > 0, lo + (k + frac)*width, np.nan)
+	return out
+
+def stats(inputs, group='month', vars=None, pres=None):
+	'''Calculate statistics of variables vars (default: VARS) in profile
+	(prof) files inputs (list of file names or datasets), grouped by group
+	(a key in GROUPS). pres is the resolution of the pressure grid (Pa;
+	default: as in campaign datasets). Returns a statistics dataset (dict).'''
+	vars = vars if vars is not None else VARS
+	pgrid = grid(pres) if pres is not None else grid()
+	n = len(pgrid)
+	label = GROUPS[group]
+	accs = {}
+	meta = {}
+	for d in (d for input_ in inputs for d in read_slices(input_, vars)):
+		for t, prof in profiles(d):
+			if not np.isfinite(t):
+				continue
+			g = label(t)
+			if g not in accs:
+				accs[g] = {var: init(n, HIST.get(var)) for var in vars}
+			for var in vars:
+				if var not in prof or np.ndim(prof[var]) != 1:
+					continue
+				meta.setdefault(var,
+					d['.'].get(var, HEADER_PROF.get(var, {})))
+				p = np.asarray(prof['p'], np.float64)
+				x = regrid(p, prof[var], pgrid)
+				update(accs[g][var], x, HIST.get(var))
+
+	groups = sorted(accs.keys())
+	out = {
+		'group': np.array(groups),
+		'p': pgrid,
+		'quantile': np.array(QUANTILES, np.float64),
+		'.': {
+			'group': {'long_name': 'group (%s)' % group, '.dims': ['group']},
+			'p': dict(HEADER_PROF['p'], **{'.dims': ['p']}),
+			'quantile': {'long_name': 'quantile', 'units': '1',
+				'.dims': ['quantile']},
+		},
+	}
+	for var in vars:
+		if var not in meta:
+			continue
+		acc = {
+			k: np.stack([accs[g][var][k] for g in groups])
+			for k in accs[groups[0]][var].keys()
+		}
+		count = acc['count']
+		with np.errstate(invalid='ignore', divide='ignore'):
+			std = np.sqrt(acc['m2']/(count - 1))
+		std[count < 2] = np.nan
+		mean = np.where(count > 0, acc['mean'], np.nan)
+		m = {k: v for k, v in meta[var].items() if k != '.dims'}
+		long_name = m.get('long_name', var)
+		out[var + '_count'] = count
+		out[var + '_mean'] = mean
+		out[var + '_std'] = std
+		out[var + '_min'] = acc['min']
+		out[var + '_max'] = acc['max']
+		out['.'][var + '_count'] = {
+			'long_name': long_name + ' number of values', 'units': '1',
+			'.dims': ['group', 'p'],
+		}
+		for k, name in [
+			('mean', 'mean'),
+			('std', 'standard deviation'),
+			('min', 'minimum'),
+			('max', 'maximum'),
+		]:
+			out['.'][var + '_' + k] = dict(m,
+				long_name=long_name + ' ' + name,
+				**{'.dims': ['group', 'p']})
+		out['.'][var + '_std'].pop('standard_name', None)
+		if 'hist' in acc:
+			out[var + '_quantile'] = np.stack([
+				quantiles(h, HIST[var], QUANTILES) for h in acc['hist']
+			])
+			out['.'][var + '_quantile'] = dict(m,
+				long_name=long_name + ' quantile',
+				**{'.dims': ['group', 'quantile', 'p']})
+	return out
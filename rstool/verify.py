@@ -0,0 +1,605 @@
+import fnmatch
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import brentq
+
+import rstool
+from rstool import accel, algorithms, precision
+from rstool.drivers import ws
+from rstool.prof import VARS, simplify
+
+# Differential verification of the optimized code paths against reference
+# implementations. Every case (CASES) generates random synthetic input,
+# passes it through a reference and an optimized code path, and returns the
+# two resulting datasets. The datasets are compared variable by variable and
+# the maximum absolute and relative differences are checked against the
+# tolerances (TOLERANCES).
+
+RTOL = 1e-9
+ATOL = 1e-12
+
+# Tolerances (rtol, atol) by "case.variable" pattern. The first matching
+# pattern is used. An element passes if it differs by at most
+# atol + rtol*abs(reference).
+TOLERANCES = {
+	'solvers.td': (0., 1e-4),
+	'solvers.pc': (0., 1e-3),
+	'backend.td': (0., 1e-4),
+	'backend.tds': (0., 1e-4),
+	'backend.pc*': (0., 1e-3),
+	'backend.lcl*': (0., 1e-3),
+	'backend.cape': (1e-6, 1e-6),
+	'backend.cin': (1e-6, 1e-6),
+	'backend.*lfc': (0., 1e-3),
+	'backend.*el': (0., 1e-3),
+	'postprocess.*': (1e-12, 1e-12),
+	'chunks.time': (0., 1e-8),
+	'chunks.[uv]a': (0., 1e-3),
+	'grid.*': (1e-9, 1e-9),
+	'parcel.tapar': (0., 1e-2),
+	'cape.cape': (1e-3, 1e-1),
+	'cape.cin': (1e-3, 1e-1),
+	'cape.p*': (2e-3, 0.),
+	'float32.bvf': (0., 1e-5),
+	'float32.lts': (0., 1e-4),
+	'float32.cape': (1e-3, 1e-3),
+	'float32.cin': (1e-3, 1e-3),
+	'float32.*lfc': (1e-4, 0.),
+	'float32.*el': (1e-4, 0.),
+	'float32.*': (1e-5, 1e-6),
+}
+
+def enc_deg(x):
+	# Degrees to degrees * 1e6 + minutes * 1e4, as in the "lat" and "lon"
+	# fields.
+	a = np.abs(x)
+	deg = np.floor(a)
+	return int(np.sign(x)*(deg*1e6 + np.round((a - deg)*60*1e4)))
+
+def synthetic_sounding(rng, n=300, sondes=1):
+	'''Generate a random Windsond sounding (bytes) with n messages per sonde
+	and sondes sondes. The sonde ascends to the middle of the flight and
+	descends afterwards.'''
+	lines = [
+		b'# Session start 2000-01-01 00:00:00',
+		b'# offset=946684800',
+		b'# timezone=0',
+	]
+	lat0 = rng.uniform(-80, 80)
+	lon0 = rng.uniform(-180, 180)
+	# Pressure of a temperature inversion, above which a lifted parcel is
+	# negatively buoyant.
+	p_inv = rng.uniform(9.4e4, 9.7e4)
+	t = 0.
+	seq = 1
+	for i in range(n):
+		for k in range(sondes):
+			t += rng.uniform(0.5, 1.)
+			tstr = '%dh%dm%ds%03d' % (t//3600, t//60 % 60, t % 60, t*1e3 % 1e3)
+			p = 101325 - min(i, n - i)*80 + rng.integers(-30, 30)
+			ta = 15 - (101325 - p)/1000*0.8 + max(p_inv - p, 0)/1000*3 + \
+				rng.normal()*0.2
+			lat = lat0 + i*1e-5*(k + 1) + rng.normal()*1e-6
+			lon = lon0 + i*2e-5 + rng.normal()*1e-6
+			fields = [
+				'id=%d' % (1000 + k),
+				'node_id=%d' % (k + 1),
+				'sid=%d' % (10000 + k),
+				'seq=%d' % seq,
+				'pa=%d' % p,
+				'alt=%d' % (min(i, n - i)*5),
+				'r=200',
+				'rec=3',
+			]
+			if rng.random() > 0.05:
+				fields += ['te=%.2f' % ta]
+			if rng.random() > 0.05:
+				fields += ['hu=%.1f' % rng.uniform(5, 100)]
+			kind = rng.choice(['fix', 'm', 'd', 'none'], p=[.1, .15, .6, .15])
+			if i == 0 or kind == 'fix':
+				fields += ['lat=%d' % enc_deg(lat), 'lon=%d' % enc_deg(lon)]
+			elif kind == 'm':
+				fm = lambda x: (x % 1)*60 if x >= 0 else 60 - (-x % 1)*60
+				fields += [
+					'latm=%d' % round(fm(lat)*1e4),
+					'lonm=%d' % round(fm(lon)*1e4),
+				]
+			elif kind == 'd':
+				fd = lambda x: (abs(x) % 1)*60 % 1
+				fd2 = lambda x: fd(x) if x >= 0 else 1 - fd(x)
+				fields += [
+					'latd=%d' % round(fd2(lat)*1e4),
+					'lond=%d' % round(fd2(lon)*1e4),
+				]
+			lines += [('%s: [#SONDE:%s]' % (tstr, ','.join(fields))).encode()]
+			seq += 1
+	return b'\n'.join(lines) + b'\n'
+
+def synthetic_surface(rng):
+	'''Generate random near-surface variables (surf dataset) for a sounding
+	generated by synthetic_sounding.'''
+	return {
+		'time': np.array([2451544.5]),
+		'ps': np.array([101325. + rng.uniform(0, 100)]),
+		'tas': np.array([288.15 + rng.normal()*0.5]),
+		'hurs': np.array([rng.uniform(70, 95)]),
+	}
+
+def prof_ref(d, pres=5e2, desc=False):
+	'''Reference implementation of the binning of points in prof.'''
+	pmin, pmax = np.nanmin(d['p']), np.nanmax(d['p'])
+	phalf_min = np.floor(pmin/pres)*pres
+	phalf_max = np.ceil(pmax/pres)*pres
+	phalf = np.arange(phalf_min, phalf_max + pres, pres)[::-1]
+	n = len(phalf) - 1
+	prof = {'p': 0.5*(phalf[1:] + phalf[:-1])}
+	for var in VARS:
+		prof[var] = np.full(n, np.nan, np.float64)
+	if desc:
+		mask1 = np.append(~(np.diff(d['p']) < 0.), True)
+	else:
+		mask1 = np.append(~(np.diff(d['p']) > 0.), True)
+	for i in range(n):
+		mask = mask1 & (d['p'] > phalf[i + 1]) & (d['p'] <= phalf[i])
+		for var in VARS:
+			x = np.ma.filled(d[var], np.nan)[mask]
+			if np.any(~np.isnan(x)):
+				prof[var][i] = np.nanmean(x)
+	return prof
+
+def grid_ref(d, coord, levels, method='interp'):
+	'''Reference implementation of the calculation of profiles in prof on a
+	vertical grid of coordinate coord with levels levels (array) or a regular
+	grid of resolution levels (float) by method method, for points monotonic
+	in the coordinate.'''
+	c = {
+		'p': d['p'],
+		'lnp': np.log(d['p']),
+		'z': d['z'],
+		'zg': algorithms.calc_zg(z=d['z'],
+			g=algorithms.calc_g(lat=d['lat'])),
+	}[coord]
+	sign = 1 if coord in ('z', 'zg') else -1
+	if np.ndim(levels) == 0:
+		k = np.arange(np.floor(np.min(c)/levels),
+			np.ceil(np.max(c)/levels) + 1)
+		half = k*levels
+		full = 0.5*(half[1:] + half[:-1])
+	else:
+		full = np.unique(np.log(levels) if coord == 'lnp' else levels)
+		half = np.concatenate([
+			[1.5*full[0] - 0.5*full[1]],
+			0.5*(full[1:] + full[:-1]),
+			[1.5*full[-1] - 0.5*full[-2]],
+		])
+	# Coordinate increasing with height.
+	u = sign*c
+	full = np.sort(sign*full)
+	half = np.sort(sign*half)
+	vars = VARS + ['p']
+	if method == 'interp':
+		prof = {
+			var: np.interp(full, u, d[var], left=np.nan, right=np.nan)
+			for var in vars
+		}
+	else:
+		prof = {var: np.full(len(full), np.nan) for var in vars}
+		for i in range(len(full)):
+			mask = (u >= half[i]) & (u < half[i + 1])
+			for var in vars:
+				if np.any(mask):
+					prof[var][i] = np.mean(d[var][mask])
+	if coord == 'p':
+		prof['p'] = -full
+	elif coord == 'lnp':
+		prof['p'] = np.exp(-full)
+	else:
+		prof[coord] = full
+	return prof
+
+def ws_postprocess_ref(d):
+	'''Reference implementation of ws.postprocess (message by message).'''
+	n = len(d['seq'])
+	for var in ['lat', 'lon']:
+		column = lambda k: np.ma.filled(d.pop(k), np.nan) if k in d \
+			else np.full(n, np.nan)
+		x0, xm0, xd0 = column(var), column(var + 'm'), column(var + 'd')
+		out = np.full(n, np.nan)
+		x = np.nan
+		for i in range(n):
+			xm = (np.abs(x) % 1.)*60.
+			xd = xm % 1.
+			if not np.isnan(x0[i]):
+				x = x0[i]
+			elif not np.isnan(xm0[i]) and not np.isnan(x):
+				xm2 = 60. - xm0[i] if x < 0 else xm0[i]
+				x = np.sign(x)*(np.floor(np.abs(x)) + xm2/60.)
+			elif not np.isnan(xd0[i]) and not np.isnan(x):
+				xd2 = 1. - xd0[i] if x < 0 else xd0[i]
+				if xd2 - xd > 0.5:
+					xd2 -= 1.
+				if xd2 - xd < -0.5:
+					xd2 += 1.
+				x = np.sign(x)*(np.floor(np.abs(x)) + (np.floor(xm) + xd2)/60.)
+			out[i] = x
+		d[var] = out
+
+def case_prof(rng):
+	d = rstool.convert('ws', 'pts', synthetic_sounding(rng))
+	desc = bool(rng.integers(2))
+	fast = rstool.prof(d, desc=desc)
+	return prof_ref(d, desc=desc), {k: fast[k] for k in VARS + ['p']}
+
+def case_chunks(rng):
+	d = rstool.convert('ws', 'pts', synthetic_sounding(rng))
+	chunk = int(rng.integers(1, len(d['p']) + 1))
+	ref = rstool.prof(d, chunk=len(d['p']))
+	fast = rstool.prof(d, chunk=chunk)
+	return {k: ref[k] for k in VARS + ['p', 'ua', 'va']}, \
+		{k: fast[k] for k in VARS + ['p', 'ua', 'va']}
+
+def case_grid(rng):
+	n = int(rng.integers(2, 1000))
+	z = np.cumsum(rng.uniform(0.1, 50., n))
+	d = {
+		'z': z,
+		'p': 1e5*np.exp(-z/8000.),
+		'ta': 290. - 0.0065*z + rng.normal(0, 0.5, n),
+		'hur': rng.uniform(0., 100., n),
+		'lat': 50. + np.cumsum(rng.normal(0, 1e-4, n)),
+		'lon': 15. + np.cumsum(rng.normal(0, 1e-4, n)),
+		'time': 2460000.5 + np.arange(n)/86400.,
+		'.': {'.': {}},
+	}
+	coord = ['p', 'lnp', 'z', 'zg'][rng.integers(4)]
+	method = ['bin', 'interp'][rng.integers(2)]
+	c = {'p': d['p'], 'lnp': d['p'], 'z': d['z'], 'zg': d['z']}[coord]
+	if rng.random() < 0.5:
+		levels = rng.uniform(np.min(c), np.max(c), int(rng.integers(2, 100)))
+	else:
+		levels = {
+			'p': rng.uniform(100, 2000),
+			'lnp': rng.uniform(0.005, 0.05),
+			'z': rng.uniform(10, 500),
+			'zg': rng.uniform(10, 500),
+		}[coord]
+	chunk = int(rng.integers(1, n + 1))
+	fast = rstool.prof(d, chunk=chunk, grid=(coord, levels, method))
+	ref = grid_ref(d, coord, levels, method)
+	return ref, {k: fast[k] for k in ref}
+
+def case_ws(rng):
+	s = synthetic_sounding(rng, sondes=1)
+	d, _ = ws.parse(s)
+	ref = {k: v for k, v in d.items() if k != '.'}
+	ws_postprocess_ref(ref)
+	fast = dict(d, **{'.': {}})
+	ws.postprocess(fast)
+	return {k: ref[k] for k in ['lat', 'lon']}, \
+		{k: fast[k] for k in ['lat', 'lon']}
+
+def case_merge(rng):
+	s = synthetic_sounding(rng, sondes=int(rng.integers(1, 3)))
+	lines = s.split(b'\n')
+	header, body = lines[:3], lines[3:]
+	i = int(rng.integers(1, len(body) - 1))
+	j = int(rng.integers(0, i))
+	parts = [
+		b'\n'.join(header + body[:i]),
+		b'\n'.join(header + body[j:]),
+		# A file with only a header, such as after a receiver restart.
+		b'\n'.join(header) + b'\n',
+	]
+	rng.shuffle(parts)
+	return ws.read(s), ws.read(parts)
+
+def case_postprocess(rng):
+	d = rstool.convert('ws', 'pts', synthetic_sounding(rng))
+	p = rstool.prof(d)
+	p['.'] = {}
+	p.update({k: v[0] for k, v in synthetic_surface(rng).items()
+		if k != 'time'})
+	sources = ['p', 'ta', 'hur']
+	ref = {k: np.copy(p[k]) for k in p if k != '.'}
+	fast = {k: np.copy(p[k]) for k in p if k != '.'}
+	rstool.postprocess(ref, fused=False)
+	rstool.postprocess(fast)
+	# The generic path recalculates the source variables.
+	return {k: v for k, v in ref.items() if k not in sources}, \
+		{k: v for k, v in fast.items() if k not in sources}
+
+def parcel_ref(ps, tas, pc, pmin):
+	'''Reference parcel temperature as a function of air pressure, by
+	integration of the pseudo-adiabat from the condensation level pc up to
+	pmin.'''
+	ta1 = tas*(pc/ps)**algorithms.kappa
+	sol = solve_ivp(
+		lambda x, y: algorithms.pseudoadiabat_rate(np.exp(x), y),
+		[np.log(pc), np.log(pmin)], [ta1],
+		rtol=1e-10, atol=1e-10, dense_output=True,
+	)
+	def f(p):
+		above = p < pc
+		return np.where(above, sol.sol(np.log(np.where(above, p, pc)))[0],
+			tas*(p/ps)**algorithms.kappa)
+	return f
+
+def tapar_ref(p, ps, tas, pc):
+	'''Reference implementation of the parcel temperature in calc_tapar by
+	integration of the pseudo-adiabat from the condensation level.'''
+	return parcel_ref(ps, tas, pc, np.min(p))(p)
+
+def cape_ref(b, x0, x1, xlcl):
+	'''Reference implementation of calc_cape by integration of buoyancy b
+	(function of the negative logarithm of air pressure x) from x0 to x1 with
+	the condensation level at xlcl. The levels where the buoyancy changes
+	sign are found by root finding on a fine grid.'''
+	xx = np.linspace(x0, x1, 10001)
+	bb = b(xx)
+	i = np.nonzero(np.sign(bb[:-1])*np.sign(bb[1:]) < 0)[0]
+	roots = np.array([brentq(b, xx[k], xx[k + 1], xtol=1e-14) for k in i])
+	up = roots[bb[i] < 0]
+	down = roots[bb[i] > 0]
+	if b(xlcl) > 0:
+		xlfc = xlcl
+	elif np.any(up > xlcl):
+		xlfc = up[up > xlcl][0]
+	else:
+		return 0., np.nan, np.nan, np.nan
+	xel = down[-1] if bb[-1] <= 0 and len(down) > 0 else np.nan
+	def integral(f, a, c):
+		knots = np.unique(np.concatenate([[a, c, xlcl], roots]))
+		knots = knots[(knots >= a) & (knots <= c)]
+		return sum([
+			solve_ivp(lambda x, y: [f(b(x))], [u, v], [0.],
+				rtol=1e-10, atol=1e-10).y[0,-1]
+			for u, v in zip(knots[:-1], knots[1:])
+		])
+	cape = algorithms.rd*integral(lambda y: max(y, 0.), xlfc,
+		xel if np.isfinite(xel) else x1)
+	cin = algorithms.rd*integral(lambda y: min(y, 0.), x0, xlfc)
+	return cape, cin, np.exp(-xlfc), np.exp(-xel)
+
+def case_cape(rng):
+	ps = rng.uniform(9.5e4, 1.03e5)
+	tas = rng.uniform(280, 305)
+	ws_ = rng.uniform(0.6, 0.95)*algorithms.calc_wsat(p=ps, ta=tas)
+	pc = algorithms.calc_pc_fmin(ps, ws_, tas)
+	pmin = 3e4
+	parcel = parcel_ref(ps, tas, pc, pmin)
+	# Environment cooling more slowly than a dry adiabat, with a warm layer
+	# aloft.
+	r = rng.uniform(0.75, 0.95)
+	dt = rng.uniform(-1, 1)
+	a = rng.uniform(10, 20)
+	pinv = rng.uniform(4e4, 8e4)
+	tv = lambda p: tas*(p/ps)**(algorithms.kappa*r) + dt + \
+		a*0.5*(1 + np.tanh((np.log(pinv) - np.log(p))/0.1))
+	p = np.concatenate([[ps], np.sort(rng.uniform(pmin, ps, 1000))[::-1],
+		[pmin]])
+	b = lambda x: parcel(np.exp(-x)) - tv(np.exp(-x))
+	ref = cape_ref(b, -np.log(ps), -np.log(pmin), -np.log(pc))
+	fast = algorithms.calc_cape(p=p, tvpar=parcel(p), tv=tv(p), ps=ps, pc=pc)
+	return dict(zip(['cape', 'cin', 'plfc', 'pel'], ref)), \
+		dict(zip(['cape', 'cin', 'plfc', 'pel'], fast))
+
+def simplify_ref(x, y, tol):
+	'''Reference implementation of the Douglas-Peucker algorithm in simplify
+	by recursive splitting of segments.'''
+	idx = np.nonzero(np.isfinite(x) & np.all(np.isfinite(y), axis=1))[0]
+	x = x[idx]
+	y = y[idx]
+	keep = [0, len(x) - 1] if len(x) > 0 else []
+	def split(a, b):
+		if b - a < 2:
+			return
+		w = ((x[a+1:b] - x[a])/(x[b] - x[a]))[:,np.newaxis]
+		dev = np.sqrt(np.sum((y[a+1:b] - (y[a] + w*(y[b] - y[a])))**2,
+			axis=1))
+		i = int(np.argmax(dev))
+		if dev[i] > tol:
+			keep.append(a + 1 + i)
+			split(a, a + 1 + i)
+			split(a + 1 + i, b)
+	split(0, len(x) - 1)
+	return idx[np.unique(keep).astype(np.int64)]
+
+def case_simplify(rng):
+	n = int(rng.integers(1, 300))
+	x = np.log(1e5) - np.cumsum(rng.uniform(1e-3, 1e-2, n))
+	y = np.cumsum(rng.normal(size=(n, int(rng.integers(1, 3)))), axis=0)
+	y[rng.random(n) < 0.05] = np.nan
+	tol = rng.uniform(0.1, 5.)
+	return {'i': simplify_ref(x, y, tol)}, {'i': simplify(x, y, tol)}
+
+def case_parcel(rng):
+	ps = rng.uniform(8e4, 1.04e5)
+	tas = rng.uniform(240, 310)
+	ws_ = rng.uniform(0.1, 1.)*algorithms.calc_wsat(p=ps, ta=tas)
+	pc = algorithms.calc_pc_fmin(ps, ws_, tas)
+	p = np.sort(rng.uniform(5e3, ps, 100))[::-1]
+	return {'tapar': tapar_ref(p, ps, tas, pc)}, \
+		{'tapar': algorithms.calc_tapar(p=p, ps=ps, tas=tas, pc=pc)}
+
+def case_solvers(rng):
+	e = rng.uniform(1, 5000, 50)
+	ps = rng.uniform(9e4, 1.04e5, 50)
+	tas = rng.uniform(240, 310, 50)
+	ws_ = rng.uniform(0.1, 1., 50)*algorithms.calc_wsat(p=ps, ta=tas)
+	return {
+		'td': algorithms.calc_td_fmin(e),
+		'pc': algorithms.calc_pc_fmin(ps, ws_, tas),
+	}, {
+		'td': accel.td(e),
+		'pc': accel.pc(ps, ws_, tas),
+	}
+
+def case_binning(rng):
+	n = int(rng.integers(1, 200))
+	i = rng.integers(0, n, 1000)
+	x = rng.normal(size=1000)
+	x[rng.random(1000) < 0.1] = np.nan
+	backend = accel.backend
+	try:
+		accel.set_backend('numpy')
+		ref = accel.bin_mean(i, x, n)
+		# The kernel runs in pure Python if numba is not installed.
+		accel.backend = 'numba'
+		fast = accel.bin_mean(i, x, n)
+	finally:
+		accel.backend = backend
+	return {'x': ref}, {'x': fast}
+
+def case_turns(rng):
+	n = int(rng.integers(1, 3000))
+	t = np.arange(n)
+	p = 9e4 + 5e3*np.sin(t/rng.uniform(5, 300)) + rng.normal(0, 200, n)
+	p[rng.random(n) < 0.1] = np.nan
+	h = rng.uniform(0, 2000)
+	chunk = int(rng.integers(1, n + 1))
+	backend = accel.backend
+	out = []
+	try:
+		for name in ['numpy', 'numba']:
+			# The kernel runs in pure Python if numba is not installed.
+			accel.backend = name
+			state = np.array([0, np.nan, 0, np.nan, 0], np.float64)
+			start = np.concatenate([
+				accel.turns(p[j0:(j0 + chunk)], h, j0, state)
+				for j0 in range(0, n, chunk)
+			])
+			out += [{'start': start, 'state': state}]
+	finally:
+		accel.backend = backend
+	return out[1], out[0]
+
+def case_backend(rng):
+	if accel.numba is None:
+		return None
+	s = synthetic_sounding(rng, n=150)
+	surf = synthetic_surface(rng)
+	backend = accel.backend
+	try:
+		accel.set_backend('numpy')
+		ref = rstool.convert('ws', 'prof', s, surf=surf)
+		accel.set_backend('numba')
+		fast = rstool.convert('ws', 'prof', s, surf=surf)
+	finally:
+		accel.backend = backend
+	return ref, fast
+
+def case_float32(rng):
+	s = synthetic_sounding(rng, n=150)
+	surf = synthetic_surface(rng)
+	dtype = precision.dtype
+	try:
+		precision.set_dtype('float64')
+		ref = rstool.convert('ws', 'prof', s, surf=surf)
+		precision.set_dtype('float32')
+		fast = rstool.convert('ws', 'prof', s, surf=surf)
+	finally:
+		precision.dtype = dtype
+	return ref, fast
+
+CASES = {
+	'prof': case_prof,
+	'chunks': case_chunks,
+	'grid': case_grid,
+	'ws': case_ws,
+	'merge': case_merge,
+	'simplify': case_simplify,
+	'postprocess': case_postprocess,
+	'solvers': case_solvers,
+	'parcel': case_parcel,
+	'cape': case_cape,
+	'binning': case_binning,
+	'turns': case_turns,
+	'backend': case_backend,
+	'float32': case_float32,
+}
+
+def tolerance(case, var, tolerances):
+	name = case + '.' + var
+	for pattern, tol in tolerances.items():
+		if fnmatch.fnmatchcase(name, pattern):
+			return tol
+	return RTOL, ATOL
+
+def diff(x, y, rtol, atol):
+	'''Compare arrays x (reference) and y. Returns a tuple of the maximum
+	absolute difference, the maximum relative difference, the number of
+	elements which differ by more than atol + rtol*abs(x) or are missing
+	(NaN or masked) in only one of the arrays, and the number of elements
+	compared (present in both arrays).'''
+	try:
+		x = np.ma.filled(np.ma.asarray(x, np.float64), np.nan)
+		y = np.ma.filled(np.ma.asarray(y, np.float64), np.nan)
+	except (TypeError, ValueError):
+		return 0., 0., int(np.any(np.asarray(x) != np.asarray(y))), 1
+	if x.shape != y.shape:
+		return 0., 0., max(x.size, y.size), 0
+	mask = ~np.isnan(x) & ~np.isnan(y)
+	n = int(np.sum(np.isnan(x) != np.isnan(y)))
+	if not np.any(mask):
+		return 0., 0., n, 0
+	dx = np.abs(x[mask] - y[mask])
+	ax = np.abs(x[mask])
+	n += int(np.sum(dx > atol + rtol*ax))
+	with np.errstate(divide='ignore', invalid='ignore'):
+		rel = np.where(dx == 0, 0., dx/ax)
+	return float(np.max(dx)), float(np.max(rel)), n, int(np.sum(mask))
+
+def verify(n=10, seed=0, cases=None, tolerances={}):
+	'''Run cases (list of names in CASES, default: all) n times with random
+	input generated from seed seed. tolerances is a dictionary of
+	"case.variable" patterns and pairs of relative and absolute tolerance,
+	which take precedence over TOLERANCES. Returns a list of results for every
+	case and variable as dictionaries with the keys "case", "var", "max_abs"
+	(maximum absolute difference), "max_rel" (maximum relative difference),
+	"n_fail" (number of elements outside of the tolerance or missing in only
+	one of the outputs), "n_valid" (number of elements compared), "rtol",
+	"atol" and "status" ("ok", "fail" or "skipped"). A variable is skipped
+	if it has no values present in both outputs.'''
+	tolerances = dict(tolerances, **{
+		k: v for k, v in TOLERANCES.items() if k not in tolerances
+	})
+	results = []
+	for case in (cases if cases is not None else CASES.keys()):
+		rng = np.random.default_rng(seed)
+		res = {}
+		for _ in range(n):
+			out = CASES[case](rng)
+			if out is None:
+				break
+			ref, fast = out
+			for var in sorted(set(ref) | set(fast)):
+				if var == '.':
+					continue
+				rtol, atol = tolerance(case, var, tolerances)
+				r = res.setdefault(var, [0., 0., 0, 0, rtol, atol])
+				if var not in ref or var not in fast:
+					r[2] += 1
+					continue
+				max_abs, max_rel, n_fail, n_valid = \
+					diff(ref[var], fast[var], rtol, atol)
+				r[0] = max(r[0], max_abs)
+				r[1] = max(r[1], max_rel)
+				r[2] += n_fail
+				r[3] += n_valid
+		if len(res) == 0:
+			results += [{'case': case, 'status': 'skipped'}]
+		for var, (max_abs, max_rel, n_fail, n_valid, rtol, atol) in \
+			sorted(res.items()):
+			results += [{
+				'case': case,
+				'var': var,
+				'max_abs': max_abs,
+				'max_rel': max_rel,
+				'n_fail': n_fail,
+				'n_valid': n_valid,
+				'rtol': rtol,
+				'atol': atol,
+				'status': 'fail' if n_fail > 0 else
+					'skipped' if n_valid == 0 else 'ok',
+			}]
+	return results
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from fnmatch import fnmatch
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from rstool import archive
+from rstool.main import main2, split_text_format
+from rstool.server import init_worker
+
+# Watch mode. An input directory is scanned periodically for Windsond
+# ".sounding" files (optionally compressed) and iMet flight directories
+# (containing ".dat" and ".flt" files). An input is considered complete when
+# its size and modification time have not changed for a given time (and for
+# iMet, when the ".flt" file is present). Complete inputs are converted on a
+# pool of worker processes. Events are written as JSON objects, one per line,
+# to the standard output.
+
+def scan(dirname):
+	'''Scan directory dirname for inputs. Returns a dictionary of input paths
+	and pairs of input type and signature (changes when the input is
+	modified).'''
+	out = {}
+	for name in os.listdir(dirname):
+		if name.startswith('.'):
+			continue
+		path = os.path.join(dirname, name)
+		try:
+			if os.path.isfile(path) and \
+				fnmatch(archive.strip_ext(name), '*.sounding'):
+				st = os.stat(path)
+				out[path] = ('ws', ((st.st_size, st.st_mtime_ns),))
+			elif os.path.isdir(path):
+				names = sorted(os.listdir(path))
+				if not any([fnmatch(x, '*.flt') for x in names]) or \
+					not any([fnmatch(x, '*.dat') for x in names]):
+					continue
+				sig = []
+				for x in names:
+					st = os.stat(os.path.join(path, x))
+					sig += [(st.st_size, st.st_mtime_ns)]
+				out[path] = ('imet', tuple(sig))
+		except FileNotFoundError:
+			continue
+	return out
+
+def output_path(path, output_type, output_dir):
+	'''Return output path for input path and output type output_type in
+	output_dir.'''
+	name = archive.strip_ext(os.path.basename(os.path.normpath(path)))
+	if name.endswith('.sounding'):
+		name = name[:-len('.sounding')]
+	fmt = split_text_format(output_type)[1]
+	ext = '' if output_type == 'pts:npy' else \
+		'.' + fmt if fmt is not None else '.nc'
+	return os.path.join(output_dir,
+		name + '_' + output_type.replace(':', '_') + ext)
+
+def up_to_date(output, sig):
+	'''Return True if output exists and is not older than an input with
+	signature sig.'''
+	try:
+		mtime = os.stat(output).st_mtime_ns
+	except FileNotFoundError:
+		return False
+	return mtime >= max([x[1] for x in sig])
+
+def write_atomic(output, func):
+	'''Call func with a file name in a temporary directory in the directory of
+	output. The files written by func are moved to the directory of output
+	when complete. Returns a list of outputs (multiple for the
+	INSTRUMENT:split input types).'''
+	dirname = os.path.dirname(output)
+	tmp = tempfile.mkdtemp(prefix='.rstool-', dir=dirname or '.')
+	outputs = []
+	try:
+		func(os.path.join(tmp, os.path.basename(output)))
+		for name in sorted(os.listdir(tmp)):
+			dst = os.path.join(dirname, name)
+			if os.path.isdir(dst):
+				shutil.rmtree(dst)
+			os.replace(os.path.join(tmp, name), dst)
+			outputs += [dst]
+	finally:
+		shutil.rmtree(tmp, ignore_errors=True)
+	return outputs
+
+def job(input_type, output_type, input_, output, surf=None):
+	'''Convert input_ to output. The output is written to a temporary
+	directory first and moved to the directory of output when complete.
+	Returns a tuple of start time, end time and a list of outputs (multiple
+	for the INSTRUMENT:split input types).'''
+	start = time.time()
+	outputs = write_atomic(output, lambda filename:
+		main2(input_type, output_type, input_, filename, surf=surf))
+	return start, time.time(), outputs
+
+def watch(output_type, input_dir, output_dir, jobs=None, interval=5.,
+	stable=10., retries=3, queue_size=None):
+	'''Watch input_dir for new inputs and convert them to output_type in
+	output_dir on jobs worker processes (default: number of CPUs). interval
+	is the scan interval (s). An input is converted when it has not changed
+	for stable seconds. A failed conversion is retried up to retries times
+	with an exponentially increasing delay. At most queue_size conversions
+	(default: 2*jobs) are queued or running at the same time. Inputs which
+	are ready when the queue is full are deferred to the next scan.'''
+	jobs = jobs if jobs is not None else os.cpu_count()
+	queue_size = queue_size if queue_size is not None else 2*jobs
+	seen = {}
+	done = {}
+	attempts = {}
+	running = {}
+	metrics = {
+		'queued': 0,
+		'ok': 0,
+		'failed': 0,
+		'retried': 0,
+		'deferred': 0,
+		'skipped': 0,
+	}
+
+	def event(res):
+		res['metrics'] = dict(metrics, running=len(running))
+		sys.stdout.write(json.dumps(res) + '\n')
+		sys.stdout.flush()
+
+	os.makedirs(output_dir, exist_ok=True)
+	with ProcessPoolExecutor(jobs, initializer=init_worker) as executor:
+		while True:
+			now = time.time()
+			deferred = 0
+			for path, (input_type, sig) in sorted(scan(input_dir).items()):
+				if done.get(path) == sig or \
+					path in [x[0] for x in running.values()]:
+					continue
+				if path not in seen or seen[path][0] != sig:
+					seen[path] = (sig, now)
+					continue
+				if now - seen[path][1] < stable:
+					continue
+				n, next_time = attempts.get(path, (0, 0.))
+				if now < next_time:
+					continue
+				output = output_path(path, output_type, output_dir)
+				if n == 0 and up_to_date(output, sig):
+					done[path] = sig
+					metrics['skipped'] += 1
+					continue
+				if len(running) >= queue_size:
+					deferred += 1
+					continue
+				fut = executor.submit(job, input_type, output_type, path,
+					output)
+				running[fut] = (path, sig, output, n + 1, now)
+				metrics['queued'] += 1
+			if deferred > 0:
+				metrics['deferred'] += deferred
+				event({'status': 'deferred', 'count': deferred})
+
+			finished, _ = wait(list(running.keys()), timeout=interval,
+				return_when=FIRST_COMPLETED)
+			if len(running) == 0:
+				time.sleep(interval)
+			for fut in finished:
+				path, sig, output, n, submitted = running.pop(fut)
+				res = {'input': path, 'output': output, 'attempt': n}
+				try:
+					start, end, _ = fut.result()
+					done[path] = sig
+					attempts.pop(path, None)
+					metrics['ok'] += 1
+					res.update({
+						'status': 'ok',
+						'queue_time': start - submitted,
+						'time': end - start,
+					})
+				except Exception as e:
+					res.update({'status': 'error', 'error': str(e)})
+					if n > retries:
+						done[path] = sig
+						attempts.pop(path, None)
+						metrics['failed'] += 1
+					else:
+						attempts[path] = (n, time.time() + interval*2**(n - 1))
+						metrics['retried'] += 1
+						res['retry'] = True
+				event(res)
@@ -36,7 +36,11 @@ setup(
 		'pyproj',
 		'ds-format>=4.1.0',
 		'aquarius-time>=0.3.0',
+		'netCDF4',
 	],
+	extras_require={
+		'numba': ['numba'],
+	},
 	classifiers=[
 		'Development Status :: 5 - Production/Stable',
 		'Environment :: Console',